@@ -1,6 +1,8 @@
+# Builds the optional native ADPCM codec used by adpcmwave.py
+# python setup.py build_ext --build-lib ..
 from distutils.core import setup
 from Cython.Build import cythonize
 
 setup(
-    ext_modules=cythonize("adpcmwave.pyx"),
+    ext_modules=cythonize("adpcmwave_native.pyx"),
 )
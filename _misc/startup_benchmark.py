@@ -0,0 +1,62 @@
+# Measures how long the tools take to start in a fresh interpreter, which is what
+# pool workers and short conversions pay for every time.
+# python startup_benchmark.py [-n RUNS] [modules...]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = [
+    "seqtool",
+    "vas3tool",
+    "wavbintool",
+    "plugins.sq3",
+    "plugins.dtx",
+    "plugins.wav",
+]
+
+# Modules that should only be loaded when they're actually used
+DEFERRED_MODULES = [
+    "imageio",
+    "pykakasi",
+    "ifstools",
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode("utf-8")
+
+
+def benchmark(module, runs):
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        run("import %s" % module)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', help='Number of runs per module', default=10, type=int)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    args = parser.parse_args()
+
+    baseline = statistics.median(benchmark("sys", args.runs))
+    print("%-16s %8.1f ms" % ("(interpreter)", baseline * 1000))
+
+    for module in args.modules:
+        timings = benchmark(module, args.runs)
+
+        loaded = run("import sys, %s; print(' '.join(x for x in %r if x in sys.modules))" % (module, DEFERRED_MODULES)).strip()
+
+        print("%-16s %8.1f ms  min %8.1f ms  %s" % (module,
+                                                    (statistics.median(timings) - baseline) * 1000,
+                                                    (min(timings) - baseline) * 1000,
+                                                    "loads " + loaded if loaded else ""))
@@ -1,41 +1,170 @@
-import os
-import subprocess
-import tmpfile
+import warnings
 
-def decode_data(data, rate, channels, bits):
-    input_filename = tmpfile.mkstemp()
-    output_filename = tmpfile.mkstemp()
+import numpy
 
-    with open(input_filename, "wb") as f:
-        f.write(data)
+try:
+    # Optional native codec, see _misc/setup.py
+    import adpcmwave_native
+except ImportError:
+    adpcmwave_native = None
+    warnings.warn("adpcmwave_native isn't built, using the slower numpy ADPCM codec (see _misc/setup.py)", RuntimeWarning)
 
-    prefix = ""
-    if os.name != "nt":
-        prefix = "wine"
+STEPS = [
+      256,  272,  304,   336,   368,   400,   448,   496,   544,   592,   656,   720,
+      800,  880,  960,  1056,  1168,  1280,  1408,  1552,  1712,  1888,  2080,  2288,
+     2512, 2768, 3040,  3344,  3680,  4048,  4464,  4912,  5392,  5936,  6528,  7184,
+     7904, 8704, 9568, 10528, 11584, 12736, 14016, 15408, 16960, 18656, 20512, 22576,
+     24832
+]
 
-    cmd = "{} adpcmwavetool.exe d \"{}\" \"{}\" {}".format(prefix, input_filename, output_filename, channels)
-    subprocess.call(cmd, shell=True)
+CHANGES = [
+    -1, -1, -1, -1, 2, 4, 6, 8,
+    -1, -1, -1, -1, 2, 4, 6, 8
+]
 
-    with open(output_filename, "rb") as f:
-        data = bytearray(f.read())
 
-    return data
+def get_sample_delta(step, sample):
+    new_sample = (step >> 3) \
+        + ((step >> 2) & -(sample & 1)) \
+        + ((step >> 1) & -((sample >> 1) & 1)) \
+        + (step & -((sample >> 2) & 1))
 
-def encode_data(data, channels):
-    input_filename = tmpfile.mkstemp()
-    output_filename = tmpfile.mkstemp()
+    if (sample & 0x08) != 0:
+        new_sample = -new_sample
+
+    return new_sample
+
+
+# Lookup tables indexed by [step_index][sample]
+DELTA_TABLE = [[get_sample_delta(step, sample) for sample in range(16)] for step in STEPS]
+DELTA_ARRAY = numpy.array(DELTA_TABLE, dtype=numpy.int32)
+NEXT_STEP_INDEX_TABLE = [[min(max(step_index + CHANGES[sample], 0), 48) for sample in range(16)] for step_index in range(len(STEPS))]
+
+
+def clamped_cumsum(deltas, low=-32768, high=32767, last_value=0):
+    # Running sum that saturates at the 16-bit limits like the decoder does.
+    # Sums are computed in windows that shrink after each clip so clipping-heavy audio doesn't go quadratic.
+    output = numpy.empty(len(deltas), dtype=numpy.int16)
+
+    start = 0
+    window = 0x10000
+    while start < len(deltas):
+        values = numpy.cumsum(deltas[start:start+window], dtype=numpy.int64) + last_value
+        clipped = numpy.flatnonzero((values < low) | (values > high))
+
+        if len(clipped) == 0:
+            output[start:start+len(values)] = values
+            last_value = int(values[-1])
+            start += len(values)
+            window = min(window * 2, 0x10000)
+            continue
+
+        end = int(clipped[0])
+        output[start:start+end] = values[:end]
+        last_value = min(max(int(values[end]), low), high)
+        output[start+end] = last_value
+        start += end + 1
+        window = max(end * 2, 0x100)
+
+    return output
+
+
+def decode_samples(samples, state=None):
+    # The step index only depends on the previous samples, so it can be walked
+    # ahead of time and the rest of the decoding done on whole arrays.
+    # state is [step_index, pcm_sample] and is updated to continue decoding the next block.
+    step_indexes = bytearray(len(samples))
+
+    step_index, pcm_sample = state if state else (0, 0)
+    for i, sample in enumerate(samples.tolist()):
+        step_indexes[i] = step_index
+        step_index = NEXT_STEP_INDEX_TABLE[step_index][sample]
+
+    deltas = DELTA_ARRAY[numpy.frombuffer(step_indexes, dtype=numpy.uint8), samples]
+    output = clamped_cumsum(deltas, last_value=pcm_sample)
+
+    if state is not None and len(output) > 0:
+        state[:] = [step_index, int(output[-1])]
+
+    return output
+
+
+def encode_samples(samples):
+    output = bytearray(len(samples))
 
-    with open(input_filename, "wb") as f:
-        f.write(data)
+    step_index = 0
+    pcm_sample = 0
+    for i, sample in enumerate(samples.tolist()):
+        delta = sample - pcm_sample
 
-    prefix = ""
-    if os.name != "nt":
-        prefix = "wine"
+        sign = 0
+        if delta < 0:
+            sign = 0x08
+            delta = -delta
+
+        v = (delta << 2) // STEPS[step_index]
+
+        if v > 7:
+            v = 7
+
+        sample_encode = sign | v
+
+        pcm_sample += DELTA_TABLE[step_index][sample_encode]
+
+        if pcm_sample > 32767:
+            pcm_sample = 32767
+        elif pcm_sample < -32768:
+            pcm_sample = -32768
+
+        step_index = NEXT_STEP_INDEX_TABLE[step_index][sample_encode]
+        output[i] = sample_encode
+
+    return numpy.frombuffer(output, dtype=numpy.uint8)
+
+
+def get_decoder_states(channels):
+    # One [step_index, pcm_sample] per channel, pass the same states to decode_data for every block of a stream
+    return [[0, 0] for _ in range(channels)]
+
+
+def decode_data(data, rate, channels, bits, states=None):
+    if adpcmwave_native:
+        if states is None:
+            return adpcmwave_native.decode_data(data, channels)
+
+        return adpcmwave_native.decode_data(data, channels, states)
+
+    data = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+
+    if channels == 1:
+        # Two samples per byte, high nibble first
+        samples = numpy.empty(len(data) * 2, dtype=numpy.uint8)
+        samples[0::2] = data >> 4
+        samples[1::2] = data & 0x0f
+        output = decode_samples(samples, states[0] if states else None)
+    else:
+        # One frame per byte, left channel in the high nibble
+        output = numpy.empty((len(data), 2), dtype=numpy.int16)
+        output[:, 0] = decode_samples(data >> 4, states[0] if states else None)
+        output[:, 1] = decode_samples(data & 0x0f, states[1] if states else None)
+
+    return bytearray(output.astype('<i2').tobytes())
+
+
+def encode_data(data, channels):
+    if adpcmwave_native:
+        return adpcmwave_native.encode_data(data, channels)
 
-    cmd = "{} adpcmwavetool.exe e \"{}\" \"{}\" {}".format(prefix, input_filename, output_filename, channels)
-    subprocess.call(cmd, shell=True)
+    # Input is raw little endian 16-bit PCM
+    data = data.tobytes() if isinstance(data, numpy.ndarray) else bytes(data)
+    samples = numpy.frombuffer(data, dtype='<i2', count=len(data) // 2)
 
-    with open(output_filename, "rb") as f:
-        data = bytearray(f.read())
+    if channels == 1:
+        # Two samples per byte, a trailing odd sample is dropped
+        encoded = encode_samples(samples[:len(data) // 4 * 2])
+        output = (encoded[0::2] << 4) | encoded[1::2]
+    else:
+        frames = len(data) // 4
+        output = (encode_samples(samples[0:frames*2:2]) << 4) | encode_samples(samples[1:frames*2:2])
 
-    return data
\ No newline at end of file
+    return bytearray(output.astype(numpy.uint8).tobytes())
@@ -1,16 +1,200 @@
 # Audio-related helper functions
 
+import collections
+import glob
+import hashlib
 import os
+import struct
 import subprocess
+import threading
+import numpy
 import pydub
 import tmpfile
+import wavfile
 
 import helper
 
-helper.check_ffmpeg()
 
+# Decoded PCM shared by every render, conversion and re-encode in the process, keyed by
+# (path, mtime, size, rate, channels, bits). The least recently used samples are dropped first
+# once the memory budget is exceeded. When a folder is set, samples are also kept on disk as .npy
+# files so worker processes and later runs don't have to decode them again.
+PCM_CACHE_SIZE_ENV = "GITADORA_PCM_CACHE_SIZE"
+PCM_CACHE_FOLDER_ENV = "GITADORA_PCM_CACHE_FOLDER"
+DEFAULT_PCM_CACHE_SIZE = 256 * 1024 * 1024
 
-def get_audio_file(filename):
+pcm_cache = collections.OrderedDict()
+pcm_cache_lock = threading.Lock()
+pcm_cache_used = 0
+pcm_cache_size = int(os.environ.get(PCM_CACHE_SIZE_ENV, DEFAULT_PCM_CACHE_SIZE))
+pcm_cache_folder = os.environ.get(PCM_CACHE_FOLDER_ENV) or None
+
+# pydub keeps 8-bit audio signed in memory and 24-bit audio is widened to 32-bit when loaded
+SAMPLE_TYPES = {
+    1: numpy.int8,
+    2: numpy.int16,
+    4: numpy.int32,
+}
+
+
+def set_pcm_cache(size=None, folder=None):
+    # The environment is updated as well so worker processes use the same settings
+    global pcm_cache_size, pcm_cache_folder
+
+    if size is not None:
+        pcm_cache_size = size
+        os.environ[PCM_CACHE_SIZE_ENV] = str(size)
+
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+        pcm_cache_folder = folder
+        os.environ[PCM_CACHE_FOLDER_ENV] = folder
+
+    with pcm_cache_lock:
+        evict_pcm_cache()
+
+def clear_pcm_cache():
+    global pcm_cache_used
+
+    with pcm_cache_lock:
+        pcm_cache.clear()
+        pcm_cache_used = 0
+
+def evict_pcm_cache():
+    global pcm_cache_used
+
+    while pcm_cache and pcm_cache_used > pcm_cache_size:
+        _, (samples, _) = pcm_cache.popitem(last=False)
+        pcm_cache_used -= samples.nbytes
+
+def get_pcm_cache_filename(key):
+    return os.path.join(pcm_cache_folder, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+def load_pcm_from_disk(key):
+    # Blobs are named <hash>.<rate>.npy since the rate isn't part of the key when it isn't converted
+    filenames = glob.glob(get_pcm_cache_filename(key) + ".*.npy")
+
+    if not filenames:
+        return None
+
+    try:
+        samples = numpy.load(filenames[0])
+        rate = int(filenames[0].split('.')[-2])
+    except (OSError, ValueError):
+        return None
+
+    return samples, rate
+
+def save_pcm_to_disk(key, samples, rate):
+    filename = "%s.%d.npy" % (get_pcm_cache_filename(key), rate)
+    temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+
+    try:
+        with open(temp_filename, "wb") as f:
+            numpy.save(f, samples)
+
+        os.replace(temp_filename, filename)
+
+    except OSError:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+def add_pcm_to_cache(key, samples, rate):
+    global pcm_cache_used
+
+    samples.flags.writeable = False
+
+    if samples.nbytes > pcm_cache_size:
+        return
+
+    with pcm_cache_lock:
+        if key in pcm_cache:
+            return
+
+        pcm_cache[key] = (samples, rate)
+        pcm_cache_used += samples.nbytes
+        evict_pcm_cache()
+
+def get_pcm_from_cache(key):
+    with pcm_cache_lock:
+        if key in pcm_cache:
+            pcm_cache.move_to_end(key)
+            return pcm_cache[key]
+
+    return None
+
+def get_pcm(filename, rate=None, channels=None, bits=None):
+    # Returns the integer samples shaped (frames, channels) and their rate,
+    # converted to the requested format. The samples are shared and read-only.
+    filename = helper.getCaseInsensitivePath(filename)
+    if not filename or not os.path.exists(filename):
+        return None
+
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, rate, channels, bits)
+
+    pcm = get_pcm_from_cache(key)
+    if pcm is not None:
+        return pcm
+
+    pcm = load_pcm_from_disk(key) if pcm_cache_folder else None
+
+    if pcm is None:
+        sound_file = load_audio_file(filename)
+
+        if not sound_file:
+            return None
+
+        if bits and sound_file.sample_width != bits // 8:
+            sound_file = sound_file.set_sample_width(bits // 8)
+
+        if channels and sound_file.channels != channels:
+            sound_file = sound_file.set_channels(channels)
+
+        if rate and sound_file.frame_rate != rate:
+            sound_file = sound_file.set_frame_rate(rate)
+
+        samples = numpy.frombuffer(sound_file.raw_data, dtype=SAMPLE_TYPES[sound_file.sample_width])
+        pcm = samples.reshape(-1, sound_file.channels), sound_file.frame_rate
+
+        if pcm_cache_folder:
+            save_pcm_to_disk(key, *pcm)
+
+    add_pcm_to_cache(key, *pcm)
+
+    return pcm
+
+def get_archive_pcm(archive_filename, sound_id, load, rate=None):
+    # Same as get_pcm for a sound stored inside an archive, keyed by the archive's path and mtime
+    # and the sound id. load() is only called on a miss and returns the 16-bit samples shaped
+    # (frames, channels) and their rate.
+    stat = os.stat(archive_filename)
+    key = (os.path.abspath(archive_filename), stat.st_mtime_ns, stat.st_size, sound_id, rate)
+
+    pcm = get_pcm_from_cache(key)
+    if pcm is not None:
+        return pcm
+
+    pcm = load_pcm_from_disk(key) if pcm_cache_folder else None
+
+    if pcm is None:
+        samples, sample_rate = load()
+
+        if rate and sample_rate != rate:
+            sound_file = get_audio_from_pcm(samples, sample_rate).set_frame_rate(rate)
+            samples = numpy.frombuffer(sound_file.raw_data, dtype=SAMPLE_TYPES[sound_file.sample_width])
+            samples, sample_rate = samples.reshape(-1, sound_file.channels), sound_file.frame_rate
+
+        pcm = samples, sample_rate
+
+        if pcm_cache_folder:
+            save_pcm_to_disk(key, *pcm)
+
+    add_pcm_to_cache(key, *pcm)
+
+    return pcm
+
+def load_audio_file(filename):
     filename = helper.getCaseInsensitivePath(filename)
     if not filename or not os.path.exists(filename):
         return None
@@ -23,52 +207,384 @@ def get_audio_file(filename):
         else:
             filename = wav_filename
 
+    helper.ensure_ffmpeg()
     return pydub.AudioSegment.from_file(filename, "wav")
 
+def get_audio_file(filename):
+    pcm = get_pcm(filename)
+
+    if pcm is None:
+        return None
+
+    return get_audio_from_pcm(*pcm)
+
+def get_audio_from_pcm(samples, rate):
+    return pydub.AudioSegment(data=samples.tobytes(),
+                              sample_width=samples.dtype.itemsize,
+                              frame_rate=rate,
+                              channels=samples.shape[1])
+
+def get_samples_from_pcm(samples, channels=2):
+    # Returns float32 samples shaped (frames, channels) in the range [-1, 1)
+    samples = samples.astype(numpy.float32) / (1 << (samples.dtype.itemsize * 8 - 1))
+
+    if samples.shape[1] < channels:
+        samples = numpy.repeat(samples[:, :1], channels, axis=1)
+
+    return samples[:, :channels]
+
+def get_samples(sound_file, rate, channels=2):
+    if sound_file.frame_rate != rate:
+        sound_file = sound_file.set_frame_rate(rate)
+
+    samples = numpy.frombuffer(sound_file.raw_data, dtype=SAMPLE_TYPES[sound_file.sample_width])
+
+    return get_samples_from_pcm(samples.reshape(-1, sound_file.channels), channels)
+
+def get_cached_samples(filename, rate, channels=2):
+    pcm = get_pcm(filename, rate=rate)
+
+    if pcm is None:
+        return None
+
+    return get_samples_from_pcm(pcm[0], channels)
+
+# Frames converted and written at a time when streaming audio to a WAV
+EXPORT_BLOCK_SIZE = 0x10000
+
+def get_pcm_from_samples(samples):
+    return numpy.clip(numpy.round(samples * 32768), -32768, 32767).astype('<i2')
+
+def get_audio_from_samples(samples, rate):
+    samples = get_pcm_from_samples(samples)
+
+    return pydub.AudioSegment(data=samples.tobytes(),
+                              sample_width=2,
+                              frame_rate=rate,
+                              channels=samples.shape[1])
+
+def export_samples(samples, rate, output_filename, format="wav", bitrate=None):
+    # WAVs are converted and written a block at a time instead of building the whole
+    # 16-bit copy first, other formats need ffmpeg through pydub
+    if format.lower() == "wav":
+        with wavfile.WavWriter(output_filename, rate, samples.shape[1]) as writer:
+            for start in range(0, len(samples), EXPORT_BLOCK_SIZE):
+                writer.write(get_pcm_from_samples(samples[start:start+EXPORT_BLOCK_SIZE]))
+
+        return
+
+    helper.ensure_ffmpeg()
+    get_audio_from_samples(samples, rate).export(output_filename, format=format, tags={}, bitrate=bitrate)
+
+# Durations by (path, mtime, size), DTX imports probe the same keysounds for every chart of a song.
+# Like the PCM cache the least recently used entries are dropped first, bounded by the number of files.
+DURATION_CACHE_SIZE = 0x4000
+
+duration_cache = collections.OrderedDict()
+duration_cache_lock = threading.Lock()
+
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+def get_duration_from_frames(frames, rate):
+    # Same rounding as len(AudioSegment)
+    return round(1000 * (frames / rate)) / 1000
+
+def get_wav_duration(f, file_size):
+    # Only PCM data is handled, anything else is decoded
+    wav_info = wavfile.info(f)
+
+    if wav_info.format not in [1, 0xfffe] or wav_info.rate == 0 or wav_info.channels * (wav_info.bits // 8) == 0:
+        return None
+
+    return get_duration_from_frames(wav_info.frames, wav_info.rate)
+
+def get_ogg_duration(f, file_size):
+    # The last page's granule position is the number of samples in the stream
+    data = f.read(0x1000)
+    if data[0:4] != b"OggS" or len(data) < 27:
+        return None
+
+    packet = data[27+data[26]:]
+    if packet[0:7] == b"\x01vorbis" and len(packet) >= 16:
+        rate = struct.unpack("<I", packet[12:16])[0]
+        pre_skip = 0
+    elif packet[0:8] == b"OpusHead" and len(packet) >= 12:
+        # Opus granule positions are always at 48kHz and include the encoder delay
+        rate = 48000
+        pre_skip = struct.unpack("<H", packet[10:12])[0]
+    else:
+        return None
+
+    f.seek(max(file_size - 0x10000, 0))
+    data = f.read()
+
+    pos = data.rfind(b"OggS")
+    while pos >= 0:
+        if pos + 14 <= len(data):
+            granule = struct.unpack("<q", data[pos+6:pos+14])[0]
+
+            if granule >= 0:
+                return get_duration_from_frames(max(granule - pre_skip, 0), rate) if rate else None
+
+        pos = data.rfind(b"OggS", 0, pos)
+
+    return None
+
+def get_mp3_frame_info(header):
+    # Returns (frame size, samples per frame, sample rate) of an MPEG audio frame header
+    if len(header) < 4 or header[0] != 0xff or (header[1] & 0xe0) != 0xe0:
+        return None
+
+    version = {0: 2.5, 2: 2, 3: 1}.get((header[1] >> 3) & 0x03)
+    layer = {1: 3, 2: 2, 3: 1}.get((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+
+    if version is None or layer is None or bitrate_index in [0, 15] or rate_index == 3:
+        return None
+
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    rate = MP3_SAMPLE_RATES[version][rate_index]
+
+    if layer == 1:
+        return (12 * bitrate // rate + padding) * 4, 384, rate
+
+    if layer == 3 and version != 1:
+        return 72 * bitrate // rate + padding, 576, rate
+
+    return 144 * bitrate // rate + padding, 1152, rate
+
+def get_mp3_duration(f, file_size):
+    header = f.read(10)
+
+    pos = 0
+    if header[0:3] == b"ID3" and len(header) == 10:
+        # Skip the ID3v2 tag, its size is stored as a syncsafe integer
+        pos = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+
+        if header[5] & 0x10:
+            pos += 10
+
+    f.seek(pos)
+    data = f.read(0x2000)
+
+    # The audio has to start right after the tag, anything else is left to ffmpeg
+    frame_info = get_mp3_frame_info(data[0:4])
+    if not frame_info or not get_mp3_frame_info(data[frame_info[0]:frame_info[0]+4]):
+        return None
+
+    frame_size, samples_per_frame, rate = frame_info
+
+    # A Xing/Info or VBRI header in the first frame already has the frame count
+    frame = data[0:frame_size]
+    for tag in [b"Xing", b"Info"]:
+        tag_pos = frame.find(tag, 4, 40)
+
+        if tag_pos == -1 or len(frame) < tag_pos + 8:
+            continue
+
+        flags = struct.unpack(">I", frame[tag_pos+4:tag_pos+8])[0]
+        if not (flags & 0x01) or len(frame) < tag_pos + 12:
+            # The tag frame isn't audio so walking the frames would be off, leave it to ffmpeg
+            return None
+
+        frames = struct.unpack(">I", frame[tag_pos+8:tag_pos+12])[0]
+
+        # The LAME tag follows the optional frame count, byte count, TOC and quality fields.
+        # Decoders drop its encoder delay and padding, so the duration doesn't include them.
+        lame_pos = tag_pos + 8 + sum(size for flag, size in [(0x01, 4), (0x02, 4), (0x04, 100), (0x08, 4)] if flags & flag)
+        delay = 0
+        padding = 0
+
+        if frame[lame_pos:lame_pos+4] in [b"LAME", b"Lavf", b"Lavc"]:
+            if len(frame) < lame_pos + 24:
+                return None
+
+            delay = frame[lame_pos+21] << 4 | frame[lame_pos+22] >> 4
+            padding = (frame[lame_pos+22] & 0x0f) << 8 | frame[lame_pos+23]
+
+        return get_duration_from_frames(max(frames * samples_per_frame - delay - padding, 0), rate)
+
+    if frame[36:40] == b"VBRI" and len(frame) >= 54:
+        frames = struct.unpack(">I", frame[50:54])[0]
+        return get_duration_from_frames(frames * samples_per_frame, rate)
+
+    # Otherwise walk the frame headers
+    samples = 0
+    while pos + 4 <= file_size:
+        f.seek(pos)
+        frame_info = get_mp3_frame_info(f.read(4))
+
+        if not frame_info:
+            break
+
+        pos += frame_info[0]
+        samples += frame_info[1]
+
+    return get_duration_from_frames(samples, rate)
+
+def probe_duration(filename):
+    # Reads the duration from the file's headers, None if the file has to be decoded instead
+    if filename.lower().endswith('.xa'):
+        return None
+
+    file_size = os.path.getsize(filename)
+
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+        f.seek(0)
+
+        if magic == b"RIFF":
+            get_format_duration = get_wav_duration
+        elif magic == b"OggS":
+            get_format_duration = get_ogg_duration
+        elif magic[0:3] == b"ID3" or get_mp3_frame_info(magic):
+            get_format_duration = get_mp3_duration
+        else:
+            return None
+
+        try:
+            return get_format_duration(f, file_size)
+        except (struct.error, ValueError):
+            return None
+
 def get_duration(filename):
     filename = helper.getCaseInsensitivePath(filename)
-    sound_file = get_audio_file(filename)
 
-    if not sound_file:
+    if not filename or not os.path.exists(filename):
         return 0
 
-    return len(sound_file) / 1000
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+    with duration_cache_lock:
+        if key in duration_cache:
+            duration_cache.move_to_end(key)
+            return duration_cache[key]
+
+    duration = probe_duration(filename)
+
+    if duration is None:
+        sound_file = get_audio_file(filename)
+        duration = len(sound_file) / 1000 if sound_file else 0
+
+    with duration_cache_lock:
+        duration_cache[key] = duration
+
+        while len(duration_cache) > DURATION_CACHE_SIZE:
+            duration_cache.popitem(last=False)
+
+    return duration
+
+def read_wav_mmap(filename):
+    # Returns the rate and a read-only memory map of the samples for plain PCM WAVs, otherwise None
+    try:
+        wav_info = wavfile.info(filename)
+    except (struct.error, ValueError, OSError):
+        return None
+
+    if wav_info.format != 1 or wav_info.bits not in [8, 16, 32] or wav_info.frames == 0:
+        return None
+
+    rate, data = wavfile.read(filename, mmap=True)[:2]
+    return rate, data
 
 def clip_audio(input_filename, output_filename, duration):
     filename = helper.getCaseInsensitivePath(input_filename)
-    sound_file = get_audio_file(filename)[:duration * 1000]
-    sound_file.export(output_filename, format="wav")
-    print("Generated", output_filename, len(sound_file) / 1000, duration)
+    wav = read_wav_mmap(filename)
+
+    if wav is None:
+        sound_file = get_audio_file(filename)[:duration * 1000]
+        sound_file.export(output_filename, format="wav")
+        print("Generated", output_filename, len(sound_file) / 1000, duration)
+        return
+
+    # Only the clipped part of the mapped samples is read.
+    # The length is rounded the same way as slicing with pydub, which pads the last frames with silence.
+    rate, data = wav
+    length = min(duration * 1000, round(1000 * (len(data) / rate)))
+    frames = int(length * (rate / 1000.0))
+
+    clipped = data[:frames]
+    if len(clipped) < frames:
+        clipped = numpy.concatenate([clipped, numpy.zeros((frames - len(clipped),) + data.shape[1:], dtype=data.dtype)])
+
+    wavfile.write(output_filename, rate, clipped)
+    print("Generated", output_filename, round(1000 * (frames / rate)) / 1000, duration)
 
 def merge_bgm(bgm_info, input_foldername, output_filename=None):
     longest_duration = bgm_info['end']
 
-    # Find maximum duration of BGM
+    helper.ensure_ffmpeg()
+
+    # Find maximum duration of BGM, everything is mixed in the widest format used by the parts
+    bgm_files = []
     channels = 1
+    rate = 48000
+    sample_width = 2
     for bgm in bgm_info['data']:
         filename = helper.getCaseInsensitivePath(os.path.join(input_foldername, bgm['filename']))
         print(filename)
-        bgm['file'] = pydub.AudioSegment.from_file(filename)
-        duration = bgm['timestamp'] + len(bgm['file']) / 1000
+        sound_file = pydub.AudioSegment.from_file(filename)
+        duration = bgm['timestamp'] + len(sound_file) / 1000
 
-        if bgm['file'].channels > channels:
-            channels = bgm['file'].channels
+        channels = max(channels, sound_file.channels)
+        rate = max(rate, sound_file.frame_rate)
+        sample_width = max(sample_width, sound_file.sample_width)
 
         if duration > longest_duration:
             longest_duration = duration
 
-    output = pydub.AudioSegment.silent(duration=longest_duration * 1000, frame_rate=48000)
-    output.set_channels(channels)
+        bgm_files.append((bgm['timestamp'], sound_file))
 
-    for bgm in bgm_info['data']:
-        output = output.overlay(bgm['file'], position=bgm['timestamp'] * 1000)
+    frames = int(rate * longest_duration)
+
+    parts = []
+    for timestamp, sound_file in bgm_files:
+        # Overlaying with pydub trimmed the output to whole milliseconds every time, keep the same length
+        length = round(1000 * frames / rate)
+        frames = int(length * (rate / 1000.0))
+
+        sound_file = sound_file.set_channels(channels).set_frame_rate(rate).set_sample_width(sample_width)
+        samples = numpy.frombuffer(sound_file.raw_data, dtype=SAMPLE_TYPES[sample_width]).reshape(-1, channels)
+        parts.append((int(min(timestamp * 1000, length) * (rate / 1000.0)), samples))
 
     if output_filename:
         temp_filename = output_filename
     else:
         temp_filename = tmpfile.mkstemp(suffix=".wav")
 
-    output.export(temp_filename, format="wav")
+    # The output is mixed and written a block at a time, each part is added with
+    # saturation in order like overlaying them one after another would
+    limits = numpy.iinfo(SAMPLE_TYPES[sample_width])
+    with wavfile.WavWriter(temp_filename, rate, channels, bits=sample_width * 8) as writer:
+        for start in range(0, frames, EXPORT_BLOCK_SIZE):
+            end = min(start + EXPORT_BLOCK_SIZE, frames)
+            output = numpy.zeros((end - start, channels), dtype=numpy.int64)
+
+            for offset, samples in parts:
+                part_start = max(start, offset)
+                part_end = min(end, offset + len(samples))
+
+                if part_start < part_end:
+                    output[part_start-start:part_end-start] += samples[part_start-offset:part_end-offset]
+                    numpy.clip(output, limits.min, limits.max, out=output)
+
+            writer.write(output)
 
     return temp_filename
 
@@ -104,28 +620,18 @@ def get_wav_from_pcm(input_filename):
 def get_processed_wav(input_filename, output_filename=None, channels=1, bits=16, rate=48000):
     input_filename = helper.getCaseInsensitivePath(input_filename)
 
-    output = get_audio_file(input_filename)
+    pcm = get_pcm(input_filename)
 
-    if not output:
+    if pcm is None:
         return None
 
-    made_change = False
-    if output.sample_width != bits // 8:
-        made_change = True
-        output = output.set_sample_width(bits // 8)
-
-    if output.channels != channels:
-        made_change = True
-        output = output.set_channels(channels)
-
-    if output.frame_rate != rate:
-        made_change = True
-        output = output.set_frame_rate(rate)
-
-    if not made_change and input_filename.lower().endswith('.wav'):
+    samples, input_rate = pcm
+    if samples.dtype.itemsize == bits // 8 and samples.shape[1] == channels and input_rate == rate and input_filename.lower().endswith('.wav'):
         # This file is already the exact requirements, just return the original
         return input_filename
 
+    output = get_audio_from_pcm(*get_pcm(input_filename, rate=rate, channels=channels, bits=bits))
+
     if output_filename == None:
         output_filename = tmpfile.mkstemp(suffix=".wav")
 
@@ -22,12 +22,15 @@ rmdir /S /Q %release%\manage_packages\__pycache__
 
 
 REM Prepare actual work tools for custom charters
-copy /Y adpcmwavetool.exe %release%\work
 copy /Y xa.exe %release%\work
 
 xcopy /Y /E /I plugins %release%\work\plugins
 copy /Y adpcmwave.py %release%\work
+REM The native ADPCM codec has to be rebuilt from _misc\adpcmwave_native.pyx whenever it changes,
+REM older builds don't take the states argument of decode_data (see README.md)
+if exist adpcmwave_native*.pyd copy /Y adpcmwave_native*.pyd %release%\work
 copy /Y audio.py %release%\work
+copy /Y convcache.py %release%\work
 copy /Y create_gst.py %release%\work
 copy /Y eamxml.py %release%\work
 copy /Y event.py %release%\work
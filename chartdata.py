@@ -0,0 +1,582 @@
+# Compact in-memory chart representation shared by the readers and writers.
+# Charts read from output.json are plain dicts until a writer converts them with get_charts.
+import copy
+
+import numpy
+
+# Flags stored per event
+FLAG_FLOAT_TIMESTAMP = 1 << 0 # Timestamp key was a float, ex. DTX charts
+FLAG_HAS_TIMESTAMP = 1 << 1 # Event carries its own timestamp field
+FLAG_HAS_DATA = 1 << 2
+FLAG_HAS_NOTE = 1 << 3
+FLAG_HAS_BONUS_NOTE = 1 << 4
+FLAG_BONUS_NOTE = 1 << 5
+FLAG_BONUS_NOTE_BOOL = 1 << 6
+
+# Fields that are stored in typed columns when they are present and fit the column type.
+# Anything else goes into the side table.
+EVENT_COLUMNS = [
+    ('id', numpy.uint8),
+    ('beat', numpy.int64),
+]
+
+DATA_COLUMNS = [
+    ('sound_id', numpy.uint32),
+    ('sound_unk', numpy.uint16),
+    ('volume', numpy.uint8),
+    ('auto_volume', numpy.uint8),
+    ('auto_note', numpy.uint8),
+    ('hold_duration', numpy.uint32),
+    ('note_length', numpy.uint32),
+    ('unk', numpy.uint32),
+    ('wail_misc', numpy.uint8),
+    ('wail_direction', numpy.uint8),
+    ('guitar_special', numpy.uint8),
+]
+
+COLUMN_FLAGS = {}
+for i, (field, _) in enumerate(EVENT_COLUMNS + DATA_COLUMNS):
+    COLUMN_FLAGS[field] = 1 << (7 + i)
+
+EVENT_FIELDS = [field for field, _ in EVENT_COLUMNS]
+COLUMN_LIMITS = {field: numpy.iinfo(dtype) for field, dtype in EVENT_COLUMNS + DATA_COLUMNS}
+
+NO_NAME = 0xffff
+
+
+def fits_column(field, value):
+    if type(value) is not int:
+        return False
+
+    return COLUMN_LIMITS[field].min <= value <= COLUMN_LIMITS[field].max
+
+
+def parse_timestamp_key(key):
+    if isinstance(key, str):
+        key = float(key) if any(c in key for c in ".eEn") else int(key)
+
+    return float(key), isinstance(key, float)
+
+
+def get_timestamp_key(timestamp, flags, raw_keys=False):
+    if not flags & FLAG_FLOAT_TIMESTAMP:
+        timestamp = int(timestamp)
+
+    return timestamp if raw_keys else str(timestamp)
+
+
+def get_value_array(values, count):
+    # Python values keep their type unless they are all ints, ex. bools stay bools in the side table
+    if isinstance(values, numpy.ndarray):
+        return values
+
+    if not isinstance(values, (list, tuple)):
+        values = [values] * count
+
+    if all(type(x) is int for x in values) and all(-(1 << 63) <= x < (1 << 63) for x in values):
+        return numpy.array(values, dtype=numpy.int64)
+
+    if all(type(x) is bool for x in values):
+        return numpy.array(values, dtype=bool)
+
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def get_table_index(table, value):
+    if value not in table:
+        table.append(value)
+
+    return table.index(value)
+
+
+class ChartData:
+    """Compact chart representation.
+
+    Events are kept sorted by timestamp in parallel typed arrays, events sharing
+    a timestamp keep the order they were added in.
+    Names and note names are stored as indexes into per-chart string tables and
+    rarely used fields (bpm, time signatures, etc) are kept in a side table keyed by row.
+    The other chart fields (header, etc) are read and written like the keys of a chart dict.
+
+    Functions taking rows accept None for every event, a boolean mask or
+    an array of row indexes in ascending order.
+    """
+
+    def __init__(self, info=None):
+        self.info = info if info is not None else {}
+        self.event_names = []
+        self.note_names = []
+        self.extras = {}
+
+        self.timestamp = numpy.zeros(0, dtype=numpy.float64)
+        self.flags = numpy.zeros(0, dtype=numpy.uint32)
+        self.event = numpy.zeros(0, dtype=numpy.uint16)
+        self.note = numpy.zeros(0, dtype=numpy.uint16)
+        self.columns = {field: numpy.zeros(0, dtype=dtype) for field, dtype in EVENT_COLUMNS + DATA_COLUMNS}
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __bool__(self):
+        # Charts are always truthy like the chart dicts they replace, even without events
+        return True
+
+    def __getitem__(self, key):
+        return self.info[key]
+
+    def __setitem__(self, key, value):
+        self.info[key] = value
+
+    def __contains__(self, key):
+        return key in self.info
+
+    def get(self, key, default=None):
+        return self.info.get(key, default)
+
+    @classmethod
+    def from_events(cls, info, timestamps, events):
+        """Creates a chart from a list of timestamp keys and the list of event dicts at those timestamps"""
+        self = cls(info)
+
+        event_name_index = {}
+        note_name_index = {}
+
+        timestamp_values = []
+        flags = []
+        event = []
+        note = []
+        columns = {field: [] for field in self.columns}
+        extras = {}
+
+        for row, (timestamp_key, entry) in enumerate(zip(timestamps, events)):
+            timestamp, is_float = parse_timestamp_key(timestamp_key)
+
+            row_flags = FLAG_FLOAT_TIMESTAMP if is_float else 0
+            entry_extra = {}
+            data_extra = {}
+
+            for k in entry:
+                value = entry[k]
+
+                if k == 'name':
+                    if value not in event_name_index:
+                        event_name_index[value] = len(self.event_names)
+                        self.event_names.append(value)
+
+                elif k == 'timestamp' and type(value) is (float if is_float else int) and float(value) == timestamp:
+                    row_flags |= FLAG_HAS_TIMESTAMP
+
+                elif k == 'data' and isinstance(value, dict):
+                    row_flags |= FLAG_HAS_DATA
+
+                elif k in EVENT_FIELDS and fits_column(k, value):
+                    row_flags |= COLUMN_FLAGS[k]
+
+                else:
+                    entry_extra[k] = value
+
+            for k in entry.get('data', {}) if row_flags & FLAG_HAS_DATA else []:
+                value = entry['data'][k]
+
+                if k == 'note' and isinstance(value, str):
+                    if value not in note_name_index:
+                        note_name_index[value] = len(self.note_names)
+                        self.note_names.append(value)
+
+                    row_flags |= FLAG_HAS_NOTE
+
+                elif k == 'bonus_note' and value in [0, 1] and type(value) in [int, bool]:
+                    row_flags |= FLAG_HAS_BONUS_NOTE
+
+                    if value:
+                        row_flags |= FLAG_BONUS_NOTE
+
+                    if type(value) is bool:
+                        row_flags |= FLAG_BONUS_NOTE_BOOL
+
+                elif k in COLUMN_FLAGS and k not in EVENT_FIELDS and fits_column(k, value):
+                    row_flags |= COLUMN_FLAGS[k]
+
+                else:
+                    data_extra[k] = value
+
+            timestamp_values.append(timestamp)
+            flags.append(row_flags)
+            event.append(event_name_index[entry['name']] if 'name' in entry else NO_NAME)
+            note.append(note_name_index[entry['data']['note']] if row_flags & FLAG_HAS_NOTE else 0)
+
+            for field in columns:
+                has_field = row_flags & COLUMN_FLAGS[field]
+                source = entry if field in EVENT_FIELDS else entry.get('data')
+                columns[field].append(source[field] if has_field else 0)
+
+            if entry_extra or data_extra:
+                extras[row] = copy.deepcopy((entry_extra, data_extra))
+
+        self.timestamp = numpy.array(timestamp_values, dtype=numpy.float64)
+        self.flags = numpy.array(flags, dtype=numpy.uint32)
+        self.event = numpy.array(event, dtype=numpy.uint16)
+        self.note = numpy.array(note, dtype=numpy.uint16)
+
+        for field, dtype in EVENT_COLUMNS + DATA_COLUMNS:
+            self.columns[field] = numpy.array(columns[field], dtype=dtype)
+
+        self.extras = extras
+
+        return self.take(numpy.argsort(self.timestamp, kind='stable'))
+
+    @classmethod
+    def from_dict(cls, chart):
+        info = {k: copy.deepcopy(chart[k]) for k in chart if k != 'timestamp'}
+        timestamps = []
+        events = []
+
+        for timestamp_key in chart.get('timestamp', {}):
+            for entry in chart['timestamp'][timestamp_key]:
+                timestamps.append(timestamp_key)
+                events.append(entry)
+
+        return cls.from_events(info, timestamps, events)
+
+    @classmethod
+    def from_columns(cls, info, timestamps, names, fields={}):
+        """Creates a chart from an array of timestamps and an array of event names.
+
+        fields maps field names to a value for every event, every event gets a data dict.
+        Fields only some events have are set with set_values once the chart is created.
+        """
+        self = cls(info)
+
+        timestamps = numpy.asarray(timestamps)
+        self.timestamp = timestamps.astype(numpy.float64)
+        self.flags = numpy.full(len(timestamps), FLAG_HAS_DATA, dtype=numpy.uint32)
+
+        if timestamps.dtype.kind == 'f':
+            self.flags |= FLAG_FLOAT_TIMESTAMP
+
+        event_names, event = numpy.unique(numpy.asarray(names, dtype=object), return_inverse=True)
+        self.event_names = event_names.tolist()
+        self.event = event.astype(numpy.uint16)
+        self.note = numpy.zeros(len(timestamps), dtype=numpy.uint16)
+        self.columns = {field: numpy.zeros(len(timestamps), dtype=dtype) for field, dtype in EVENT_COLUMNS + DATA_COLUMNS}
+
+        for field in fields:
+            self.set_values(field, None, fields[field])
+
+        return self.take(numpy.argsort(self.timestamp, kind='stable'))
+
+    def take(self, rows, info=None):
+        # New chart holding the given rows in the given order.
+        # Side table entries are never changed in place so they can be shared.
+        chart = ChartData(self.info if info is None else info)
+        chart.event_names = list(self.event_names)
+        chart.note_names = list(self.note_names)
+
+        chart.timestamp = self.timestamp[rows]
+        chart.flags = self.flags[rows]
+        chart.event = self.event[rows]
+        chart.note = self.note[rows]
+        chart.columns = {field: self.columns[field][rows] for field in self.columns}
+
+        if self.extras:
+            position = numpy.full(len(self), -1, dtype=numpy.int64)
+            position[rows] = numpy.arange(len(chart))
+            chart.extras = {int(position[row]): self.extras[row] for row in self.extras if position[row] >= 0}
+
+        return chart
+
+    def copy(self):
+        return self.take(numpy.arange(len(self)), copy.deepcopy(self.info))
+
+    def select(self, rows, info=None):
+        """Returns a chart with only the given rows"""
+        return self.take(self.get_rows(rows), info)
+
+    def merge(self, other):
+        """Returns a chart with the events of both charts and this chart's other fields.
+
+        Events from other go after this chart's events at the same timestamp.
+        """
+        combined = ChartData(self.info)
+        combined.event_names = list(self.event_names)
+        combined.note_names = list(self.note_names)
+
+        event = other.event.copy()
+        for i, name in enumerate(other.event_names):
+            event[other.event == i] = get_table_index(combined.event_names, name)
+
+        note = other.note.copy()
+        for i, name in enumerate(other.note_names):
+            note[(other.note == i) & (other.flags & FLAG_HAS_NOTE != 0)] = get_table_index(combined.note_names, name)
+
+        combined.timestamp = numpy.concatenate([self.timestamp, other.timestamp])
+        combined.flags = numpy.concatenate([self.flags, other.flags])
+        combined.event = numpy.concatenate([self.event, event])
+        combined.note = numpy.concatenate([self.note, note])
+        combined.columns = {field: numpy.concatenate([self.columns[field], other.columns[field]]) for field in self.columns}
+        combined.extras = dict(self.extras)
+        combined.extras.update({row + len(self): other.extras[row] for row in other.extras})
+
+        # Both charts are already sorted so the other chart's rows only need to be slotted in
+        other_rows = numpy.searchsorted(self.timestamp, other.timestamp, side='right') + numpy.arange(len(other))
+        is_other = numpy.zeros(len(combined), dtype=bool)
+        is_other[other_rows] = True
+
+        order = numpy.empty(len(combined), dtype=numpy.int64)
+        order[~is_other] = numpy.arange(len(self))
+        order[is_other] = numpy.arange(len(self), len(combined))
+
+        return combined.take(order)
+
+    def get_rows(self, rows=None):
+        if rows is None:
+            return numpy.arange(len(self))
+
+        rows = numpy.asarray(rows)
+
+        if rows.dtype == bool:
+            return numpy.flatnonzero(rows)
+
+        return rows.astype(numpy.int64)
+
+    def get_event_mask(self, names):
+        indexes = [i for i, name in enumerate(self.event_names) if name in names]
+        return numpy.isin(self.event, indexes)
+
+    def get_note_mask(self, notes):
+        indexes = [i for i, name in enumerate(self.note_names) if name in notes]
+        return numpy.isin(self.note, indexes) & (self.flags & FLAG_HAS_NOTE != 0)
+
+    def get_timestamp_groups(self):
+        """Returns the first row of each timestamp and the row after the last one"""
+        starts = numpy.flatnonzero(numpy.diff(self.timestamp)) + 1
+        return numpy.concatenate([[0], starts, [len(self)]]) if len(self) else numpy.zeros(1, dtype=numpy.int64)
+
+    def get_extra_rows(self, field, rows):
+        # Positions in rows of the rows that have field in the side table
+        level = 0 if field in EVENT_FIELDS else 1
+        extra_rows = [row for row in self.extras if field in self.extras[row][level]]
+
+        if not extra_rows:
+            return []
+
+        extra_rows = numpy.array(sorted(extra_rows), dtype=numpy.int64)
+        positions = numpy.searchsorted(rows, extra_rows)
+        found = positions < len(rows)
+        found[found] = rows[positions[found]] == extra_rows[found]
+
+        return list(zip(extra_rows[found].tolist(), positions[found].tolist()))
+
+    def has_values(self, field, rows=None):
+        rows = self.get_rows(rows)
+        flags = self.flags[rows]
+
+        if field == 'name':
+            present = self.event[rows] != NO_NAME
+        elif field == 'timestamp':
+            present = flags & FLAG_HAS_TIMESTAMP != 0
+        elif field == 'data':
+            present = flags & FLAG_HAS_DATA != 0
+        elif field == 'note':
+            present = flags & FLAG_HAS_NOTE != 0
+        elif field == 'bonus_note':
+            present = flags & FLAG_HAS_BONUS_NOTE != 0
+        elif field in COLUMN_FLAGS:
+            present = flags & COLUMN_FLAGS[field] != 0
+        else:
+            present = numpy.zeros(len(rows), dtype=bool)
+
+        for _, position in self.get_extra_rows(field, rows):
+            present[position] = True
+
+        return present
+
+    def get_values(self, field, rows=None, default=None):
+        """Returns a list with the field's value for each row, or default for rows without it"""
+        rows = self.get_rows(rows)
+        present = self.has_values(field, rows).tolist()
+
+        if field == 'name':
+            values = [self.event_names[x] if x != NO_NAME else None for x in self.event[rows].tolist()]
+        elif field == 'note':
+            values = [self.note_names[x] if x < len(self.note_names) else None for x in self.note[rows].tolist()]
+        elif field == 'bonus_note':
+            flags = self.flags[rows]
+            bonus_notes = (flags & FLAG_BONUS_NOTE != 0).tolist()
+            is_bool = (flags & FLAG_BONUS_NOTE_BOOL != 0).tolist()
+            values = [bool(x) if b else int(x) for x, b in zip(bonus_notes, is_bool)]
+        elif field == 'timestamp':
+            values = self.get_timestamp_keys(rows, True)
+        elif field in COLUMN_FLAGS:
+            values = self.columns[field][rows].tolist()
+        else:
+            values = [None] * len(rows)
+
+        values = [x if p else default for x, p in zip(values, present)]
+
+        level = 0 if field in EVENT_FIELDS else 1
+        for row, position in self.get_extra_rows(field, rows):
+            values[position] = copy.deepcopy(self.extras[row][level][field])
+
+        return values
+
+    def set_extra(self, row, field, value=None, remove=False):
+        level = 0 if field in EVENT_FIELDS else 1
+        extra = [dict(x) for x in self.extras.get(row, ({}, {}))]
+
+        if remove:
+            extra[level].pop(field, None)
+        else:
+            extra[level][field] = value
+
+        if extra[0] or extra[1]:
+            self.extras[row] = tuple(extra)
+        elif row in self.extras:
+            del self.extras[row]
+
+    def set_values(self, field, rows, values):
+        """Sets a field for the given rows, values is a single value or a value for each row"""
+        rows = self.get_rows(rows)
+
+        values = get_value_array(values, len(rows))
+
+        if field == 'name':
+            self.event[rows] = [get_table_index(self.event_names, x) for x in values.tolist()]
+            return
+
+        for row, _ in self.get_extra_rows(field, rows):
+            self.set_extra(row, field, remove=True)
+
+        data_flag = 0 if field in EVENT_FIELDS else FLAG_HAS_DATA
+
+        if field == 'note':
+            self.note[rows] = [get_table_index(self.note_names, x) for x in values.tolist()]
+            self.flags[rows] |= FLAG_HAS_NOTE | FLAG_HAS_DATA
+
+        elif field == 'bonus_note':
+            is_bool = values.dtype == bool
+            self.flags[rows] &= ~numpy.uint32(FLAG_BONUS_NOTE | FLAG_BONUS_NOTE_BOOL)
+            self.flags[rows] |= FLAG_HAS_BONUS_NOTE | FLAG_HAS_DATA | (FLAG_BONUS_NOTE_BOOL if is_bool else 0)
+            self.flags[rows[values.astype(bool)]] |= FLAG_BONUS_NOTE
+
+        elif field in COLUMN_FLAGS and values.dtype.kind in 'iu':
+            limits = COLUMN_LIMITS[field]
+
+            if len(values) == 0 or (limits.min <= values.min() and values.max() <= limits.max):
+                self.columns[field][rows] = values
+                self.flags[rows] |= COLUMN_FLAGS[field] | data_flag
+                return
+
+            fits = (values >= limits.min) & (values <= limits.max)
+            self.set_values(field, rows[fits], values[fits])
+            self.set_values(field, rows[~fits], values[~fits].astype(object))
+
+        else:
+            # Values that don't fit a column go into the side table
+            for row, value in zip(rows.tolist(), values.tolist()):
+                if field in COLUMN_FLAGS and fits_column(field, value):
+                    self.columns[field][row] = value
+                    self.flags[row] |= COLUMN_FLAGS[field] | data_flag
+                    continue
+
+                if field in COLUMN_FLAGS:
+                    self.flags[row] &= ~numpy.uint32(COLUMN_FLAGS[field])
+
+                self.flags[row] |= data_flag
+                self.set_extra(row, field, value)
+
+    def get_event(self, row, columns=None):
+        if columns is None:
+            columns = {field: self.columns[field][row:row+1].tolist() for field in self.columns}
+            row_flags = int(self.flags[row])
+            event = int(self.event[row])
+            note = int(self.note[row])
+            timestamp = self.timestamp[row].item()
+            i = 0
+        else:
+            row_flags, event, note, timestamp = columns['flags'][row], columns['event'][row], columns['note'][row], columns['timestamp'][row]
+            i = row
+
+        entry = {}
+        if event != NO_NAME:
+            entry['name'] = self.event_names[event]
+
+        if row_flags & FLAG_HAS_TIMESTAMP:
+            entry['timestamp'] = timestamp if row_flags & FLAG_FLOAT_TIMESTAMP else int(timestamp)
+
+        for field, _ in EVENT_COLUMNS:
+            if row_flags & COLUMN_FLAGS[field]:
+                entry[field] = columns[field][i]
+
+        entry_extra, data_extra = self.extras.get(row, ({}, {}))
+
+        if row_flags & FLAG_HAS_DATA:
+            data = {}
+
+            if row_flags & FLAG_HAS_NOTE:
+                data['note'] = self.note_names[note]
+
+            if row_flags & FLAG_HAS_BONUS_NOTE:
+                bonus_note = 1 if row_flags & FLAG_BONUS_NOTE else 0
+                data['bonus_note'] = bool(bonus_note) if row_flags & FLAG_BONUS_NOTE_BOOL else bonus_note
+
+            for field, _ in DATA_COLUMNS:
+                if row_flags & COLUMN_FLAGS[field]:
+                    data[field] = columns[field][i]
+
+            data.update(copy.deepcopy(data_extra))
+            entry['data'] = data
+
+        entry.update(copy.deepcopy(entry_extra))
+
+        return entry
+
+    def get_events(self, rows=None):
+        """Returns the event dicts of the given rows"""
+        columns = {field: self.columns[field].tolist() for field in self.columns}
+        columns['flags'] = self.flags.tolist()
+        columns['event'] = self.event.tolist()
+        columns['note'] = self.note.tolist()
+        columns['timestamp'] = self.timestamp.tolist()
+
+        return [self.get_event(row, columns) for row in self.get_rows(rows).tolist()]
+
+    def iter_timestamps(self, raw_keys=False):
+        """Yields (timestamp key, events) in ascending timestamp order"""
+        events = self.get_events()
+        groups = self.get_timestamp_groups().tolist()
+
+        for start, end in zip(groups, groups[1:]):
+            yield self.get_timestamp_key(start, raw_keys), events[start:end]
+
+    def get_timestamp_key(self, row, raw_keys=False):
+        return get_timestamp_key(self.timestamp[row].item(), int(self.flags[row]), raw_keys)
+
+    def get_timestamp_keys(self, rows=None, raw_keys=False):
+        rows = self.get_rows(rows)
+        return [get_timestamp_key(x, flags, raw_keys) for x, flags in zip(self.timestamp[rows].tolist(), self.flags[rows].tolist())]
+
+    def to_dict(self, raw_keys=False):
+        # By default the output matches what json.loads would give for the original chart
+        chart = copy.deepcopy(self.info)
+        chart['timestamp'] = {}
+
+        for timestamp_key, events in self.iter_timestamps(raw_keys):
+            chart['timestamp'][timestamp_key] = events
+
+        return chart
+
+
+def get_charts(json_data):
+    """Returns the document's charts as ChartData, charts read from output.json are converted here"""
+    return [x if isinstance(x, ChartData) else ChartData.from_dict(x) for x in json_data['charts']]
+
+
+def encode_chart(obj):
+    if isinstance(obj, ChartData):
+        # Keep the numeric timestamp keys so sort_keys orders them the same way as before
+        return obj.to_dict(raw_keys=True)
+
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
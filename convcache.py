@@ -0,0 +1,247 @@
+# Content addressed cache for conversion outputs.
+# Entries are keyed by a hash of the input files and the conversion options
+# and hold a copy of every file the conversion created or modified.
+import hashlib
+import json
+import os
+import shutil
+import struct
+
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# Files written by earlier conversions into the same roots, see get_output_filenames
+OUTPUTS_FOLDERNAME = "outputs"
+
+
+def get_normalized_path(filename):
+    return os.path.normcase(os.path.abspath(filename))
+
+
+def get_input_filenames(input_filenames, exclude=()):
+    # Folders are expanded, each file is paired with the name used for hashing.
+    # Files in exclude are skipped when walking a folder, a file given directly is always hashed.
+    filenames = []
+
+    for input_filename in input_filenames:
+        if not input_filename or not os.path.exists(input_filename):
+            continue
+
+        if not os.path.isdir(input_filename):
+            filenames.append((os.path.basename(input_filename), input_filename))
+            continue
+
+        folder_filenames = []
+        for root, _, files in os.walk(input_filename):
+            for filename in files:
+                filename = os.path.join(root, filename)
+
+                if get_normalized_path(filename) in exclude:
+                    continue
+
+                folder_filenames.append((os.path.relpath(filename, input_filename).replace("\\", "/"), filename))
+
+        filenames += sorted(folder_filenames)
+
+    return filenames
+
+
+def get_cache_key(input_filenames, options, exclude=()):
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([CACHE_VERSION, options], sort_keys=True).encode('utf-8'))
+
+    for name, filename in get_input_filenames(input_filenames, exclude):
+        name = name.encode('utf-8')
+        hasher.update(struct.pack("<IQ", len(name), os.path.getsize(filename)))
+        hasher.update(name)
+
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(0x100000), b""):
+                hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def get_snapshot(roots, names=None):
+    # names limits the snapshot to those files of the roots instead of walking them
+    snapshot = {}
+
+    for idx, root in enumerate(roots):
+        if not os.path.isdir(root):
+            continue
+
+        if names is not None:
+            for name in names:
+                filename = os.path.join(root, name)
+
+                if os.path.isfile(filename):
+                    stat = os.stat(filename)
+                    snapshot[(idx, name)] = (stat.st_mtime_ns, stat.st_size)
+
+            continue
+
+        for folder, _, files in os.walk(root):
+            for filename in files:
+                filename = os.path.join(folder, filename)
+                stat = os.stat(filename)
+                snapshot[(idx, os.path.relpath(filename, root))] = (stat.st_mtime_ns, stat.st_size)
+
+    return snapshot
+
+
+def get_changed_files(snapshot, roots, names=None):
+    after = get_snapshot(roots, names)
+    return sorted(k for k in after if snapshot.get(k) != after[k])
+
+
+def restore(cache_folder, key, roots):
+    entry_folder = os.path.join(cache_folder, key)
+    manifest_filename = os.path.join(entry_folder, "manifest.json")
+
+    try:
+        with open(manifest_filename, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if manifest['roots'] != len(roots):
+        return False
+
+    restored_filenames = []
+
+    try:
+        for idx, filename in manifest['files']:
+            output_filename = os.path.join(roots[idx], filename)
+            output_foldername = os.path.dirname(output_filename)
+
+            if output_foldername and not os.path.exists(output_foldername):
+                os.makedirs(output_foldername)
+
+            restored_filenames.append(output_filename)
+            shutil.copy2(os.path.join(entry_folder, str(idx), filename), output_filename)
+
+        # The manifest's mtime is used as the last access time for eviction
+        os.utime(manifest_filename, None)
+    except OSError:
+        # The entry was evicted by another process while copying, treat it as a miss
+        for filename in restored_filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        return False
+
+    add_output_filenames(cache_folder, key, roots, manifest['files'])
+
+    return True
+
+
+def store(cache_folder, key, roots, files, max_size=DEFAULT_MAX_SIZE):
+    if not files:
+        return
+
+    add_output_filenames(cache_folder, key, roots, files)
+
+    entry_folder = os.path.join(cache_folder, key)
+    if os.path.exists(entry_folder):
+        return
+
+    # Build the entry next to its final location and move it in place once complete
+    temp_folder = "%s.%d.tmp" % (entry_folder, os.getpid())
+    size = 0
+
+    try:
+        for idx, filename in files:
+            cache_filename = os.path.join(temp_folder, str(idx), filename)
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            shutil.copy2(os.path.join(roots[idx], filename), cache_filename)
+            size += os.path.getsize(cache_filename)
+
+        with open(os.path.join(temp_folder, "manifest.json"), "w") as f:
+            json.dump({
+                'roots': len(roots),
+                'files': files,
+                'size': size,
+            }, f)
+
+        os.rename(temp_folder, entry_folder)
+    except OSError:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        return
+
+    evict(cache_folder, max_size)
+
+
+def get_outputs_folder(cache_folder, roots):
+    roots = json.dumps([get_normalized_path(root) for root in roots])
+    return os.path.join(cache_folder, OUTPUTS_FOLDERNAME, hashlib.sha256(roots.encode('utf-8')).hexdigest())
+
+
+def get_output_filenames(cache_folder, roots):
+    # Conversions can write next to their inputs (a sound folder that's also the output folder).
+    # What earlier conversions wrote into the same roots is left out of the input hashes
+    # so the next run into those roots still gets the same key.
+    outputs = set()
+    outputs_folder = get_outputs_folder(cache_folder, roots)
+
+    if not os.path.isdir(outputs_folder):
+        return outputs
+
+    for filename in os.listdir(outputs_folder):
+        if not filename.endswith(".json"):
+            continue
+
+        try:
+            with open(os.path.join(outputs_folder, filename), "r") as f:
+                outputs.update(json.load(f))
+        except (OSError, ValueError):
+            continue
+
+    return outputs
+
+
+def add_output_filenames(cache_folder, key, roots, files):
+    # Every entry gets its own file per roots so concurrent conversions never overwrite each other's
+    outputs_folder = get_outputs_folder(cache_folder, roots)
+    outputs_filename = os.path.join(outputs_folder, key + ".json")
+
+    if os.path.exists(outputs_filename):
+        return
+
+    temp_filename = "%s.%d.tmp" % (outputs_filename, os.getpid())
+
+    try:
+        os.makedirs(outputs_folder, exist_ok=True)
+
+        with open(temp_filename, "w") as f:
+            json.dump(sorted(get_normalized_path(os.path.join(roots[idx], filename)) for idx, filename in files), f)
+
+        os.replace(temp_filename, outputs_filename)
+    except OSError:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def evict(cache_folder, max_size):
+    # Remove the least recently used entries until the cache fits in max_size bytes
+    entries = []
+    total_size = 0
+
+    for key in os.listdir(cache_folder):
+        manifest_filename = os.path.join(cache_folder, key, "manifest.json")
+
+        try:
+            with open(manifest_filename, "r") as f:
+                size = json.load(f)['size']
+
+            entries.append((os.path.getmtime(manifest_filename), size, key))
+        except (OSError, ValueError, KeyError):
+            continue
+
+        total_size += size
+
+    for _, size, key in sorted(entries):
+        if total_size <= max_size:
+            break
+
+        shutil.rmtree(os.path.join(cache_folder, key), ignore_errors=True)
+        total_size -= size
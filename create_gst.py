@@ -3,6 +3,7 @@ import glob
 import os
 import pydub
 
+import helper
 import ifs
 import mdb
 import tmpfile
@@ -102,6 +103,8 @@ if args.mix_phase:
 wavbintool.parse_bin(drum_bgm, drum_bgm_out)
 wavbintool.parse_bin(guitar_bgm, guitar_bgm_out)
 
+helper.ensure_ffmpeg()
+
 if args.mix_phase:
     base_audio = pydub.AudioSegment.from_file(base_bgm_out).invert_phase()
 
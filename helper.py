@@ -1,7 +1,11 @@
-import pykakasi
-import imageio
 import os
 import shutil
+import threading
+
+# pykakasi and imageio are slow to import, they're only loaded the first time they're needed
+kakasi_converter = None
+ffmpeg_ready = False
+ffmpeg_lock = threading.Lock()
 
 
 def getCaseInsensitivePath(path):
@@ -51,22 +55,35 @@ def getCaseInsensitivePath(path):
         return path # cant find the right one, just return the path as is.
 
 
+def get_kakasi_converter():
+    global kakasi_converter
+
+    if kakasi_converter is None:
+        import pykakasi
+
+        kakasi = pykakasi.kakasi()
+        kakasi.setMode("H","a")
+        kakasi.setMode("K","a")
+        kakasi.setMode("J","a")
+        kakasi.setMode("C", True)
+        kakasi_converter = kakasi.getConverter()
+
+    return kakasi_converter
+
+
 def romanize(text):
     if all(ord(c) < 128 for c in text):
         return text
 
-    kakasi = pykakasi.kakasi()
-    kakasi.setMode("H","a")
-    kakasi.setMode("K","a")
-    kakasi.setMode("J","a")
-    kakasi.setMode("C", True)
-    conv = kakasi.getConverter()
+    conv = get_kakasi_converter()
     new_text = conv.do(text)
     return new_text.upper() if text != new_text else text
 
 
 
 def check_ffmpeg():
+    import imageio
+
     try:
         if not os.path.exists("ffmpeg.exe"):
             exe_path = imageio.plugins.ffmpeg.get_exe()
@@ -85,3 +102,18 @@ def check_ffmpeg():
 
             if os.path.exists(path):
                 shutil.copy(path, "ffmpeg" + ext)
+
+
+def ensure_ffmpeg():
+    # Fetches ffmpeg for pydub the first time audio has to go through it
+    global ffmpeg_ready
+
+    if ffmpeg_ready:
+        return
+
+    with ffmpeg_lock:
+        if not ffmpeg_ready:
+            import imageio
+            imageio.plugins.ffmpeg.download()
+            check_ffmpeg()
+            ffmpeg_ready = True
@@ -9,9 +9,11 @@ try:
 except:
     import tmpfile
 
-from ifstools.ifs import IFS
+# ifstools takes a while to import so it's only loaded once an IFS is actually used
 
 def extract(filename, path=None, progress=False):
+    from ifstools.ifs import IFS
+
     if not path:
         path = tmpfile.mkdtemp(prefix="ifs")
 
@@ -22,6 +24,8 @@ def extract(filename, path=None, progress=False):
     return glob.glob(os.path.join(path, "*")), path
 
 def create(foldername, output_filename, progress=False):
+    from ifstools.ifs import IFS
+
     ifs = IFS(foldername)
     ifs.repack(progress=progress, path=output_filename, use_cache=True)
 
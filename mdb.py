@@ -1,11 +1,116 @@
+import copy
 import csv
+import json
 import os
 from lxml import objectify
 
-def get_song_info_from_mdb(input_filename, music_id):
+# Parsed databases are kept in memory and in a cache file next to the source,
+# both keyed by the source file's mtime and size
+MDB_CACHE_VERSION = 1
+MDB_CACHE_EXT = ".cache.json"
+
+song_info_indexes = {}
+
+
+def get_file_signature(input_filename):
+    stat = os.stat(input_filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_cached_index(cache_filename, signature):
+    try:
+        with open(cache_filename, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cache.get('version') != MDB_CACHE_VERSION or cache.get('signature') != signature:
+        return None
+
+    return {int(k): v for k, v in cache['songs'].items()}
+
+
+def save_cached_index(cache_filename, signature, index):
+    cache = {
+        'version': MDB_CACHE_VERSION,
+        'signature': signature,
+        'songs': index,
+    }
+
+    # Write to a temporary file first so concurrent conversions never see a partial cache
+    temp_filename = "%s.%d.tmp" % (cache_filename, os.getpid())
+
+    try:
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+
+        os.replace(temp_filename, cache_filename)
+    except OSError:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def get_song_info_index(input_filename, parser):
     if not os.path.exists(input_filename):
         return None
 
+    signature = get_file_signature(input_filename)
+    key = (os.path.abspath(input_filename), parser.__name__)
+
+    if key in song_info_indexes and song_info_indexes[key][0] == signature:
+        return song_info_indexes[key][1]
+
+    cache_filename = input_filename + MDB_CACHE_EXT
+    index = load_cached_index(cache_filename, signature)
+
+    if index is None:
+        index = parser(input_filename)
+
+        if index is None:
+            return None
+
+        save_cached_index(cache_filename, signature, index)
+
+    song_info_indexes[key] = (signature, index)
+
+    return index
+
+
+def parse_mdb_entry(data, music_id):
+    song_info = {
+        'music_id': music_id
+    }
+
+    if hasattr(data, 'title_name'):
+        song_info['title'] = data.title_name.text or ""
+
+    if hasattr(data, 'artist_title'):
+        song_info['artist'] = data.artist_title.text or ""
+    elif hasattr(data, 'artist_title_ascii'):
+        song_info['artist'] = data.artist_title_ascii.text or ""
+
+    if hasattr(data, 'xg_diff_list'):
+        # The original ordering is guitar, drum, bass, but I want them to be in drum, guitar, bass order
+        difficulties = data.xg_diff_list.text.split(' ')
+        difficulties = difficulties[5:10] + difficulties[0:5] + difficulties[10:]
+        song_info['difficulty'] = [int(x) for x in difficulties]
+
+    if hasattr(data, 'classics_diff_list'):
+        # The original ordering is guitar, bass, open, drum but I want them to be in drum, guitar, bass, open order
+        difficulties = data.classics_diff_list.text.split(' ')
+        difficulties = difficulties[-4:] + difficulties[:-4]
+        song_info['classics_difficulty'] = [int(x) for x in difficulties]
+
+    if hasattr(data, 'bpm'):
+        song_info['bpm'] = int(data.bpm.text)
+
+    if hasattr(data, 'bpm2'):
+        song_info['bpm2'] = int(data.bpm2.text)
+
+    return song_info
+
+
+def parse_song_info_from_mdb(input_filename):
     try:
         with open(input_filename, "r", encoding="utf-8") as f:
             root = objectify.fromstring(f.read())
@@ -15,54 +120,38 @@ def get_song_info_from_mdb(input_filename, music_id):
     except:
         return None
 
+    index = {}
     for data in root.mdb_data:
-        if int(data.music_id) == music_id:
-            song_info = {
-                'music_id': music_id
-            }
-
-            if hasattr(data, 'title_name'):
-                song_info['title'] = data.title_name.text or ""
-
-            if hasattr(data, 'artist_title'):
-                song_info['artist'] = data.artist_title.text or ""
-            elif hasattr(data, 'artist_title_ascii'):
-                song_info['artist'] = data.artist_title_ascii.text or ""
+        try:
+            music_id = int(data.music_id)
+        except (AttributeError, TypeError, ValueError):
+            continue
 
-            if hasattr(data, 'xg_diff_list'):
-                # The original ordering is guitar, drum, bass, but I want them to be in drum, guitar, bass order
-                difficulties = data.xg_diff_list.text.split(' ')
-                difficulties = difficulties[5:10] + difficulties[0:5] + difficulties[10:]
-                song_info['difficulty'] = [int(x) for x in difficulties]
+        if music_id in index:
+            continue
 
-            if hasattr(data, 'classics_diff_list'):
-                # The original ordering is guitar, bass, open, drum but I want them to be in drum, guitar, bass, open order
-                difficulties = data.classics_diff_list.text.split(' ')
-                difficulties = difficulties[-4:] + difficulties[:-4]
-                song_info['classics_difficulty'] = [int(x) for x in difficulties]
+        # A malformed entry only makes its own song unavailable instead of the whole database
+        try:
+            index[music_id] = parse_mdb_entry(data, music_id)
+        except (AttributeError, TypeError, ValueError):
+            print("Skipping malformed music database entry for music ID %d" % music_id)
 
-            if hasattr(data, 'bpm'):
-                song_info['bpm'] = int(data.bpm.text)
+    return index
 
-            if hasattr(data, 'bpm2'):
-                song_info['bpm2'] = int(data.bpm2.text)
 
-            return song_info
+def parse_song_info_from_csv(input_filename):
+    index = {}
+    song_info_vers = {}
 
-    return None
-
-def get_song_info_from_csv(input_filename, music_id):
-    if not os.path.exists(input_filename):
-        return None
+    with open(input_filename, 'r', encoding="utf-8") as f:
+        reader = csv.DictReader(f)
 
-    reader = csv.DictReader(open(input_filename, 'r', encoding="utf-8"))
+        for data in reader:
+            music_id = int(data['music_id'])
 
-    song_info_ver = 0
-    song_info = None
-    for data in reader:
-        if int(data['music_id']) == music_id:
-            if int(data['game_version']) > song_info_ver and int(data['game_version']) < 1000:
-                song_info_ver = int(data['game_version'])
+            # Keep the entry from the newest game version
+            if int(data['game_version']) > song_info_vers.get(music_id, 0) and int(data['game_version']) < 1000:
+                song_info_vers[music_id] = int(data['game_version'])
 
                 song_info = {
                     'music_id': music_id
@@ -72,4 +161,23 @@ def get_song_info_from_csv(input_filename, music_id):
                 song_info['artist'] = data['artist_title']
                 song_info['difficulty'] = [data[k] for k in ["diff_dm_easy","diff_dm_bsc","diff_dm_adv","diff_dm_ext","diff_dm_mst","diff_gf_easy","diff_gf_bsc","diff_gf_adv","diff_gf_ext","diff_gf_mst","diff_gf_b_easy","diff_gf_b_bsc","diff_gf_b_adv","diff_gf_b_ext","diff_gf_b_mst"]]
 
-    return song_info
+                index[music_id] = song_info
+
+    return index
+
+
+def get_song_info(input_filename, music_id, parser):
+    index = get_song_info_index(input_filename, parser)
+
+    if not index or music_id not in index:
+        return None
+
+    return copy.deepcopy(index[music_id])
+
+
+def get_song_info_from_mdb(input_filename, music_id):
+    return get_song_info(input_filename, music_id, parse_song_info_from_mdb)
+
+
+def get_song_info_from_csv(input_filename, music_id):
+    return get_song_info(input_filename, music_id, parse_song_info_from_csv)
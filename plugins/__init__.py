@@ -1,4 +1,44 @@
 from os.path import dirname, basename, isfile
 import glob
+import importlib
 modules = glob.glob(dirname(__file__)+"/*.py")
-__all__ = [ basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
\ No newline at end of file
+__all__ = [ basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
+
+# Format name, plugin module and the (offset, bytes) pairs a header must match for the format to be detected.
+# This lets a format be picked without importing every plugin, it's the only place the headers are checked.
+FORMATS = [
+    ("SQ3", "sq3", [(0x00, b"SEQP"), (0x30, b"SQ3T"), (0x36, b"\x03")]),
+    ("SQ2", "sq2", [(0x00, b"SEQP"), (0x30, b"SEQT"), (0x36, b"\x02")]),
+    ("Dsq2", "dsq2", [(0x00, b"DSQ1")]),
+    ("Gsq2", "gsq2", [(0x00, b"GSQ1")]),
+    ("Dsq1", "dsq1", None),
+    ("Gsq1", "gsq1", None),
+    ("DTX", "dtx", None),
+    ("JSON", "json", None),
+    ("WAV", "wav", None),
+]
+
+HEADER_SIZE = 0x40
+
+
+def get_module_by_format_name(format_name):
+    for name, module, _ in FORMATS:
+        if name.lower() == format_name.lower():
+            return module
+
+    return None
+
+
+def get_module_by_header(filename):
+    # The header is read once and checked against every format
+    header = open(filename, "rb").read(HEADER_SIZE)
+
+    for _, module, magics in FORMATS:
+        if magics and all(header[offset:offset+len(magic)] == magic for offset, magic in magics):
+            return module
+
+    return None
+
+
+def load_handler(module):
+    return importlib.import_module('plugins.' + module).get_class()
@@ -513,7 +513,7 @@ def generate_json_from_dsq1(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Dsq1Format:
@@ -529,10 +529,6 @@ class Dsq1Format:
     def to_chart(params):
         super()
 
-    @staticmethod
-    def is_format(filename):
-        return False
-
 
 def get_class():
     return Dsq1Format
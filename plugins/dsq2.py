@@ -529,7 +529,7 @@ def generate_json_from_dsq2(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Dsq2Format:
@@ -545,19 +545,6 @@ class Dsq2Format:
     def to_chart(params):
         super()
 
-    @staticmethod
-    def is_format(filename):
-        header = open(filename, "rb").read(0x40)
-
-        try:
-            is_dsq = header[0x00:0x04].decode('ascii') == "DSQ1"
-            if is_dsq:
-                return True
-        except:
-            return False
-
-        return False
-
 
 def get_class():
     return Dsq2Format
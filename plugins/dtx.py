@@ -42,15 +42,21 @@
 # BLACKCOLORKEY
 
 
+import bisect
+import concurrent.futures
 import copy
 from fractions import Fraction
+import itertools
 import json
 import math
+import numpy
 from numpy import base_repr
 import os
 import re
 
 import audio
+import chartdata
+import vas3tool
 
 dtx_bonus_mapping = {
     "leftcymbal": 0x01,
@@ -238,49 +244,64 @@ class Fraction2:
 #   DTX reading code   #
 ########################
 
-def get_value_from_dtx(target_tag, lines, default=None):
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+DTX_COMMAND_REGEX = re.compile(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)")
+DTX_CHANNEL_REGEX = re.compile("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})")
 
-        if not matches:
-            continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+class DtxCommands:
+    """All of the commands in a DTX file, read in a single pass.
 
-        if tag.startswith(target_tag):
-            return value
+    Header commands are kept as (tag, value) and channel commands as
+    (measure, event, value), both in file order.
+    """
 
-    return default
+    def __init__(self, lines):
+        self.headers = []
+        self.channels = []
 
+        for line in lines:
+            matches = DTX_COMMAND_REGEX.match(line)
 
-def get_bpms_from_dtx(lines):
-    bpms = {}
-    base_bpm = 0
+            if not matches:
+                continue
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+            tag = matches.group('tag').upper()
+            value = matches.group('value')
 
-        if not matches:
-            continue
+            if tag[0].isdigit():
+                matches2 = DTX_CHANNEL_REGEX.match(tag)
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
+                if not matches2:
+                    print("Invalid channel command: %s" % line)
+                    continue
 
-        if tag.startswith("BPM"):
-            matches2 = re.match("BPM(?P<id>[0-9A-Z]{2})?", tag)
+                self.channels.append((int(matches2.group('measure')), int(matches2.group('event'), 16), value))
 
-            if not matches2:
-                pass
+            else:
+                self.headers.append((tag, value))
 
-            bpm_id = matches2.group('id')
 
-            if bpm_id:
-                bpm_id = int(bpm_id, 36)
-            else:
-                bpm_id = 0
+def get_dtx_tag_id(tag, prefix):
+    # Tags are made up of [0-9A-Z] after being uppercased so only the length has to be checked
+    tag_id = tag[len(prefix):len(prefix)+2]
+    return int(tag_id, 36) if len(tag_id) == 2 else 0
 
-            bpms[bpm_id] = float(value)
+
+def get_value_from_dtx(target_tag, dtx, default=None):
+    for tag, value in dtx.headers:
+        if tag.startswith(target_tag):
+            return value
+
+    return default
+
+
+def get_bpms_from_dtx(dtx):
+    bpms = {}
+    base_bpm = 0
+
+    for tag, value in dtx.headers:
+        if tag.startswith("BPM"):
+            bpms[get_dtx_tag_id(tag, "BPM")] = float(value)
 
         elif tag.startswith("BASEBPM"):
             base_bpm = float(value)
@@ -288,38 +309,18 @@ def get_bpms_from_dtx(lines):
     return bpms, base_bpm
 
 
-def get_wavs_from_dtx(lines, target_parts, sound_metadata, get_wav_length=True):
+def get_wavs_from_dtx(dtx, target_parts, sound_metadata, get_wav_length=True):
     wav_filenames = {}
     wav_lengths = {}
 
-    for line in lines:
-        if ';' in line:
-            line = line[:line.index(';')].strip()
-
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
+    for tag, value in dtx.headers:
         if tag.startswith("WAV") and not tag.startswith("WAVPAN") and not tag.startswith("WAVVOL"):
             # Handle WAV tags
             # This can be exported for use by va3 creator
+            if ';' in value:
+                value = value[:value.index(';')].strip()
 
-            matches2 = re.match("WAV(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
-
-            wav_id = matches2.group('id')
-
-            if wav_id:
-                wav_id = int(wav_id, 36)
-            else:
-                wav_id = 0
-
+            wav_id = get_dtx_tag_id(tag, "WAV")
             wav_filenames[wav_id] = os.sep.join(value.split('\\'))
 
             if get_wav_length and ('guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts):
@@ -331,175 +332,94 @@ def get_wavs_from_dtx(lines, target_parts, sound_metadata, get_wav_length=True):
     return wav_filenames, wav_lengths
 
 
-def get_wav_volumes_from_dtx(lines):
+def get_wav_volumes_from_dtx(dtx):
     wav_volumes = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
+    for tag, value in dtx.headers:
+        # Handle VOLUME tags
+        # This can be exported for use by va3 creator
         if tag.startswith("VOLUME"):
-            valid_tag = "VOLUME"
-        elif tag.startswith("WAVVOL"):
-            valid_tag = "WAVVOL"
-        else:
-            valid_tag = None
-
-        if valid_tag:
-            # Handle VOLUME tags
-            # This can be exported for use by va3 creator
-
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
-
-            vol_id = matches2.group('id')
+            wav_volumes[get_dtx_tag_id(tag, "VOLUME")] = int(value)
 
-            if vol_id:
-                vol_id = int(vol_id, 36)
-            else:
-                vol_id = 0
-
-            wav_volumes[vol_id] = int(value)
+        elif tag.startswith("WAVVOL"):
+            wav_volumes[get_dtx_tag_id(tag, "WAVVOL")] = int(value)
 
     return wav_volumes
 
 
-def get_wav_pans_from_dtx(lines):
+def get_wav_pans_from_dtx(dtx):
     wav_pans = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
+    for tag, value in dtx.headers:
+        # Handle PAN tags
+        # This can be exported for use by va3 creator
         if tag.startswith("PAN"):
-            valid_tag = "PAN"
-        elif tag.startswith("WAVPAN"):
-            valid_tag = "WAVPAN"
-        else:
-            valid_tag = None
+            wav_pans[get_dtx_tag_id(tag, "PAN")] = int(value)
 
-
-        if valid_tag:
-            # Handle PAN tags
-            # This can be exported for use by va3 creator
-
-            matches2 = re.match(valid_tag + "(?P<id>[0-9A-Z]{2})?", tag)
-
-            if not matches2:
-                pass
-
-            pan_id = matches2.group('id')
-
-            if pan_id:
-                pan_id = int(pan_id, 36)
-            else:
-                pan_id = 0
-
-            wav_pans[pan_id] = int(value)
+        elif tag.startswith("WAVPAN"):
+            wav_pans[get_dtx_tag_id(tag, "WAVPAN")] = int(value)
 
     return wav_pans
 
 
-def get_bonus_notes_from_dtx(lines, start_offset_padding):
+def get_bonus_notes_from_dtx(dtx, start_offset_padding):
     bonus_notes = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
-
-        if not matches:
-            continue
-
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
+    for measure, event, value in dtx.channels:
+        measure += start_offset_padding
 
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
+        if event in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
+            data = [value[i:i+2] for i in range(0, len(value), 2)]
+            for i in range(len(data)):
+                if measure not in bonus_notes:
+                    bonus_notes[measure] = {}
 
-            if event in [0x4c, 0x4d, 0x4e, 0x4f]:  # Bonus notes
-                data = [value[i:i+2] for i in range(0, len(value), 2)]
-                for i in range(len(data)):
-                    if measure not in bonus_notes:
-                        bonus_notes[measure] = {}
+                if i not in bonus_notes[measure]:
+                    bonus_notes[measure][i] = []
 
-                    if i not in bonus_notes[measure]:
-                        bonus_notes[measure][i] = []
-
-                    bonus_notes[measure][i].append(int(data[i], 36))
+                bonus_notes[measure][i].append(int(data[i], 36))
 
     return bonus_notes
 
 
-def get_measure_lengths_from_dtx(lines, start_offset_padding):
+def get_measure_lengths_from_dtx(dtx, start_offset_padding):
     VALID_TIMESIG_DENOMINATORS = [1 << x for x in range(0, 256)]
 
     measure_lengths = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+    for measure, event, value in dtx.channels:
+        measure += start_offset_padding
 
-        if not matches:
+        if event != 0x02:
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
-
-            if not matches2:
-                pass
-
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event != 0x02:
-                continue
-
-            # Measure length event
-            f1 = Fraction(float(value)).limit_denominator()
-            numerator = f1.numerator
-            denominator = f1.denominator
-
-            # How to code this?
-            if denominator == 1:
-                numerator *= 4
-                denominator = 4
-            elif denominator == 2:
-                numerator *= 2
-                denominator = 4
-
-            f2 = Fraction2(numerator, denominator)
-
-            # Add check for impossible time signatures
-            if denominator not in VALID_TIMESIG_DENOMINATORS:
-                print("ERROR: This is an impossible to represent"
-                      "time signature: {}".format(value))
-                print("This came out to be", f2)
-                print("Valid denominators for the time signature"
-                      "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
-                print("Please try simplifying all measures which"
-                      "use the measure length {}".format(value))
-                exit(1)
+        # Measure length event
+        f1 = Fraction(float(value)).limit_denominator()
+        numerator = f1.numerator
+        denominator = f1.denominator
+
+        # How to code this?
+        if denominator == 1:
+            numerator *= 4
+            denominator = 4
+        elif denominator == 2:
+            numerator *= 2
+            denominator = 4
+
+        f2 = Fraction2(numerator, denominator)
+
+        # Add check for impossible time signatures
+        if denominator not in VALID_TIMESIG_DENOMINATORS:
+            print("ERROR: This is an impossible to represent"
+                  "time signature: {}".format(value))
+            print("This came out to be", f2)
+            print("Valid denominators for the time signature"
+                  "must be a power of two...", VALID_TIMESIG_DENOMINATORS[:12])
+            print("Please try simplifying all measures which"
+                  "use the measure length {}".format(value))
+            exit(1)
 
-            measure_lengths[measure] = f2
+        measure_lengths[measure] = f2
 
     if 0 not in measure_lengths:
         measure_lengths[0] = Fraction2(4, 4)  # Default to 4/4
@@ -507,62 +427,47 @@ def get_measure_lengths_from_dtx(lines, start_offset_padding):
     return measure_lengths
 
 
-def get_events_by_measure_from_dtx(lines, start_offset_padding):
+def get_events_by_measure_from_dtx(dtx, start_offset_padding):
     events_by_measure = {}
 
-    for line in lines:
-        matches = re.match(r"#(?P<tag>[A-Za-z0-9]+):?\s*(?P<value>.*)", line)
+    for measure, event, value in dtx.channels:
+        measure += start_offset_padding
 
-        if not matches:
+        if event == 0x02:
             continue
 
-        tag = matches.group('tag').upper()
-        value = matches.group('value')
-
-        if tag[0].isdigit():
-            matches2 = re.match("(?P<measure>[0-9]{3})(?P<event>[0-9A-F]{2})", tag)
+        # Handle specific events
+        if measure not in events_by_measure:
+            events_by_measure[measure] = {}
 
-            if not matches2:
-                pass
-
-            measure = int(matches2.group('measure')) + start_offset_padding
-            event = int(matches2.group('event'), 16)
-
-            if event == 0x02:
-                continue
-
-            # Handle specific events
-            if measure not in events_by_measure:
-                events_by_measure[measure] = {}
-
-            events_by_measure[measure][event] = [value[i:i+2] for i in range(0, len(value), 2)]
+        events_by_measure[measure][event] = [value[i:i+2] for i in range(0, len(value), 2)]
 
     return events_by_measure
 
 
-def pad_events(events_by_measure, measure_lengths):
-    # Pad all measures to appropriate sizes
-    for measure in events_by_measure:
-        for event in events_by_measure[measure]:
-            scale = Fraction(4, 4)
+class DtxChips(dict):
+    """Chips of a single channel in a measure, keyed by tick.
 
-            measure_lengths_keys = sorted(measure_lengths.keys(), key=lambda x: int(x))
-            matched_measures = [x for x in measure_lengths_keys if int(x) <= measure]
+    Empty ("00") chips aren't stored. length is the number of ticks the
+    channel's chips are spread across.
+    """
 
-            if len(matched_measures) > 0:
-                scale = measure_lengths[matched_measures[-1]]
+    def __init__(self, length, chips=()):
+        super().__init__(chips)
+        self.length = length
 
-            event_count = len(events_by_measure[measure][event])
-            beat_division = (1920 / scale.denominator) * scale.numerator
 
-            new_chips = []
-            for i in range(len(events_by_measure[measure][event])):
-                c = events_by_measure[measure][event][i]
+def get_chips_by_measure(events_by_measure, measure_lengths):
+    # Place the chips of every channel at their tick within the measure
+    for measure in events_by_measure:
+        scale = find_last_timesig(measure, measure_lengths) or Fraction(4, 4)
+        beat_division = (1920 / scale.denominator) * scale.numerator
 
-                new_chips.append(c)
-                new_chips += ['00'] * (int(beat_division / len(events_by_measure[measure][event])) - 1)
+        for event in events_by_measure[measure]:
+            chips = events_by_measure[measure][event]
+            step = max(int(beat_division / max(len(chips), 1)), 1)
 
-            events_by_measure[measure][event] = new_chips
+            events_by_measure[measure][event] = DtxChips(len(chips) * step, [(i * step, c) for i, c in enumerate(chips) if c != '00'])
 
     return events_by_measure
 
@@ -572,16 +477,12 @@ def get_bpms_at_measure_beat(events, bpms):
 
     for measure in events:
         if 0x08 in events[measure]:
-            for i in range(len(events[measure][0x08])):
-                if events[measure][0x08][i] != "00":
-                    if measure not in bpms_at_measure_beat:
-                        bpms_at_measure_beat[measure] = {}
-
-                    if i not in bpms_at_measure_beat[measure]:
-                        bpms_at_measure_beat[measure][i] = {}
+            for i in events[measure][0x08]:
+                if measure not in bpms_at_measure_beat:
+                    bpms_at_measure_beat[measure] = {}
 
-                    val = int(events[measure][0x08][i], 36)
-                    bpms_at_measure_beat[measure][i] = bpms[val]
+                val = int(events[measure][0x08][i], 36)
+                bpms_at_measure_beat[measure][i] = bpms[val]
 
     if 0 not in bpms_at_measure_beat:
         bpms_at_measure_beat[0] = {0: bpms[0]}
@@ -595,12 +496,11 @@ def get_guitar_long_notes_at_measure_beat(events):
     for measure in events:
         for long_event in [0x2a, 0x2c]:
             if long_event in events[measure]:
-                for i in range(len(events[measure][long_event])):
-                    if events[measure][long_event][i] != "00":
-                        if measure not in guitar_long_notes_at_measure_beat:
-                            guitar_long_notes_at_measure_beat[measure] = {}
+                for i in events[measure][long_event]:
+                    if measure not in guitar_long_notes_at_measure_beat:
+                        guitar_long_notes_at_measure_beat[measure] = {}
 
-                        guitar_long_notes_at_measure_beat[measure][i] = True
+                    guitar_long_notes_at_measure_beat[measure][i] = True
 
     return guitar_long_notes_at_measure_beat
 
@@ -611,12 +511,11 @@ def get_bass_long_notes_at_measure_beat(events):
     for measure in events:
         for long_event in [0x2b, 0x2d]:
             if long_event in events[measure]:
-                for i in range(len(events[measure][long_event])):
-                    if events[measure][long_event][i] != "00":
-                        if measure not in bass_long_notes_at_measure_beat:
-                            bass_long_notes_at_measure_beat[measure] = {}
+                for i in events[measure][long_event]:
+                    if measure not in bass_long_notes_at_measure_beat:
+                        bass_long_notes_at_measure_beat[measure] = {}
 
-                        bass_long_notes_at_measure_beat[measure][i] = True
+                    bass_long_notes_at_measure_beat[measure][i] = True
 
     return bass_long_notes_at_measure_beat
 
@@ -627,17 +526,16 @@ def get_notes_by_measure_beat(events):
     for measure in events:
         for event in events[measure]:
             if event in guitar_range or event in bass_range:
-                for i in range(len(events[measure][event])):
-                    if events[measure][event][i] != "00":
-                        if measure not in notes_by_measure_beat:
-                            notes_by_measure_beat[measure] = {}
-
-                        if event in guitar_range:
-                            notes_by_measure_beat[measure][i] = 1
-                        elif event in bass_range:
-                            notes_by_measure_beat[measure][i] = 2
-                        else:
-                            notes_by_measure_beat[measure][i] = 0
+                for i in events[measure][event]:
+                    if measure not in notes_by_measure_beat:
+                        notes_by_measure_beat[measure] = {}
+
+                    if event in guitar_range:
+                        notes_by_measure_beat[measure][i] = 1
+                    elif event in bass_range:
+                        notes_by_measure_beat[measure][i] = 2
+                    else:
+                        notes_by_measure_beat[measure][i] = 0
 
     return notes_by_measure_beat
 
@@ -729,138 +627,92 @@ def generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_
     return sound_metadata_map, sound_metadata
 
 
-bpm_cache = {}
-def find_last_bpm(measure, target_beat, bpms_at_measure_beat):
-    global bpm_cache
-
-    last_bpm = 0
-
-    if measure in bpm_cache and target_beat in bpm_cache[measure]:
-        return bpm_cache[measure][target_beat]
-
-    for pk in sorted(bpms_at_measure_beat.keys()):
-        if pk > measure:
-            break
-
-        if pk not in bpms_at_measure_beat:
-            continue
-
-        for subbeat_k in sorted(bpms_at_measure_beat[pk].keys()):
-            is_start = measure == 0 and target_beat == 0
-            if not is_start and pk == measure and subbeat_k > target_beat:
-                break
-
-            last_bpm = bpms_at_measure_beat[pk][subbeat_k]
-
-    if measure not in bpm_cache:
-        bpm_cache[measure] = {}
-
-    bpm_cache[measure][target_beat] = last_bpm
-
-    return last_bpm
-
-def is_mid_bpm(measure, bpms_at_measure_beat):
-    if measure not in bpms_at_measure_beat:
-        return False
+def calculate_timestamp_length(measures, ticks, timesig, bpm):
+    one_measure = (1920 / timesig.denominator) * timesig.numerator
+    beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
+    beat_len = (beat_ts * timesig.numerator) / one_measure
 
-    if len(bpms_at_measure_beat[measure].keys()) > 1:
-        return True
+    return (((measures * one_measure) + ticks) * beat_len) / 300
 
-    for subbeat_k in sorted(bpms_at_measure_beat[measure].keys()):
-        if subbeat_k > 0:
-            return True
 
-    return False
+class TempoMap:
+    """Timestamp lookups for a single chart.
 
+    The start time of each measure is accumulated once, and measures that are
+    looked into or that change BPM partway through get a cumulative time per tick.
+    Times are summed tick by tick in the same order as before so the rounded
+    timestamps don't change.
+    """
 
-timestamp_cache = {}
-timestamp_cache2 = {}
-def calculate_current_timestamp(measure, target_beat, measure_lengths, bpms_at_measure_beat):
-    global bpm_cache
-    global timestamp_cache
-    global timestamp_cache2
+    def __init__(self, measure_lengths, bpms_at_measure_beat):
+        self.measure_lengths = measure_lengths
+        self.timesig_keys = sorted(measure_lengths.keys())
 
-    def _calculate_current_timestamp(measure, target_beat, prev, timesig, bpm):
-        cache_key = "%d_%d_%d_%d_%f" % (
-            measure,
-            target_beat,
-            timesig.numerator,
-            timesig.denominator,
-            bpm
-        )
-
-        if cache_key in timestamp_cache2:
-            return timestamp_cache2[cache_key]
-
-        one_measure = (1920 / timesig.denominator) * timesig.numerator
-        beat_ts = (60 / (bpm * (timesig.denominator / 4))) * 300
-        beat_len = (beat_ts * timesig.numerator) / one_measure
+        self.bpm_keys = sorted([(measure, beat) for measure in bpms_at_measure_beat for beat in bpms_at_measure_beat[measure]])
+        self.bpm_values = [bpms_at_measure_beat[measure][beat] for measure, beat in self.bpm_keys]
+        self.mid_bpm_measures = set([measure for measure, beat in self.bpm_keys if beat > 0 or len(bpms_at_measure_beat[measure]) > 1])
 
-        timestamp = (((measure * one_measure) + target_beat) * beat_len) / 300
-        timestamp_cache2[cache_key] = timestamp
+        self.measure_starts = [0]
+        self.measure_ticks = {}
 
-        return timestamp
+    def get_timesig(self, measure):
+        idx = bisect.bisect_right(self.timesig_keys, measure)
+        return self.measure_lengths[self.timesig_keys[idx - 1]] if idx > 0 else None
 
-    if measure in timestamp_cache and target_beat in timestamp_cache[measure]:
-        return timestamp_cache[measure][target_beat]
-
-    measure_lengths_before_target = {}
-    results = [0]
-    keys = sorted(measure_lengths.keys())
+    def get_bpm(self, measure, beat):
+        if measure == 0 and beat == 0:
+            # The start of the chart uses the last BPM found in the first measure
+            idx = bisect.bisect_right(self.bpm_keys, (0, math.inf))
+        else:
+            idx = bisect.bisect_right(self.bpm_keys, (measure, beat))
 
-    if len(keys) > 0:
-        measure_lengths_before_target[keys[0]] = 0
+        return self.bpm_values[idx - 1] if idx > 0 else 0
 
-    for cur_measure in range(measure + 1):
-        current_timesig = find_last_timesig(cur_measure, measure_lengths)
+    def get_measure_start(self, measure):
+        while len(self.measure_starts) <= measure:
+            cur_measure = len(self.measure_starts) - 1
 
-        if cur_measure == measure or is_mid_bpm(cur_measure, bpms_at_measure_beat):
-            numerator = current_timesig.numerator
-            denominator = current_timesig.denominator
-            beat_division = int(round((1920 // denominator) * numerator))
+            if cur_measure in self.mid_bpm_measures:
+                self.measure_starts.append(float(self.get_measure_ticks(cur_measure)[-1]))
+            else:
+                timesig = self.get_timesig(cur_measure)
+                bpm = self.get_bpm(cur_measure, 0)
+                self.measure_starts.append(self.measure_starts[-1] + calculate_timestamp_length(1, 0, timesig, bpm))
 
-            for cur_beat in range(beat_division):
-                if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                    current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
-                else:
-                    current_bpm = bpm_cache[cur_measure][cur_beat]
+        return self.measure_starts[measure]
 
-                if cur_measure >= measure and cur_beat >= target_beat:
-                    break
+    def get_measure_ticks(self, measure):
+        if measure in self.measure_ticks:
+            return self.measure_ticks[measure]
 
-                cache_key = "0_1_%d_%d_%f" % (
-                    current_timesig.numerator,
-                    current_timesig.denominator,
-                    current_bpm
-                )
+        timesig = self.get_timesig(measure)
+        beat_division = int(round((1920 // timesig.denominator) * timesig.numerator))
 
-                results.append(results[-1] + timestamp_cache2.get(cache_key, _calculate_current_timestamp(0, 1, results[-1], current_timesig, current_bpm)))
-        else:
-            cur_beat = 0
+        lengths = numpy.empty(beat_division + 1, dtype=numpy.float64)
+        lengths[0] = self.get_measure_start(measure)
 
-            if cur_measure not in bpm_cache or cur_beat not in bpm_cache[cur_measure]:
-                current_bpm = find_last_bpm(cur_measure, cur_beat, bpms_at_measure_beat)
+        # Fill in tick lengths one BPM segment at a time
+        start = 0
+        while start < beat_division:
+            if measure == 0 and start == 0:
+                end = 1
             else:
-                current_bpm = bpm_cache[cur_measure][cur_beat]
+                idx = bisect.bisect_right(self.bpm_keys, (measure, start))
+                end = beat_division
+                if idx < len(self.bpm_keys) and self.bpm_keys[idx][0] == measure:
+                    end = min(self.bpm_keys[idx][1], beat_division)
 
-            cache_key = "1_0_%d_%d_%f" % (
-                current_timesig.numerator,
-                current_timesig.denominator,
-                current_bpm
-            )
+            lengths[start + 1:end + 1] = calculate_timestamp_length(0, 1, timesig, self.get_bpm(measure, start))
+            start = end
 
-            if cache_key in timestamp_cache2:
-                results.append(results[-1] + timestamp_cache2[cache_key])
-            else:
-                results.append(results[-1] + _calculate_current_timestamp(1, 0, results[-1], current_timesig, current_bpm))
-
-    if measure not in timestamp_cache:
-        timestamp_cache[measure] = {}
+        # cumsum adds sequentially, so each tick matches a running sum
+        self.measure_ticks[measure] = numpy.cumsum(lengths)
 
-    result = int(round(results[-1] * 300))
-    timestamp_cache[measure][target_beat] = result
+        return self.measure_ticks[measure]
 
-    return result
+    def get_timestamp(self, measure, target_beat):
+        ticks = self.get_measure_ticks(measure)
+        return int(round(float(ticks[min(target_beat, len(ticks) - 1)]) * 300))
 
 
 def find_last_timesig(measure, measure_lengths):
@@ -940,7 +792,8 @@ def add_hold_notes(chart_data, long_note_time_by_measure_beat, long_note_info):
 
 
 def generate_timestamp_set(chart, last_event):
-    chart['timestamp'] = {}
+    timestamps = []
+    events = []
 
     for x in sorted(chart['beats'].keys()):
         # Remove anything past the end point
@@ -949,41 +802,35 @@ def generate_timestamp_set(chart, last_event):
             continue
 
         for x2 in chart['beats'][x]:
-            if x2['timestamp'] not in chart['timestamp']:
-                chart['timestamp'][x2['timestamp']] = []
-
             x2['beat'] = int(x)
 
-            chart['timestamp'][x2['timestamp']].append(x2)
+            timestamps.append(x2['timestamp'])
+            events.append(x2)
 
-    return chart
+    info = {k: chart[k] for k in chart if k != 'beats'}
+    return chartdata.ChartData.from_events(info, timestamps, events)
 
 
 def get_valid_chart(chart):
     # A chart must have at least 1 note (played) to be considered valid
-    if not chart or 'timestamp' not in chart:
+    if chart is None or len(chart) == 0:
         return None
 
-    if len(chart['timestamp']) == 0:
-        return None
-
-    for timestamp in chart['timestamp']:
-        for x in chart['timestamp'][timestamp]:
-            if x['name'] == "note" and x['data']['note'] != "auto":
-                return chart
+    if numpy.any(chart.get_event_mask(["note"]) & ~chart.get_note_mask(["auto"])):
+        return chart
 
     return None
 
 
-def get_chart_datas(chart_data, lines):
-    song_title = get_value_from_dtx("TITLE", lines, default="")
-    artist_name = get_value_from_dtx("ARTIST", lines, default="")
-    drum_difficulty = get_value_from_dtx("DLEVEL", lines, default=0)
-    guitar_difficulty = get_value_from_dtx("GLEVEL", lines, default=0)
-    bass_difficulty = get_value_from_dtx("BLEVEL", lines, default=0)
-    pre_image = get_value_from_dtx("PREIMAGE", lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
-    first_bpm = bpms[sorted(bpms.keys(), key=lambda x:int(x))[0]]
+def get_chart_datas(chart_data, dtx):
+    song_title = get_value_from_dtx("TITLE", dtx, default="")
+    artist_name = get_value_from_dtx("ARTIST", dtx, default="")
+    drum_difficulty = get_value_from_dtx("DLEVEL", dtx, default=0)
+    guitar_difficulty = get_value_from_dtx("GLEVEL", dtx, default=0)
+    bass_difficulty = get_value_from_dtx("BLEVEL", dtx, default=0)
+    pre_image = get_value_from_dtx("PREIMAGE", dtx)
+    bpms, base_bpm = get_bpms_from_dtx(dtx)
+    first_bpm = bpms[min(bpms.keys())]
 
     drum_chart_data = {
         "artist": artist_name,
@@ -991,7 +838,6 @@ def get_chart_datas(chart_data, lines):
         "bpm": first_bpm,
         "level": drum_difficulty,
         "preimage": pre_image,
-        "timestamp": {},
         "header": {
             "beat_division": 1920 // 4,
             "time_division": 300,
@@ -1008,7 +854,6 @@ def get_chart_datas(chart_data, lines):
         "bpm": first_bpm,
         "level": guitar_difficulty,
         "preimage": pre_image,
-        "timestamp": {},
         "header": {
             "beat_division": 1920 // 4,
             "time_division": 300,
@@ -1025,7 +870,6 @@ def get_chart_datas(chart_data, lines):
         "bpm": first_bpm,
         "level": bass_difficulty,
         "preimage": pre_image,
-        "timestamp": {},
         "header": {
             "beat_division": 1920 // 4,
             "time_division": 300,
@@ -1036,54 +880,38 @@ def get_chart_datas(chart_data, lines):
         }
     }
 
-    # Split chart_data based on type
-    for k in chart_data['timestamp']:
-        drum_chart_data['timestamp'][k] = []
-        guitar_chart_data['timestamp'][k] = []
-        bass_chart_data['timestamp'][k] = []
-
-        for entry in chart_data['timestamp'][k]:
-            if entry['name'] != 'note':
-                drum_chart_data['timestamp'][k].append(entry)
-                guitar_chart_data['timestamp'][k].append(entry)
-                bass_chart_data['timestamp'][k].append(entry)
-            else:
-                if entry['data']['note'] == "auto":
-                    drum_chart_data['timestamp'][k].append(entry)
-                    guitar_chart_data['timestamp'][k].append(entry)
-                    bass_chart_data['timestamp'][k].append(entry)
-                elif entry['data']['note'] in drum_mapping:
-                    drum_chart_data['timestamp'][k].append(entry)
-                elif entry['data']['note'] in guitar_mapping:
-                    guitar_chart_data['timestamp'][k].append(entry)
-                elif entry['data']['note'] in bass_mapping:
-                    bass_chart_data['timestamp'][k].append(entry)
-                else:
-                    print("Unknown note, don't know what chart it belongs to")
-                    print(entry)
-                    exit(1)
+    # Split chart_data based on type, everything that isn't a played note goes into every chart
+    is_shared = ~chart_data.get_event_mask(["note"]) | chart_data.get_note_mask(["auto"])
+    is_drum = chart_data.get_note_mask(drum_mapping)
+    is_guitar = chart_data.get_note_mask(guitar_mapping)
+    is_bass = chart_data.get_note_mask(bass_mapping)
+
+    unknown = numpy.flatnonzero(~(is_shared | is_drum | is_guitar | is_bass))
+    if len(unknown) > 0:
+        print("Unknown note, don't know what chart it belongs to")
+        print(chart_data.get_events(unknown[:1])[0])
+        exit(1)
+
+    drum_chart_data = chart_data.select(is_shared | is_drum, drum_chart_data)
+    guitar_chart_data = chart_data.select(is_shared | is_guitar, guitar_chart_data)
+    bass_chart_data = chart_data.select(is_shared | is_bass, bass_chart_data)
 
     return get_valid_chart(drum_chart_data), get_valid_chart(guitar_chart_data), get_valid_chart(bass_chart_data)
 
 
 # TODO: Try to refactor this more later
-def parse_dtx_to_intermediate(filename,
-                              params,
-                              sound_metadata,
-                              target_parts=['drum', 'guitar', 'bass', 'open']):
-    global timestamp_cache
-    global bpm_cache
-    global timestamp_cache2
-
+def read_dtx(filename,
+             params,
+             sound_folder,
+             target_parts=['drum', 'guitar', 'bass', 'open']):
+    # Only touches data local to this file so several files can be read at once.
+    # Sound ids in the chart are placeholders until merge_dtx_sound_metadata is called.
     start_offset_padding = params.get('dtx_pad_start', 0)
 
-    timestamp_cache = {}
-    bpm_cache = {}
-    timestamp_cache2 = {}
     bpms_at_measure_beat = {}
 
     if not filename or not os.path.exists(filename):
-        return None, None, None, None, sound_metadata
+        return None
 
     try:
         with open(filename, "r", encoding="shift-jis") as f:
@@ -1097,18 +925,19 @@ def parse_dtx_to_intermediate(filename,
                 lines = [x.strip() for x in f if x.strip().startswith("#")]
 
     # Parse all commands
+    dtx = DtxCommands(lines)
     bgm_info = []
     default_notes = {}
 
-    preview_filename = get_value_from_dtx("PREVIEW", lines)
-    wav_filenames, wav_lengths = get_wavs_from_dtx(lines, target_parts, sound_metadata, not params.get('no_sounds', False))
-    wav_volumes = get_wav_volumes_from_dtx(lines)
-    wav_pans = get_wav_pans_from_dtx(lines)
-    bpms, base_bpm = get_bpms_from_dtx(lines)
+    preview_filename = get_value_from_dtx("PREVIEW", dtx)
+    wav_filenames, wav_lengths = get_wavs_from_dtx(dtx, target_parts, {'sound_folder': sound_folder}, not params.get('no_sounds', False))
+    wav_volumes = get_wav_volumes_from_dtx(dtx)
+    wav_pans = get_wav_pans_from_dtx(dtx)
+    bpms, base_bpm = get_bpms_from_dtx(dtx)
 
-    bonus_notes = get_bonus_notes_from_dtx(lines, start_offset_padding)
-    measure_lengths = get_measure_lengths_from_dtx(lines, start_offset_padding)
-    events_by_measure = get_events_by_measure_from_dtx(lines, start_offset_padding)
+    bonus_notes = get_bonus_notes_from_dtx(dtx, start_offset_padding)
+    measure_lengths = get_measure_lengths_from_dtx(dtx, start_offset_padding)
+    events_by_measure = get_events_by_measure_from_dtx(dtx, start_offset_padding)
 
     # Build data for sound metadata file
     # This must be correct to get the right sound id for the note commands
@@ -1116,12 +945,13 @@ def parse_dtx_to_intermediate(filename,
     # but volume data is possible.
     # As a result, all volume flags will be stored in the chart data
     # but the panning will be in the sound metadata.
-    sound_metadata_map, sound_metadata = generate_sound_metadata_map(sound_metadata, wav_filenames, wav_volumes, wav_pans, is_drums='drum' in target_parts)
+    sound_metadata_map = {wav_id: wav_id + 1 for wav_id in wav_filenames}
     sound_metadata_guitar = []
     sound_metadata_drum = []
 
-    events_by_measure = pad_events(events_by_measure, measure_lengths)
+    events_by_measure = get_chips_by_measure(events_by_measure, measure_lengths)
     bpms_at_measure_beat = get_bpms_at_measure_beat(events_by_measure, bpms)
+    tempo_map = TempoMap(measure_lengths, bpms_at_measure_beat)
 
     guitar_long_notes_at_measure_beat = get_guitar_long_notes_at_measure_beat(events_by_measure)
     guitar_long_note_time_by_measure_beat = \
@@ -1156,7 +986,7 @@ def parse_dtx_to_intermediate(filename,
     }
 
     # Add start events
-    timestamp_cur = calculate_current_timestamp(0, 0, measure_lengths, bpms_at_measure_beat)
+    timestamp_cur = tempo_map.get_timestamp(0, 0)
     chart_data['beats'][0] = []
     chart_data['beats'][0].append({
         "name": "startpos",
@@ -1181,7 +1011,7 @@ def parse_dtx_to_intermediate(filename,
         'timestamp': timestamp_cur,
     })
 
-    last_seen_bpm = bpms[sorted(bpms.keys(), key=lambda x:int(x))[0]]
+    last_seen_bpm = bpms[min(bpms.keys())]
     metadata_chart_data['beats'][0].append({
         "data": {
             "bpm": last_seen_bpm
@@ -1195,7 +1025,7 @@ def parse_dtx_to_intermediate(filename,
     last_event = (0, 0, 0)
     current_time_signature = Fraction(4, 4)
     keys = list(events_by_measure.keys()) + list(measure_lengths.keys())
-    measure_list = sorted(list(set(keys)), key=lambda x: int(x))
+    measure_list = sorted(set(keys))
     for measure in range(measure_list[-1] + 1):
         time_signature = find_last_timesig(measure, measure_lengths)
         same_numerator = time_signature.numerator == current_time_signature.numerator
@@ -1218,7 +1048,7 @@ def parse_dtx_to_intermediate(filename,
         if global_beat_metadata not in metadata_chart_data['beats']:
             metadata_chart_data['beats'][global_beat_metadata] = []
 
-        timestamp_cur = calculate_current_timestamp(measure, 0, measure_lengths, bpms_at_measure_beat)
+        timestamp_cur = tempo_map.get_timestamp(measure, 0)
         if updated_time_signature:
             metadata_chart_data['beats'][global_beat_metadata].append({
                 "data": {
@@ -1253,7 +1083,7 @@ def parse_dtx_to_intermediate(filename,
 
             metadata_chart_data['beats'][beat].append({
                 "name": "beat",
-                "timestamp": calculate_current_timestamp(measure, cb, measure_lengths, bpms_at_measure_beat),
+                "timestamp": tempo_map.get_timestamp(measure, cb),
             })
 
         global_beat_metadata = int(round(global_beat_metadata))
@@ -1276,16 +1106,9 @@ def parse_dtx_to_intermediate(filename,
                 if event == 0x01:
                     # BGM item
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
-                        timestamp = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
+                        timestamp = tempo_map.get_timestamp(measure, i)
 
                         if int(data[i], 36) in wav_filenames:
                             bgm_info.append({
@@ -1296,9 +1119,7 @@ def parse_dtx_to_intermediate(filename,
                 elif event == 0x03:
                     # Base BPM addition
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         beat = global_beat_metadata + i
 
@@ -1312,12 +1133,7 @@ def parse_dtx_to_intermediate(filename,
                                 "bpm": new_bpm
                             },
                             "name": "bpm",
-                            "timestamp": calculate_current_timestamp(
-                                measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
-                            ),
+                            "timestamp": tempo_map.get_timestamp(measure, i),
                         })
 
                         if beat > last_event[2]:
@@ -1328,9 +1144,7 @@ def parse_dtx_to_intermediate(filename,
                 elif event == 0x08:
                     # BPM event
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         beat = global_beat_metadata + i
 
@@ -1347,12 +1161,7 @@ def parse_dtx_to_intermediate(filename,
                                     "bpm": base_bpm + bpms[int(data[i], 36)]
                                 },
                                 "name": "bpm",
-                                "timestamp": calculate_current_timestamp(
-                                    measure,
-                                    i % len(data),
-                                    measure_lengths,
-                                    bpms_at_measure_beat
-                                ),
+                                "timestamp": tempo_map.get_timestamp(measure, i),
                             })
 
                             if beat > last_event[2]:
@@ -1363,9 +1172,7 @@ def parse_dtx_to_intermediate(filename,
                 elif event == 0xc2:
                     # baron/off
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         beat = global_beat_metadata + i
 
@@ -1386,12 +1193,7 @@ def parse_dtx_to_intermediate(filename,
 
                         metadata_chart_data['beats'][beat].append({
                             "name": name,
-                            "timestamp": calculate_current_timestamp(
-                                measure,
-                                i % len(data),
-                                measure_lengths,
-                                bpms_at_measure_beat
-                            ),
+                            "timestamp": tempo_map.get_timestamp(measure, i),
                         })
 
                         if beat > last_event[2]:
@@ -1399,9 +1201,7 @@ def parse_dtx_to_intermediate(filename,
 
                 elif event in default_note_events:
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         sound_id = int(data[i], 36)
                         mapped_sound_id = sound_metadata_map.get(sound_id, 0)
@@ -1410,42 +1210,26 @@ def parse_dtx_to_intermediate(filename,
                 elif event in [0x2a, 0x2c]:
                     # Guitar long note
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         if measure not in guitar_long_note_info:
                             guitar_long_note_info[measure] = {}
 
-                        guitar_long_note_info[measure][i] = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
+                        guitar_long_note_info[measure][i] = tempo_map.get_timestamp(measure, i)
 
                 elif event in [0x2b, 0x2d]:
                     # Bass long note
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         if measure not in bass_long_note_info:
                             bass_long_note_info[measure] = {}
 
-                        bass_long_note_info[measure][i] = calculate_current_timestamp(
-                            measure,
-                            i % len(data),
-                            measure_lengths,
-                            bpms_at_measure_beat
-                        )
+                        bass_long_note_info[measure][i] = tempo_map.get_timestamp(measure, i)
 
                 elif event in reverse_dtx_mapping:
                     data = events_by_measure[measure][event]
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         beat = global_beat_chart + i
 
@@ -1486,7 +1270,7 @@ def parse_dtx_to_intermediate(filename,
                             wail_event = 0xa8
 
                         if wail_event != -1 and wail_event in events_by_measure[measure]:
-                            if len(events_by_measure[measure][wail_event]) == len(events_by_measure[measure][event]) and events_by_measure[measure][wail_event][i] != "00":
+                            if events_by_measure[measure][wail_event].length == events_by_measure[measure][event].length and i in events_by_measure[measure][wail_event]:
                                 wail_flag = 1
 
                         if event in guitar_range and measure in guitar_long_note_time_by_measure_beat and i in guitar_long_note_time_by_measure_beat[measure]:
@@ -1509,7 +1293,7 @@ def parse_dtx_to_intermediate(filename,
                                 "bonus_note": 1 if measure in bonus_notes and i in bonus_notes[measure] and sound_id in bonus_notes[measure][i] else 0,
                             },
                             "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
+                            "timestamp": tempo_map.get_timestamp(measure, i),
                         })
 
                         if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
@@ -1522,9 +1306,7 @@ def parse_dtx_to_intermediate(filename,
 
                     data = events_by_measure[measure][event]
 
-                    for i in range(len(data)):
-                        if data[i] == '00':
-                            continue
+                    for i in data:
 
                         beat = global_beat_chart + i
 
@@ -1549,7 +1331,7 @@ def parse_dtx_to_intermediate(filename,
                                 "guitar_special": 0,
                             },
                             "name": "note",
-                            "timestamp": calculate_current_timestamp(measure, i % len(data), measure_lengths, bpms_at_measure_beat),
+                            "timestamp": tempo_map.get_timestamp(measure, i),
                         })
 
                         if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
@@ -1574,7 +1356,7 @@ def parse_dtx_to_intermediate(filename,
 
     chart_data['beats'][last_event[2]].append({
         "name": "chipend",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": tempo_map.get_timestamp(last_event[0], last_event[1]),
     })
 
     # Delayed end command
@@ -1592,19 +1374,57 @@ def parse_dtx_to_intermediate(filename,
 
     chart_data['beats'][last_event[2]].append({
         "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": tempo_map.get_timestamp(last_event[0], last_event[1]),
     })
 
     metadata_chart_data['beats'][last_event[2]].append({
         "name": "endpos",
-        "timestamp": calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat),
+        "timestamp": tempo_map.get_timestamp(last_event[0], last_event[1]),
     })
 
     chart_data = generate_timestamp_set(chart_data, last_event)
     metadata_chart_data = generate_timestamp_set(metadata_chart_data, last_event)
 
+    return {
+        'dtx': dtx,
+        'chart_data': chart_data,
+        'metadata_chart_data': metadata_chart_data,
+        'wav_filenames': wav_filenames,
+        'wav_volumes': wav_volumes,
+        'wav_pans': wav_pans,
+        'is_drums': 'drum' in target_parts,
+        'sound_metadata_drum': sound_metadata_drum,
+        'sound_metadata_guitar': sound_metadata_guitar,
+        'bgm_info': bgm_info,
+        'bgm_end': tempo_map.get_timestamp(last_event[0], last_event[1]) / 300,
+        'preview': preview_filename,
+        'defaults': default_notes,
+    }
+
+
+def merge_dtx_sound_metadata(dtx_data, sound_metadata):
+    if dtx_data is None:
+        return None, None, None, None, sound_metadata
+
+    sound_metadata_map, sound_metadata = generate_sound_metadata_map(sound_metadata,
+                                                                     dtx_data['wav_filenames'],
+                                                                     dtx_data['wav_volumes'],
+                                                                     dtx_data['wav_pans'],
+                                                                     is_drums=dtx_data['is_drums'])
+
+    # Replace the placeholder sound ids with the ones assigned in the shared sound metadata
+    sound_ids = {wav_id + 1: sound_metadata_map[wav_id] for wav_id in sound_metadata_map}
+
+    chart_data = dtx_data['chart_data']
+    note_rows = chart_data.get_event_mask(["note"])
+    chart_data.set_values('sound_id', note_rows, [sound_ids.get(x, 0) for x in chart_data.get_values('sound_id', note_rows)])
+
+    sound_metadata_drum = [sound_ids.get(x, 0) for x in dtx_data['sound_metadata_drum']]
+    sound_metadata_guitar = [sound_ids.get(x, 0) for x in dtx_data['sound_metadata_guitar']]
+    default_notes = {k: sound_ids.get(dtx_data['defaults'][k], 0) for k in dtx_data['defaults']}
+
     # Remove any BGMs from the sound metadata
-    for bgm in bgm_info:
+    for bgm in dtx_data['bgm_info']:
         remove_keys = []
         for k in sound_metadata['data']:
             if sound_metadata['data'][k]['filename'] == bgm['filename']:
@@ -1616,15 +1436,23 @@ def parse_dtx_to_intermediate(filename,
     sound_metadata['drum'] = list(set(sound_metadata['drum'] + sound_metadata_drum))
     sound_metadata['guitar'] = list(set(sound_metadata['guitar'] + sound_metadata_guitar))
     sound_metadata['bgm'] = {
-        'end': calculate_current_timestamp(last_event[0], last_event[1], measure_lengths, bpms_at_measure_beat) / 300,
-        'data': bgm_info
+        'end': dtx_data['bgm_end'],
+        'data': dtx_data['bgm_info']
     }
-    sound_metadata['preview'] = preview_filename
+    sound_metadata['preview'] = dtx_data['preview']
     sound_metadata['defaults'] = default_notes
 
-    drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, lines)
+    drum_chart_data, guitar_chart_data, bass_chart_data = get_chart_datas(chart_data, dtx_data['dtx'])
+
+    return dtx_data['metadata_chart_data'], drum_chart_data, guitar_chart_data, bass_chart_data, sound_metadata
 
-    return metadata_chart_data, drum_chart_data, guitar_chart_data, bass_chart_data, sound_metadata
+
+def parse_dtx_to_intermediate(filename,
+                              params,
+                              sound_metadata,
+                              target_parts=['drum', 'guitar', 'bass', 'open']):
+    dtx_data = read_dtx(filename, params, sound_metadata['sound_folder'], target_parts)
+    return merge_dtx_sound_metadata(dtx_data, sound_metadata)
 
 
 def create_json_from_dtx(params):
@@ -1656,27 +1484,27 @@ def create_json_from_dtx(params):
 
     sound_metadata = {'sound_folder': params['sound_folder'] if 'sound_folder' in params else "", 'preview': "", 'bgm': {}, 'data': {}, 'guitar': [], 'drum': [], 'defaults': {}}
 
-    def get_chart_data(data, sound_metadata, parts):
+    def get_chart_data(dtx_datas, sound_metadata):
         metadatas = []
 
         chart_drum = None
-        if "drum" in parts and 'drum' in data:
-            metadata1, chart_drum, _, _, sound_metadata = parse_dtx_to_intermediate(data['drum'], params, sound_metadata, "drum")
+        if 'drum' in dtx_datas:
+            metadata1, chart_drum, _, _, sound_metadata = merge_dtx_sound_metadata(dtx_datas['drum'].result(), sound_metadata)
             metadatas.append(metadata1)
 
         chart_guitar = None
-        if "guitar" in parts and 'guitar' in data:
-            metadata2, _, chart_guitar, _, sound_metadata = parse_dtx_to_intermediate(data['guitar'], params, sound_metadata, "guitar")
+        if 'guitar' in dtx_datas:
+            metadata2, _, chart_guitar, _, sound_metadata = merge_dtx_sound_metadata(dtx_datas['guitar'].result(), sound_metadata)
             metadatas.append(metadata2)
 
         chart_bass = None
-        if "bass" in parts and 'bass' in data:
-            metadata3, _,  _, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['bass'], params, sound_metadata, "bass")
+        if 'bass' in dtx_datas:
+            metadata3, _,  _, chart_bass, sound_metadata = merge_dtx_sound_metadata(dtx_datas['bass'].result(), sound_metadata)
             metadatas.append(metadata3)
 
         chart_open = None
-        # if "open" in parts and 'open' in data:
-        #     metadata4, chart_bass, sound_metadata = parse_dtx_to_intermediate(data['open'], params, sound_metadata, "open")
+        # if 'open' in dtx_datas:
+        #     metadata4, chart_bass, sound_metadata = merge_dtx_sound_metadata(dtx_datas['open'].result(), sound_metadata)
         #     metadatas.append(metadata4)
 
         metadatas = [x for x in metadatas if x is not None]  # Filter bad metadata charts
@@ -1684,11 +1512,22 @@ def create_json_from_dtx(params):
 
         return metadata, chart_drum, chart_guitar, chart_bass, chart_open, sound_metadata
 
-    novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open, sound_metadata = get_chart_data(novice_data, sound_metadata, params['parts'])
-    basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open, sound_metadata = get_chart_data(basic_data, sound_metadata, params['parts'])
-    adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open, sound_metadata = get_chart_data(adv_data, sound_metadata, params['parts'])
-    ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open, sound_metadata = get_chart_data(ext_data, sound_metadata, params['parts'])
-    master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open, sound_metadata = get_chart_data(master_data, sound_metadata, params['parts'])
+    # The files are read in parallel but the sound metadata is always merged
+    # in the same order so the assigned sound ids don't depend on timing
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        dtx_datas = []
+        for data in [novice_data, basic_data, adv_data, ext_data, master_data]:
+            dtx_datas.append({})
+
+            for part in ['drum', 'guitar', 'bass']:
+                if part in params['parts'] and part in data:
+                    dtx_datas[-1][part] = executor.submit(read_dtx, data[part], params, sound_metadata['sound_folder'], part)
+
+        novice_metadata, novice_chart_drum, novice_chart_guitar, novice_chart_bass, novice_chart_open, sound_metadata = get_chart_data(dtx_datas[0], sound_metadata)
+        basic_metadata, basic_chart_drum, basic_chart_guitar, basic_chart_bass, basic_chart_open, sound_metadata = get_chart_data(dtx_datas[1], sound_metadata)
+        adv_metadata, adv_chart_drum, adv_chart_guitar, adv_chart_bass, adv_chart_open, sound_metadata = get_chart_data(dtx_datas[2], sound_metadata)
+        ext_metadata, ext_chart_drum, ext_chart_guitar, ext_chart_bass, ext_chart_open, sound_metadata = get_chart_data(dtx_datas[3], sound_metadata)
+        master_metadata, master_chart_drum, master_chart_guitar, master_chart_bass, master_chart_open, sound_metadata = get_chart_data(dtx_datas[4], sound_metadata)
 
     # Create sound metadata file
     # Any notes not in the drums or guitar sound metadata fields should be added to both just in case
@@ -1800,7 +1639,7 @@ def create_json_from_dtx(params):
         "preview": sound_metadata['preview'],
     }
 
-    return json.dumps(output_json, indent=4, sort_keys=True)
+    return output_json
 
 
 #########################
@@ -1808,115 +1647,69 @@ def create_json_from_dtx(params):
 #########################
 
 def combine_charts(metadata, chart):
-    chart_combined = copy.deepcopy(chart)
-
     # Remove endpos command from chart but keep metadata's command
-    for k in sorted(chart_combined['timestamp'].keys(), key=lambda x: int(x)):
-        filter_list = ["endpos"]
-        chart_combined['timestamp'][k] = [x for x in chart_combined['timestamp'][k] if x['name'] not in filter_list]
-
-    for k in sorted(metadata['timestamp'].keys(), key=lambda x: int(x)):
-        if k not in chart_combined['timestamp']:
-            chart_combined['timestamp'][k] = []
-
-        for d in metadata['timestamp'][k]:
-            chart_combined['timestamp'][k].append(d)
+    chart_combined = chart.select(~chart.get_event_mask(["endpos"]), copy.deepcopy(chart.info))
 
-    return chart_combined
+    return chart_combined.merge(metadata)
 
 
 def generate_hold_release_events(chart):
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][k]:
-            if beat['name'] == "note":
-                if 'guitar_special' in beat['data'] and beat['data']['guitar_special'] & 0x02:
-                    # Long note start
-                    new_note = copy.deepcopy(beat)
-                    new_note['name'] = "_note_start"
+    hold_rows = numpy.flatnonzero(chart.get_event_mask(["note"]) & chart.has_values('guitar_special'))
+    hold_rows = hold_rows[[x & 0x02 != 0 for x in chart.get_values('guitar_special', hold_rows)]]
 
-                    if 'beat' in new_note:
-                        del new_note['beat']
+    # Long note start
+    start_events = chart.get_events(hold_rows)
+    for event in start_events:
+        event['name'] = "_note_start"
+        event.pop('beat', None)
 
-                    chart['timestamp'][k].append(new_note)
+    # Long note end, moved back until it doesn't share a timestamp with a note
+    note_timestamps = set(chart.timestamp[chart.get_event_mask(["note"])].tolist())
+    start_timestamps = chart.get_timestamp_keys(hold_rows, True)
+    release_timestamps = []
+    release_events = chart.get_events(hold_rows)
 
-                    # Long note end
-                    new_note = copy.deepcopy(beat)
-                    new_note['name'] = "_note_release"
+    for event, timestamp, hold_duration in zip(release_events, start_timestamps, chart.get_values('hold_duration', hold_rows)):
+        event['name'] = "_note_release"
+        event.pop('beat', None)
 
-                    if 'beat' in new_note:
-                        del new_note['beat']
-
-                    timestamp_offset = 0
-                    while True:
-                        new_timestamp = str(int(k) + int(beat['data']['hold_duration']) - timestamp_offset)
-
-                        if new_timestamp not in chart['timestamp']:
-                            break
-
-                        found_note = False
-                        for beat2 in chart['timestamp'][new_timestamp]:
-                            if beat2['name'] == "note":
-                                timestamp_offset += 1
-                                found_note = True
-                                break
-
-                        if not found_note:
-                            break
+        new_timestamp = int(timestamp) + int(hold_duration)
+        while new_timestamp in note_timestamps:
+            new_timestamp -= 1
 
-                    if new_timestamp not in chart['timestamp']:
-                        chart['timestamp'][new_timestamp] = []
+        release_timestamps.append(new_timestamp)
 
-                    chart['timestamp'][new_timestamp].append(new_note)
-
-    return chart
-
-
-def get_time_signatures_by_timestamp(chart):
-    time_signatures_by_timestamp = {}
-
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][k]:
-            if beat['name'] == "barinfo":
-                time_signatures_by_timestamp[k] = {
-                    'numerator': beat['data']['numerator'],
-                    'denominator': beat['data']['denominator'],
-                    'denominator_orig': Fraction2(beat['data']['numerator'], beat['data']['denominator']).denominator_orig,
-                    'timesig': beat['data']['numerator'] / beat['data']['denominator']
-                }
-
-    return time_signatures_by_timestamp
-
-
-def generate_time_signature_by_timestamp(chart):
-    time_signatures_by_timestamp = get_time_signatures_by_timestamp(chart)
-
-    # Generate a time_signature field for everything based on timestamp
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        idx = [x for x in sorted(time_signatures_by_timestamp.keys(), key=lambda x: int(x)) if int(x) <= int(k)][-1]
-        time_signature = time_signatures_by_timestamp[idx]
-
-        for idx in range(len(chart['timestamp'][k])):
-            chart['timestamp'][k][idx]['time_signature'] = time_signature
+    # Releases go after the events already at their timestamp, starts after everything else
+    chart = chart.merge(chartdata.ChartData.from_events(chart.info, release_timestamps, release_events))
+    chart = chart.merge(chartdata.ChartData.from_events(chart.info, start_timestamps, start_events))
 
     return chart
 
 
 def force_dtx_time_signatures(chart):
     # Find time signatures that aren't x/4 and make them x/4 with approprate BPM changes
+    rows = numpy.flatnonzero(chart.get_event_mask(["bpm", "barinfo"]))
+    events = chart.get_events(rows)
+    timestamps = chart.get_timestamp_keys(rows, True)
+
+    new_timestamps = []
+    new_events = []
 
     last_bpm = None
     last_bpm_k = None
     last_bpm_real = None
     is_mod_bpm = False
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for data in chart['timestamp'][k]:
+    for k, group in itertools.groupby(zip(timestamps, events), key=lambda x: x[0]):
+        group = [x[1] for x in group]
+
+        for data in group:
             if data['name'] == "bpm":
                 last_bpm = data
                 last_bpm_k = k
                 last_bpm_real = data
                 is_mod_bpm = False
 
-        for data in chart['timestamp'][k]:
+        for data in list(group):
             if data['name'] == "barinfo":
                 if data['data']['denominator'] != 4:
                     diff = data['data']['denominator'] / 4
@@ -1925,7 +1718,7 @@ def force_dtx_time_signatures(chart):
 
                     if last_bpm_k == k:
                         # Replace BPM in current timestamp
-                        for data2 in chart['timestamp'][k]:
+                        for data2 in group:
                             if data2['name'] == "bpm":
                                 data2['data']['bpm'] *= diff
                     else:
@@ -1933,7 +1726,9 @@ def force_dtx_time_signatures(chart):
                         new_bpm = copy.deepcopy(last_bpm_real)
                         new_bpm['beat'] = data['beat']
                         new_bpm['data']['bpm'] *= diff
-                        chart['timestamp'][k].append(new_bpm)
+                        group.append(new_bpm)
+                        new_timestamps.append(k)
+                        new_events.append(new_bpm)
                         last_bpm = new_bpm
                         last_bpm_k = k
 
@@ -1943,12 +1738,21 @@ def force_dtx_time_signatures(chart):
                         # Add new BPM command
                         new_bpm = copy.deepcopy(last_bpm_real)
                         new_bpm['beat'] = data['beat']
-                        chart['timestamp'][k].append(new_bpm)
+                        group.append(new_bpm)
+                        new_timestamps.append(k)
+                        new_events.append(new_bpm)
                         last_bpm = new_bpm
                         last_bpm_k = k
 
+    # Write the changed fields back, the new BPM commands go after everything else at their timestamp
+    bpm_rows = chart.get_event_mask(["bpm"])[rows]
+    chart.set_values('bpm', rows[bpm_rows], [x['data']['bpm'] for x, is_bpm in zip(events, bpm_rows) if is_bpm])
 
-    return chart
+    for field in ['denominator', 'denominator_orig']:
+        has_field = [field in x['data'] and not is_bpm for x, is_bpm in zip(events, bpm_rows)]
+        chart.set_values(field, rows[has_field], [x['data'][field] for x, b in zip(events, has_field) if b])
+
+    return chart.merge(chartdata.ChartData.from_events(chart.info, new_timestamps, new_events))
 
 
 def generate_metadata_fields(metadata, chart, is_forced_dtx_time_signatures=False):
@@ -1966,77 +1770,57 @@ def generate_metadata_fields(metadata, chart, is_forced_dtx_time_signatures=Fals
         chart = force_dtx_time_signatures(chart)
 
     chart = generate_hold_release_events(chart)
-    chart = generate_time_signature_by_timestamp(chart)
 
     return chart
 
 
-def get_chart_data_by_measure_beat(chart_data):
+def get_chart_data_by_measure_beat(events):
     chart_data_sorted = {}
 
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
-        for idx in range(len(chart_data['timestamp'][k])):
-            measure = chart_data['timestamp'][k][idx]['metadata']['measure']
-            beat = chart_data['timestamp'][k][idx]['metadata']['beat']
+    for event in events:
+        measure = event['metadata']['measure']
+        beat = event['metadata']['beat']
 
-            if measure not in chart_data_sorted:
-                chart_data_sorted[measure] = {}
+        if measure not in chart_data_sorted:
+            chart_data_sorted[measure] = {}
 
-            if beat not in chart_data_sorted[measure]:
-                chart_data_sorted[measure][beat] = []
+        if beat not in chart_data_sorted[measure]:
+            chart_data_sorted[measure][beat] = []
 
-            d = chart_data['timestamp'][k][idx]
-            d['timestamp'] = k
-            chart_data_sorted[measure][beat].append(d)
+        chart_data_sorted[measure][beat].append(event)
 
     return chart_data_sorted
 
 
-def calculate_time_signatures_by_timestamp(chart_data):
-    time_signatures_by_timestamp = {}
-    last_timesig_timestamp = 0
-
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
-        found_timesig = False
-
-        for beat in chart_data['timestamp'][k]:
-            if beat['name'] == "barinfo":
-                time_signatures_by_timestamp[k] = {
-                    'numerator': beat['data']['numerator'],
-                    'denominator': beat['data']['denominator'],
-                    'denominator_orig': Fraction2(beat['data']['numerator'], beat['data']['denominator']).denominator_orig,
-                    'timesig': beat['data']['numerator'] / beat['data']['denominator']
-                }
-
-                last_timesig_timestamp = k
-                found_timesig = True
-
-        if not found_timesig and last_timesig_timestamp in time_signatures_by_timestamp:
-            time_signatures_by_timestamp[k] = time_signatures_by_timestamp[last_timesig_timestamp]
+def get_time_signatures_for_events(chart_data):
+    # Every event uses the time signature of the last barinfo event at or before it
+    barinfo_rows = numpy.flatnonzero(chart_data.get_event_mask(["barinfo"]))
+    time_signatures = []
 
-    return time_signatures_by_timestamp
-
-
-def add_time_signature_to_events(chart_data):
-    time_signatures_by_timestamp = calculate_time_signatures_by_timestamp(chart_data)
-
-    # Generate a time_signature field for everything based on timestamp
-    time_signatures_by_timestamp_keys = list(sorted(time_signatures_by_timestamp.keys(), key=lambda x: int(x)))
-    last_idx = 0
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
-        idx = [x for x in time_signatures_by_timestamp_keys[last_idx:] if int(x) <= int(k)][-1]
-        last_idx = time_signatures_by_timestamp_keys.index(idx)
-
-        time_signature = time_signatures_by_timestamp[idx]
+    for numerator, denominator in zip(chart_data.get_values('numerator', barinfo_rows), chart_data.get_values('denominator', barinfo_rows)):
+        time_signatures.append({
+            'numerator': numerator,
+            'denominator': denominator,
+            'denominator_orig': Fraction2(numerator, denominator).denominator_orig,
+            'timesig': numerator / denominator
+        })
 
-        for idx in range(len(chart_data['timestamp'][k])):
-            chart_data['timestamp'][k][idx]['time_signature'] = time_signature
+    idx = numpy.searchsorted(chart_data.timestamp[barinfo_rows], chart_data.timestamp, side='right') - 1
+    if numpy.any(idx < 0):
+        raise IndexError("Couldn't find a time signature for the start of the chart")
 
-    return chart_data
+    return [time_signatures[x] for x in idx.tolist()]
 
 
 def generate_measure_beat_for_chart(chart_data):
-    chart_data = add_time_signature_to_events(chart_data)
+    # Returns the chart's events with their time signature, timestamp and DTX measure/beat
+    time_signatures = get_time_signatures_for_events(chart_data)
+    names = chart_data.get_values('name')
+    bpm_rows = numpy.flatnonzero(chart_data.get_event_mask(["bpm"]))
+    bpms = dict(zip(bpm_rows.tolist(), chart_data.get_values('bpm', bpm_rows)))
+
+    events = chart_data.get_events()
+    groups = chart_data.get_timestamp_groups().tolist()
 
     measure = -1
     beat = 0
@@ -2044,29 +1828,31 @@ def generate_measure_beat_for_chart(chart_data):
     last_timesig = {'numerator': 4, 'denominator': 4}
     cur_bpm = None
     base_beat = 0
-    for k in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
-        for idx in range(len(chart_data['timestamp'][k])):
-            if chart_data['timestamp'][k][idx]['name'] == "measure":
+    for start, end in zip(groups, groups[1:]):
+        k = chart_data.get_timestamp_key(start, True)
+
+        for idx in range(start, end):
+            if names[idx] == "measure":
                 measure += 1
                 beat = 0
                 last_measure_timestamp = int(k)
-                last_timesig = chart_data['timestamp'][k][idx]['time_signature']
+                last_timesig = time_signatures[idx]
                 base_beat = beat
 
-            elif chart_data['timestamp'][k][idx]['name'] == "beat":
-                #beat += int(round(1920 * (chart_data['timestamp'][k][idx]['time_signature']['numerator'] / chart_data['timestamp'][k][idx]['time_signature']['denominator']) / chart_data['timestamp'][k][idx]['time_signature']['numerator']))
-                beat = base_beat + (1920 // chart_data['timestamp'][k][idx]['time_signature']['denominator'])
+            elif names[idx] == "beat":
+                #beat += int(round(1920 * (time_signatures[idx]['numerator'] / time_signatures[idx]['denominator']) / time_signatures[idx]['numerator']))
+                beat = base_beat + (1920 // time_signatures[idx]['denominator'])
                 last_measure_timestamp = int(k)
-                last_timesig = chart_data['timestamp'][k][idx]['time_signature']
+                last_timesig = time_signatures[idx]
                 base_beat = beat
 
-            elif chart_data['timestamp'][k][idx]['name'] == "barinfo":
+            elif names[idx] == "barinfo":
                 last_measure_timestamp = int(k)
-                last_timesig = chart_data['timestamp'][k][idx]['time_signature']
+                last_timesig = time_signatures[idx]
 
-            elif cur_bpm == None and chart_data['timestamp'][k][idx]['name'] == "bpm":
-                cur_bpm = chart_data['timestamp'][k][idx]['data']['bpm']
-                last_timesig = chart_data['timestamp'][k][idx]['time_signature']
+            elif cur_bpm == None and names[idx] == "bpm":
+                cur_bpm = bpms[idx]
+                last_timesig = time_signatures[idx]
 
         # Calculate the difference between the current beat's timestamp and
         # the current note's timestamp Then calculate the beat difference
@@ -2090,21 +1876,23 @@ def generate_measure_beat_for_chart(chart_data):
         final_beat = beat + round(beat_diff)
         final_beat *= int(last_timesig['denominator_orig'] / 2)
 
-        for idx in range(len(chart_data['timestamp'][k])):
-            chart_data['timestamp'][k][idx]['beat'] = 0
-            chart_data['timestamp'][k][idx]['metadata'] = {
+        for idx in range(start, end):
+            events[idx]['time_signature'] = time_signatures[idx]
+            events[idx]['timestamp'] = k
+            events[idx]['beat'] = 0
+            events[idx]['metadata'] = {
                 'measure': measure + measure_diff if measure + measure_diff >= 0 else 0,
                 'beat': int(round(final_beat)),
             }
 
-        for idx in range(len(chart_data['timestamp'][k])):
-            if chart_data['timestamp'][k][idx]['name'] == "bpm":
-                cur_bpm = chart_data['timestamp'][k][idx]['data']['bpm']
-                last_timesig = chart_data['timestamp'][k][idx]['time_signature']
+        for idx in range(start, end):
+            if names[idx] == "bpm":
+                cur_bpm = bpms[idx]
+                last_timesig = time_signatures[idx]
                 last_measure_timestamp = int(k)
                 beat = int(round(final_beat))
 
-    return chart_data
+    return events
 
 
 def get_clipped_wav(sound_metadata, sound_entry, duration):
@@ -2169,8 +1957,8 @@ def generate_dtx_info(chart_data, sound_metadata, game_type):
     last_played_note = None
 
     # TODO: Refactor this more eventually if possible
-    for measure in sorted(chart_data.keys(), key=lambda x: int(x)):
-        for beat in sorted(chart_data[measure].keys(), key=lambda x: int(x)):
+    for measure in sorted(chart_data.keys()):
+        for beat in sorted(chart_data[measure].keys()):
             for idx in range(len(chart_data[measure][beat])):
                 cd = chart_data[measure][beat][idx]
 
@@ -2579,8 +2367,8 @@ def generate_dtx_chart_from_json(metadata, orig_chart_data, sound_metadata, para
 
     output.append("#00001: ZZ")
     output.append("#00054: ZZ")
-    for measure in sorted(dtx_info.keys(), key=lambda x: int(x)):
-        for key in sorted(dtx_info[measure].keys(), key=lambda x: int(x)):
+    for measure in sorted(dtx_info.keys()):
+        for key in sorted(dtx_info[measure].keys()):
             output.append("#%03d%02X: %s" % (measure, key, "".join(dtx_info[measure][key])))
 
     return "\n".join(output)
@@ -2600,14 +2388,28 @@ def get_charts_data(charts, sound_metadata, params):
 
     return [{
         'chart': x,
-        'data': generate_dtx_chart_from_json(copy.deepcopy(chart_metadata), x, sound_metadata, params)
+        'data': generate_dtx_chart_from_json(chart_metadata.copy(), x, sound_metadata, params)
     } for x in charts if x['header']['is_metadata'] == 0]
 
 
+def extract_used_keysounds(charts, sound_archive, sound_folder):
+    # Only the keysounds played by the charts are decoded from the archive
+    sound_ids = set()
+    for chart in charts:
+        rows = numpy.flatnonzero(chart.get_event_mask(["note"]) & chart.has_values('sound_id'))
+        sound_ids.update([int(x) for x in chart.get_values('sound_id', rows)])
+
+    for sound_id in sorted(sound_ids):
+        entry = sound_archive.get_entry_by_sound_id(sound_id)
+
+        if entry:
+            sound_archive.extract(entry, os.path.join(sound_folder, sound_archive.get_wav_filename(entry)))
+
+
 def create_dtx_from_json(params):
-    dtx_data = params.get('input', None)
+    json_dtx = params.get('input', None)
+    charts = chartdata.get_charts(json_dtx)
     sound_folder = params.get('sound_folder', None)
-    json_dtx = json.loads(dtx_data)
 
     output_folder = params.get('output', None)
     if output_folder and not os.path.exists(output_folder):
@@ -2615,7 +2417,22 @@ def create_dtx_from_json(params):
 
     sound_metadata = params.get('sound_metadata', None)
 
-    charts_data = get_charts_data(json_dtx['charts'], sound_metadata, params)
+    if params.get('sound_archive'):
+        # Keysounds come from a VA3 archive instead of an extracted sound folder
+        if not sound_folder:
+            sound_folder = output_folder if output_folder else ""
+            params = dict(params, sound_folder=sound_folder)
+
+        if sound_folder and not os.path.exists(sound_folder):
+            os.makedirs(sound_folder)
+
+        with vas3tool.VA3Archive(params['sound_archive']) as sound_archive:
+            if not sound_metadata:
+                sound_metadata = copy.deepcopy(sound_archive.metadata)
+
+            extract_used_keysounds(charts, sound_archive, sound_folder)
+
+    charts_data = get_charts_data(charts, sound_metadata, params)
     create_dtx_files(json_dtx, params, charts_data)
     create_set_definition_file(json_dtx, params, charts_data)
 
@@ -2674,7 +2491,7 @@ def create_set_definition_file(json_dtx, params, charts_data):
             if song_title:
                 outfile.write("#TITLE: {} ({})\n".format(song_title, part))
 
-            for difficulty in sorted(output_set_data[part].keys(), key=lambda x: int(x)):
+            for difficulty in sorted(output_set_data[part].keys()):
                 outfile.write("#L{}FILE: {}\n".format(difficulty,
                                                       output_set_data[part][difficulty]))
             outfile.write("\n")
@@ -2693,11 +2510,6 @@ class DtxFormat:
     def to_chart(params):
         return create_dtx_from_json(params)
 
-    @staticmethod
-    def is_format(filename):
-        # How to determine a DTX?
-        return False
-
 
 def get_class():
     return DtxFormat
@@ -577,7 +577,7 @@ def generate_json_from_gsq2(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Gsq1Format:
@@ -593,10 +593,6 @@ class Gsq1Format:
     def to_chart(params):
         super()
 
-    @staticmethod
-    def is_format(filename):
-        return False
-
 
 def get_class():
     return Gsq1Format
@@ -581,7 +581,7 @@ def generate_json_from_gsq2(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Gsq2Format:
@@ -597,19 +597,6 @@ class Gsq2Format:
     def to_chart(params):
         super()
 
-    @staticmethod
-    def is_format(filename):
-        header = open(filename, "rb").read(0x40)
-
-        try:
-            is_gsq = header[0x00:0x04].decode('ascii') == "GSQ1"
-            if is_gsq:
-                return True
-        except:
-            return False
-
-        return False
-
 
 def get_class():
     return Gsq2Format
@@ -1,6 +1,8 @@
 import json
 import os
 
+import chartdata
+
 
 class JsonFormat:
     @staticmethod
@@ -15,18 +17,17 @@ class JsonFormat:
             return None
 
         with open(input_filename, "rb") as f:
-            return f.read()
+            return json.loads(f.read().decode('utf-8'))
 
     @staticmethod
     def to_chart(params):
         output_filename = os.path.join(params.get('output', ""), "output.json")
 
-        with open(output_filename, "w") as f:
-            f.write(params.get('input', ""))
+        # Documents read from output.json keep their key order, the other formats are written sorted
+        sort_keys = (params.get('input_format') or "").lower() != "json"
 
-    @staticmethod
-    def is_format(filename):
-        return False
+        with open(output_filename, "w") as f:
+            f.write(json.dumps(params.get('input', {}), indent=4, sort_keys=sort_keys, default=chartdata.encode_chart))
 
 
 def get_class():
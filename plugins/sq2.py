@@ -1,5 +1,6 @@
 import copy
 import json
+import numpy
 import os
 import shutil
 import struct
@@ -8,6 +9,7 @@ from lxml import etree
 from lxml.builder import E
 import uuid
 
+import chartdata
 import helper
 import mdb
 import eamxml
@@ -151,160 +153,94 @@ REVERSE_NOTE_MAPPING = {
 }
 
 
-def combine_metadata_with_chart(metadata, chart):
-    chart_combined = copy.deepcopy(chart)
+def get_time_signatures(chart):
+    # Time signature of every event, taken from the last barinfo event at or before it
+    barinfo_rows = numpy.flatnonzero(chart.get_event_mask(["barinfo"]))
+    numerators = numpy.array([4] + chart.get_values('numerator', barinfo_rows), dtype=numpy.int64)
+    denominators = numpy.array([4] + chart.get_values('denominator', barinfo_rows), dtype=numpy.int64)
 
-    for timestamp_key in sorted(metadata['timestamp'].keys(), key=lambda x: int(x)):
-        if timestamp_key not in chart_combined['timestamp']:
-            chart_combined['timestamp'][timestamp_key] = []
+    idx = numpy.searchsorted(chart.timestamp[barinfo_rows], chart.timestamp, side='right')
 
-        for d in metadata['timestamp'][timestamp_key]:
-            chart_combined['timestamp'][timestamp_key].append(d)
+    return numerators[idx], denominators[idx]
 
-    return chart_combined
 
+def generate_beats_by_timestamp(chart, numerators, denominators):
+    # Generate beats based on measures and line markers.
+    # Until the first measure a marker uses its own time signature, after that it uses
+    # the time signature of the previous timestamp.
+    groups = chart.get_timestamp_groups()
+    group_idx = numpy.searchsorted(groups, numpy.arange(len(chart)), side='right') - 1
+    previous_rows = groups[numpy.maximum(group_idx - 1, 0)]
 
-def get_timesigs_by_timestamp(chart_combined):
-    time_signatures_by_timestamp = {
-        0: {
-            'numerator': 4,
-            'denominator': 4,
-            'timesig': 1,
-        }
-    }
-
-    for k in sorted(chart_combined['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart_combined['timestamp'][k]:
-            if beat['name'] == "barinfo":
-                time_signatures_by_timestamp[k] = {
-                    'numerator': beat['data']['numerator'],
-                    'denominator': beat['data']['denominator'],
-                    'timesig': beat['data']['numerator'] / beat['data']['denominator']
-                }
-
-    return time_signatures_by_timestamp
-
-
-def generate_timesigs_for_events(chart):
-    time_signatures_by_timestamp = get_timesigs_by_timestamp(chart)
+    measure_rows = numpy.flatnonzero(chart.get_event_mask(["measure"]))
+    first_group = group_idx[measure_rows[0]] if len(measure_rows) else len(groups)
+    timesig_rows = numpy.where(group_idx > first_group, previous_rows, numpy.arange(len(chart)))
 
-    # Generate a time_signature field for everything based on timestamp
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        idx = [x for x in sorted(time_signatures_by_timestamp.keys(),
-                                 key=lambda x: int(x)) if int(x) <= int(k)][-1]
-        time_signature = time_signatures_by_timestamp[idx]
+    marker_rows = numpy.flatnonzero(chart.get_event_mask(["measure", "beat"]))
+    is_measure = numpy.isin(marker_rows, measure_rows).tolist()
+    steps = (1920 // denominators[timesig_rows[marker_rows]]).tolist()
+    marker_numerators = numerators[timesig_rows[marker_rows]].tolist()
 
-        for idx in range(len(chart['timestamp'][k])):
-            chart['timestamp'][k][idx]['time_signature'] = time_signature
-
-    return chart
-
-
-def generate_beats_by_timestamp(chart):
-    # Generate beats based on measures and line markers
-    current_timesig = {'numerator': 4, 'denominator': 4}
     current_measures = 0
     current_beats = 0
-    beats_by_timestamp = {}
-
     found_first = False
+    marker_beats = []
 
-    hold_timesig = None
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
+    for measure, step, numerator in zip(is_measure, steps, marker_numerators):
+        if measure:
+            if found_first:
+                current_beats = 0
+                current_measures += step * numerator
 
-            if not found_first:
-                current_timesig = beat['time_signature']
-                hold_timesig = current_timesig
-            else:
-                hold_timesig = beat['time_signature']
+            found_first = True
 
-            if name == "measure":
-                if found_first:
-                    current_beats = 0
-                    current_measures += (1920 // current_timesig['denominator']) * current_timesig['numerator']
-
-                found_first = True
-
-            if name == "beat":
-                current_beats += (1920 // current_timesig['denominator'])
+        else:
+            current_beats += step
 
-            if name in ["measure", "beat"]:
-                last_beat = current_measures + current_beats
-                beats_by_timestamp[timestamp] = last_beat
+        marker_beats.append(current_measures + current_beats)
 
-        current_timesig = hold_timesig
+    # Keep the last marker of each timestamp
+    marker_timestamps = chart.timestamp[marker_rows]
+    is_last = numpy.append(marker_timestamps[1:] != marker_timestamps[:-1], True) if len(marker_rows) else []
 
-    return beats_by_timestamp
+    return marker_timestamps[is_last], numpy.array(marker_beats, dtype=numpy.int64)[is_last]
 
 
 def correct_auto_notes(chart):
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] != "note":
-                continue
-
-            if beat['data']['note'] not in REVERSE_NOTE_MAPPING:
-                # Set all unknown events to auto play
-                REVERSE_NOTE_MAPPING[beat['data']['note']] = 0xff
+    rows = numpy.flatnonzero(chart.get_event_mask(["note"]))
+    if not numpy.all(chart.has_values('note', rows)):
+        raise KeyError('note')
 
-            is_auto_note = beat['data'].get('auto_note', 0)
-            is_auto_name = beat['data'].get('note', "auto") == "auto"
-            is_auto_mapping = REVERSE_NOTE_MAPPING[beat['data']['note']] == 0xff
+    # Set all unknown notes to auto play
+    note_codes = numpy.array([REVERSE_NOTE_MAPPING.get(note, 0xff) for note in chart.note_names], dtype=numpy.int64)
+    is_auto_note = numpy.array([bool(x) for x in chart.get_values('auto_note', rows, 0)], dtype=bool)
+    is_auto_name = chart.get_note_mask(["auto"])[rows]
+    is_auto_mapping = note_codes[chart.note[rows]] == 0xff
 
-            if is_auto_note or is_auto_name or is_auto_mapping:
-                beat['name'] = "auto"
+    chart.set_values('name', rows[is_auto_note | is_auto_name | is_auto_mapping], "auto")
 
     return chart
 
 
 def generate_beats_for_events(chart):
-    beats_by_timestamp = generate_beats_by_timestamp(chart)
-
-    # Set base beat for every event at timestamp
-    last_timestamp = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            beat['beat'] = beats_by_timestamp[last_timestamp]
-
-    last_timestamp = 0
-    cur_bpm = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] == "bpm":
-                cur_bpm = beat['data']['bpm']
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            keys = list(sorted(beats_by_timestamp.keys(), key=lambda x: int(x))) + [0]
-            next_timestamp = keys[keys.index(last_timestamp) + 1]
-            if timestamp not in beats_by_timestamp:
-                diff = int(timestamp_key) - last_timestamp
-                tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // beat['time_signature']['denominator'])
-
-                beat['beat'] = beat['beat'] + int(tf)
+    numerators, denominators = get_time_signatures(chart)
+    marker_timestamps, marker_beats = generate_beats_by_timestamp(chart, numerators, denominators)
+
+    # Events on a marker get its beat, everything else is offset from the last marker
+    # using the first BPM of the last timestamp that had one
+    marker_idx = numpy.searchsorted(marker_timestamps, chart.timestamp, side='right') - 1
+    if numpy.any(marker_idx < 0):
+        raise KeyError(0)
+
+    bpm_rows = numpy.flatnonzero(chart.get_event_mask(["bpm"]))
+    bpm_timestamps, first_bpm_rows = numpy.unique(chart.timestamp[bpm_rows], return_index=True)
+    bpms = numpy.array([0] + chart.get_values('bpm', bpm_rows[first_bpm_rows]), dtype=numpy.float64)
+    cur_bpm = bpms[numpy.searchsorted(bpm_timestamps, chart.timestamp, side='right')]
+
+    diff = chart.timestamp - marker_timestamps[marker_idx]
+    tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // denominators)
+
+    chart.set_values('beat', None, marker_beats[marker_idx] + tf.astype(numpy.int64))
 
     return chart
 
@@ -313,8 +249,6 @@ def generate_metadata_fields(metadata, chart):
     # Generate and add any important data that isn't guaranteed
     # to be there
 
-    # TODO: This code is slow
-
     # I know they're read, but I'm curious if these are actually
     # ever used in game or not. The required info can be calculated
     # using the time signature and deriving it from the value 1920.
@@ -326,50 +260,40 @@ def generate_metadata_fields(metadata, chart):
     if 'time_division' not in metadata['header']:
         metadata['header']['time_division'] = 300
 
-    chart_combined = combine_metadata_with_chart(metadata, chart)
-    chart_combined = generate_timesigs_for_events(chart_combined)
-    chart_combined = correct_auto_notes(chart_combined)
-    chart_combined = generate_beats_for_events(chart_combined)
+    # The metadata events go after the chart's own events at the same timestamp
+    chart_combined = correct_auto_notes(chart.merge(metadata))
 
-    return chart_combined
+    return generate_beats_for_events(chart_combined)
 
 
 def get_note_counts_from_json(chart, part):
     note_counts = {}
 
-    total_notes = 0
-    for k in chart['timestamp']:
-        for event in chart['timestamp'][k]:
-            if 'data' not in event:
-                continue
+    # Auto notes aren't counted
+    rows = numpy.flatnonzero(chart.get_event_mask(["note"]) & chart.has_values('note') & ~chart.get_note_mask(["auto"]))
+    rows = rows[numpy.array(chart.get_values('auto_note', rows), dtype=object) != 1]
 
-            is_note = event['name'] == "note"
-            is_auto = event['data'].get('note') == "auto"
-            is_auto_note = event['data'].get('auto_note') == 1
-
-            if is_note and not is_auto and not is_auto_note:
-                # Drum and guitar must be calculated separately because
-                # Guitar needs R G B Y P Open calculated by bit flag may be the most accurate
-
-                if part == "drum":
-                    if event['data']['note'] not in note_counts:
-                        note_counts[event['data']['note']] = 0
-                    note_counts[event['data']['note']] += 1
-                    total_notes += 1
-                elif part in ['guitar', 'bass']:
-                    n = event['data']['note'][2:]
-
-                    if n == "open":
-                        if n not in note_counts:
-                            note_counts[n] = 0
-                        note_counts[n] += 1
-                        total_notes += 1
-                    else:
-                        for note in [c for c in n if c != 'x']:
-                            if note not in note_counts:
-                                note_counts[note] = 0
-                            note_counts[note] += 1
-                        total_notes += 1
+    # Count each note name once, in the order the notes first appear
+    note_indexes, first_rows, counts = numpy.unique(chart.note[rows], return_index=True, return_counts=True)
+    order = numpy.argsort(first_rows)
+
+    for note_index, count in zip(note_indexes[order].tolist(), counts[order].tolist()):
+        note_name = chart.note_names[note_index]
+
+        # Drum and guitar must be calculated separately because
+        # Guitar needs R G B Y P Open calculated by bit flag may be the most accurate
+        if part == "drum":
+            note_counts[note_name] = note_counts.get(note_name, 0) + count
+        elif part in ['guitar', 'bass']:
+            n = note_name[2:]
+
+            if n == "open":
+                note_counts[n] = note_counts.get(n, 0) + count
+            else:
+                for note in [c for c in n if c != 'x']:
+                    note_counts[note] = note_counts.get(note, 0) + count
+
+    total_notes = len(rows) if part in ['drum', 'guitar', 'bass'] else 0
 
     return {'total': total_notes, 'notes': note_counts}
 
@@ -401,37 +325,47 @@ def create_preview(json_sq2, params, part):
     return running_threads
 
 
-def create_bgm_render(json_sq2, params, target_parts, output_bgm_filename):
-    def _create_bgm_render(params_bgm, target_parts, output_bgm_filename):
-        wav.generate_wav_from_json(params_bgm, generate_output_filename=False)
-        wavbintool.parse_wav(params_bgm['output'], output_bgm_filename)
+def create_bgm_renders(json_sq2, params, renders):
+    def _create_bgm_renders(params_bgm, bgm_renders, output_bgm_filenames):
+        wav.generate_bgm_renders(params_bgm, bgm_renders)
+
+        for (_, _, wav_filename), output_bgm_filename in zip(bgm_renders, output_bgm_filenames):
+            if os.path.exists(wav_filename):
+                wavbintool.parse_wav(wav_filename, output_bgm_filename)
 
-    print("Creating BGM render", target_parts)
+    print("Creating BGM renders", [target_parts for target_parts, _ in renders])
 
-    params_bgm = copy.deepcopy(params)
+    # The chart document is only read by the renders so it doesn't need to be copied
+    params_bgm = copy.copy(params)
     params_bgm['render_ext'] = "wav"
-    params_bgm['output'] = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
 
-    if os.path.exists(params_bgm['output']):
-        os.unlink(params_bgm['output'])
+    # All of the renders share the same keysounds and stems so they are made in one go
+    bgm_renders = []
+    output_bgm_filenames = []
+    for target_parts, output_bgm_filename in renders:
+        wav_filename = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
 
-    if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
-        params_bgm['render_ignore_auto'] = True
+        if os.path.exists(wav_filename):
+            os.unlink(wav_filename)
 
-    params_bgm['parts'] = target_parts
-    params_bgm['difficulty'] = ['max']
+        ignore_auto = params_bgm.get('render_ignore_auto', False)
+        if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
+            ignore_auto = True
+
+        bgm_renders.append((target_parts, ignore_auto, wav_filename))
+        output_bgm_filenames.append(output_bgm_filename)
 
     running_threads = []
 
     if USE_THREADS:
-        bgm_thread = threading.Thread(target=_create_bgm_render,
+        bgm_thread = threading.Thread(target=_create_bgm_renders,
                                       args=(params_bgm,
-                                            target_parts,
-                                            output_bgm_filename))
+                                            bgm_renders,
+                                            output_bgm_filenames))
         bgm_thread.start()
         running_threads.append(bgm_thread)
     else:
-        _create_bgm_render(params_bgm, target_parts, output_bgm_filename)
+        _create_bgm_renders(params_bgm, bgm_renders, output_bgm_filenames)
 
     return running_threads
 
@@ -476,13 +410,15 @@ def create_va3(json_sq2, params, part):
         va3_thread = threading.Thread(target=vas3tool.write_vas3,
                                       args=(params['sound_folder'],
                                             output_filename,
-                                            json_sq2['sound_metadata'][part]))
+                                            json_sq2['sound_metadata'][part],
+                                            params.get('sound_workers', 1)))
         va3_thread.start()
         running_threads.append(va3_thread)
     else:
         vas3tool.write_vas3(params['sound_folder'],
                             output_filename,
-                            json_sq2['sound_metadata'][part])
+                            json_sq2['sound_metadata'][part],
+                            params.get('sound_workers', 1))
 
     return running_threads
 
@@ -495,27 +431,27 @@ def create_event_file(json_sq2, params, charts):
     # easier to handle the data for multiple difficulties
     bonus_notes = {}
     for chart in charts:
-        for x in chart['timestamp']:
-            for x2 in chart['timestamp'][x]:
-                if not (x2['name'] == "note" and x2['data'].get('bonus_note', 0) == 1):
-                    continue
-
-                if x2['beat'] not in bonus_notes:
-                    bonus_notes[x2['beat']] = {}
-
-                gamelevel = 1 << chart['header']['difficulty']
-                if x2['data']['sound_id'] in bonus_notes[x2['beat']]:
-                    gamelevel |= bonus_notes[x2['beat']][x2['data']['sound_id']]['gamelevel']
-
-                bonus_notes[x2['beat']][x2['data']['sound_id']] = {
-                    'sound_id': x2['data']['sound_id'],
-                    'time': x2['beat'],
-                    'gamelevel': gamelevel,
-                }
+        rows = numpy.flatnonzero(chart.get_event_mask(["note"]))
+        rows = rows[numpy.array(chart.get_values('bonus_note', rows, 0), dtype=object) == 1]
+        gamelevel_bit = 1 << chart['header']['difficulty']
+
+        for beat, sound_id in zip(chart.get_values('beat', rows), chart.get_values('sound_id', rows)):
+            if beat not in bonus_notes:
+                bonus_notes[beat] = {}
+
+            gamelevel = gamelevel_bit
+            if sound_id in bonus_notes[beat]:
+                gamelevel |= bonus_notes[beat][sound_id]['gamelevel']
+
+            bonus_notes[beat][sound_id] = {
+                'sound_id': sound_id,
+                'time': beat,
+                'gamelevel': gamelevel,
+            }
 
     # Convert the dictionary into a flat list
     bonus_notes_flat = []
-    for beat in sorted(bonus_notes.keys(), key=lambda x: int(x)):
+    for beat in sorted(bonus_notes.keys()):
         for sound_id in bonus_notes[beat]:
             bonus_notes_flat.append(bonus_notes[beat][sound_id])
 
@@ -773,23 +709,22 @@ def create_sq2_file(json_sq2, params, target_parts, charts_data):
     # Create actual SQ2 data
     archive_size = 0x20 + (0x10 * len(charts_data)) + sum([len(x['data']) for x in charts_data])
 
-    output_data = [0] * 0x20
+    output_data = bytearray(archive_size)
     output_data[0x00:0x04] = b'SEQP'
     output_data[0x06] = 0x02
     output_data[0x0a] = 0x01
-    output_data[0x0c:0x10] = struct.pack("<I", archive_size)
-    output_data[0x14:0x18] = struct.pack("<I", json_sq2['musicid'])
-    output_data[0x18:0x1c] = struct.pack("<I", len(charts_data))
+    struct.pack_into("<I", output_data, 0x0c, archive_size)
+    struct.pack_into("<I", output_data, 0x14, json_sq2['musicid'])
+    struct.pack_into("<I", output_data, 0x18, len(charts_data))
 
-    output_data = bytearray(output_data)
+    offset = 0x20
     for chart_data in charts_data:
         data = chart_data['data']
 
-        file_header = [0] * 0x10
-        file_header[0x00:0x04] = struct.pack("<I", len(data) + 0x10)
+        struct.pack_into("<I", output_data, offset, len(data) + 0x10)
 
-        output_data += bytearray(file_header)
-        output_data += data
+        output_data[offset + 0x10:offset + 0x10 + len(data)] = data
+        offset += 0x10 + len(data)
 
     if 'drum' in target_parts:
         output_filename = 'd%04d.sq2' % (json_sq2['musicid'])
@@ -817,14 +752,17 @@ def create_sound_files(json_sq2, params, target_parts):
             output_bgm_filename = os.path.join(output_folder, 'bgm%04d___k.bin' % (json_sq2['musicid']))
             running_threads += create_bgm(json_sq2, params, output_bgm_filename)
 
+            bgm_renders = []
+
             if 'guitar' in target_parts or 'bass' in target_parts:
-                running_threads += create_bgm_render(json_sq2, params, ['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq2['musicid'])))
-                running_threads += create_bgm_render(json_sq2, params, ['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq2['musicid'])))
+                bgm_renders.append((['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq2['musicid']))))
+                bgm_renders.append((['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq2['musicid']))))
 
             if 'drum' in target_parts:
-                running_threads += create_bgm_render(json_sq2, params, ['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq2['musicid'])))
+                bgm_renders.append((['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq2['musicid']))))
 
-            running_threads += create_bgm_render(json_sq2, params, ['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq2['musicid'])))
+            bgm_renders.append((['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq2['musicid']))))
+            running_threads += create_bgm_renders(json_sq2, params, bgm_renders)
 
         else:
             if 'drum' in target_parts:
@@ -869,14 +807,16 @@ def create_sound_files(json_sq2, params, target_parts):
 
 
 def generate_sq2_file_from_json(params):
-    json_sq2 = json.loads(params['input']) if 'input' in params else None
+    json_sq2 = params['input'] if 'input' in params else None
 
     if not json_sq2:
         print("Couldn't find input data")
         return
 
+    charts = chartdata.get_charts(json_sq2)
+
     # Generate metadata charts for each chart
-    chart_metadata = [x for x in json_sq2['charts'] if x['header']['is_metadata'] == 1]
+    chart_metadata = [x for x in charts if x['header']['is_metadata'] == 1]
 
     if len(chart_metadata) == 0:
         print("Couldn't find metadata chart")
@@ -894,13 +834,13 @@ def generate_sq2_file_from_json(params):
         metadata_chart = chart_metadata[0]
 
         filtered_charts = [
-            generate_metadata_fields(metadata_chart, x) for x in json_sq2['charts']
+            generate_metadata_fields(metadata_chart, x) for x in charts
             if x['header']['is_metadata'] == 0
             and x['header']['game_type'] < len(parts)
             and parts[x['header']['game_type']] in valid_parts
         ]
 
-        found_parts += [parts[x['header']['game_type']] for x in json_sq2['charts'] if x['header']['is_metadata'] == 0]
+        found_parts += [parts[x['header']['game_type']] for x in charts if x['header']['is_metadata'] == 0]
 
         if len(filtered_charts) == 0:
             continue
@@ -945,119 +885,137 @@ def generate_sq2_file_from_json(params):
 
 
 def get_start_timestamp(chart):
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] in ["startpos"]:
-                return timestamp_key
-
-    return sorted(chart['timestamp'].keys(), key=lambda x: int(x))[0]
+    rows = numpy.flatnonzero(chart.get_event_mask(["startpos"]))
+    return chart.timestamp[rows[0] if len(rows) > 0 else 0]
 
 
 def get_end_timestamp(chart):
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] in ["endpos"]:
-                return timestamp_key
-
-    return sorted(chart['timestamp'].keys(), key=lambda x: int(x))[-1]
+    rows = numpy.flatnonzero(chart.get_event_mask(["endpos"]))
+    return chart.timestamp[rows[0] if len(rows) > 0 else -1]
+
+
+# Layout of a single SEQT event entry.
+# The fields at 0x08 and 0x0c overlap depending on the event type:
+# bpm events store microseconds per minute, barinfo events store the time signature
+# and note events store the sound id and volume.
+SQ2_EVENT_FIELDS = [
+    ('timestamp', '<u4', 0x00),
+    ('note', 'u1', 0x04),
+    ('id', 'u1', 0x05),
+    ('bpm_mpm', '<u4', 0x08),
+    ('sound_id', '<u2', 0x08),
+    ('sound_unk', '<u2', 0x0a),
+    ('volume', 'u1', 0x0c),
+    ('numerator', 'u1', 0x0c),
+    ('denominator_orig', 'u1', 0x0d),
+]
+
+SQ2_EVENT_DTYPE = numpy.dtype({
+    'names': [x[0] for x in SQ2_EVENT_FIELDS],
+    'formats': [x[1] for x in SQ2_EVENT_FIELDS],
+    'offsets': [x[2] for x in SQ2_EVENT_FIELDS],
+    'itemsize': 0x10,
+})
+
+
+def write_event_table(output_data, offset, count, columns):
+    # Fill the event entries in place, one bulk write per field
+    entries = numpy.frombuffer(output_data, dtype=SQ2_EVENT_DTYPE, count=count, offset=offset)
+
+    for field in columns:
+        rows, values = columns[field]
+        entries[field][rows] = values
 
 
 def generate_sq2_chart_data_from_json(chart):
     metadata = True if chart['header']['is_metadata'] == 1 else False
 
-    event_data = []
-    found_events = []
-
-    start_timestamp = int(get_start_timestamp(chart))
-    end_timestamp = int(get_end_timestamp(chart))
-
-    # Handle events based on beat offset in ascending order
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        if int(timestamp_key) < start_timestamp or int(timestamp_key) > end_timestamp:
-            continue
-
-        for beat in chart['timestamp'][timestamp_key]:
-            chart_events = [
-                "chipstart",
-                "chipend",
-                "startpos",
-                "endpos",
-                "note",
-                "auto"
-            ]
-
-            metadata_events = [
-                "meta",
-                "bpm",
-                "barinfo",
-                "baron",
-                "baroff",
-                "measure",
-                "beat",
-                "startpos",
-                "endpos"
-            ]
-
-            if not metadata and beat['name'] not in chart_events:
-                continue
-
-            elif metadata and beat['name'] not in metadata_events:
-                continue
-
-            if beat['name'] in ["startpos", "endpos"] and EVENT_ID_REVERSE[beat['name']] in found_events:
-                # Don't duplicate these events
-                continue
-
-            found_events.append(EVENT_ID_REVERSE[beat['name']])
-
-            mdata = [0] * 0x10
-
-            mdata[0x00:0x04] = struct.pack("<I", int(timestamp_key))
-            mdata[0x05] = EVENT_ID_REVERSE[beat['name']] & 0xff
+    chart_events = [
+        "chipstart",
+        "chipend",
+        "startpos",
+        "endpos",
+        "note",
+        "auto"
+    ]
+
+    metadata_events = [
+        "meta",
+        "bpm",
+        "barinfo",
+        "baron",
+        "baroff",
+        "measure",
+        "beat",
+        "startpos",
+        "endpos"
+    ]
+
+    start_timestamp = get_start_timestamp(chart)
+    end_timestamp = get_end_timestamp(chart)
+
+    # Events are already in ascending timestamp order
+    is_valid = (chart.timestamp >= start_timestamp) & (chart.timestamp <= end_timestamp)
+    is_valid &= chart.get_event_mask(metadata_events if metadata else chart_events)
+
+    # Don't duplicate these events
+    for name in ["startpos", "endpos"]:
+        duplicates = numpy.flatnonzero(is_valid & chart.get_event_mask([name]))[1:]
+        is_valid[duplicates] = False
+
+    rows = numpy.flatnonzero(is_valid)
+    event_count = len(rows)
+
+    def get_event_rows(names):
+        # Output positions and chart rows of the events with the given names
+        is_event = chart.get_event_mask(names)[rows]
+        return numpy.flatnonzero(is_event), rows[is_event]
+
+    # Event fields are collected by column and only written once the event count is known
+    event_ids = numpy.zeros(len(chart.event_names), dtype=numpy.uint8)
+    for event in numpy.unique(chart.event[rows]).tolist():
+        event_ids[event] = EVENT_ID_REVERSE[chart.event_names[event]] & 0xff
+
+    columns = {
+        'timestamp': (slice(None), chart.timestamp[rows].astype(numpy.int64)),
+        'id': (slice(None), event_ids[chart.event[rows]]),
+    }
 
-            if beat['name'] == "meta":
-                # How to handle?
-                pass
-            elif beat['name'] == "bpm":
-                mdata[0x08:0x0c] = struct.pack("<I", int(round(60000000 / beat['data']['bpm'])))
+    positions, event_rows = get_event_rows(["bpm"])
+    columns['bpm_mpm'] = (positions, [int(round(60000000 / bpm)) for bpm in chart.get_values('bpm', event_rows)])
 
-            elif beat['name'] == "barinfo":
-                mdata[0x0c] = beat['data']['numerator'] & 0xff
+    positions, event_rows = get_event_rows(["barinfo"])
+    columns['numerator'] = (positions, [x & 0xff for x in chart.get_values('numerator', event_rows)])
 
-                denominator = 1 << (beat['data']['denominator'].bit_length() - 1)
-                if denominator != beat['data']['denominator']:
-                    raise Exception("ERROR: The time signature denominator must be divisible by 2."
-                                    "Found {}".format(beat['data']['denominator']))
+    denominators = chart.get_values('denominator', event_rows)
+    for denominator in denominators:
+        if 1 << (denominator.bit_length() - 1) != denominator:
+            raise Exception("ERROR: The time signature denominator must be divisible by 2."
+                            "Found {}".format(denominator))
 
-                mdata[0x0d] = (beat['data']['denominator'].bit_length() - 1) & 0xff
+    columns['denominator_orig'] = (positions, [(x.bit_length() - 1) & 0xff for x in denominators])
 
-            elif beat['name'] == "note":
-                mdata[0x08:0x0A] = struct.pack("<H", beat['data'].get('sound_id', 0))
-                mdata[0x0A:0x0c] = struct.pack("<H", beat['data'].get('sound_unk', 0))
-                mdata[0x0c] = beat['data'].get('volume', 0) & 0xff
+    positions, event_rows = get_event_rows(["note", "auto"])
+    columns['sound_id'] = (positions, chart.get_values('sound_id', event_rows, 0))
+    columns['sound_unk'] = (positions, chart.get_values('sound_unk', event_rows, 0))
+    columns['volume'] = (positions, [x & 0xff for x in chart.get_values('volume', event_rows, 0)])
 
-                if 'note' in beat['data']:
-                    if REVERSE_NOTE_MAPPING[beat['data']['note']] == 0xff:
-                        beat['name'] = "auto"
-                        mdata[0x04] = 0
-                        mdata[0x05] = EVENT_ID_REVERSE["auto"] & 0xff
-                    else:
-                        mdata[0x04] = REVERSE_NOTE_MAPPING[beat['data']['note']] & 0xff
+    # Notes without a mapping are written as auto notes
+    is_note = chart.get_event_mask(["note"])[event_rows] & chart.has_values('note', event_rows)
+    positions, event_rows = positions[is_note], event_rows[is_note]
 
-            elif beat['name'] == "auto":
-                mdata[0x04] = 0
-                mdata[0x08:0x0A] = struct.pack("<H", beat['data'].get('sound_id', 0))
-                mdata[0x0A:0x0c] = struct.pack("<H", beat['data'].get('sound_unk', 0))
-                mdata[0x0c] = beat['data'].get('volume', 0) & 0xff
+    note_codes = numpy.array([REVERSE_NOTE_MAPPING.get(note, 0xff) & 0xff for note in chart.note_names], dtype=numpy.uint8)[chart.note[event_rows]]
+    is_auto = note_codes == 0xff
 
-            event_data.append(bytearray(mdata))
+    columns['id'][1][positions[is_auto]] = EVENT_ID_REVERSE["auto"]
+    columns['note'] = (positions[~is_auto], note_codes[~is_auto])
 
-    output_data = [0] * 0x20
+    output_data = bytearray(0x20 + event_count * 0x10)
     output_data[0x00:0x04] = b'SEQT'
     output_data[0x06] = 0x02  # SQ2 flag
     output_data[0x0a] = 0x01  # SQ2 flag 2?
-    output_data[0x0c:0x10] = struct.pack("<I", 0x20)  # Size of header
-    output_data[0x10:0x14] = struct.pack("<I", len(event_data))  # Number of events
+    struct.pack_into("<I", output_data, 0x0c, 0x20)  # Size of header
+    struct.pack_into("<I", output_data, 0x10, event_count)  # Number of events
     output_data[0x14] = chart['header']['unk_sys'] & 0xff
     output_data[0x15] = chart['header']['is_metadata'] & 0xff
     output_data[0x16] = chart['header']['difficulty'] & 0xff
@@ -1067,9 +1025,7 @@ def generate_sq2_chart_data_from_json(chart):
         output_data[0x15] = 0x01
         output_data[0x16] = 0x01
 
-    output_data = bytearray(output_data)
-    for data in event_data:
-        output_data += data
+    write_event_table(output_data, 0x20, event_count, columns)
 
     return output_data
 
@@ -1077,74 +1033,80 @@ def generate_sq2_chart_data_from_json(chart):
 ########################
 #   SQ2 parsing code   #
 ########################
-def parse_event_block(mdata, game, difficulty, events={}, is_metadata=False):
-    packet_data = {}
-
-    timestamp = struct.unpack("<I", mdata[0x00:0x04])[0]
-    game_type_id = {"drum": 0, "guitar": 1, "bass": 2, "open": 3}[game]
-
-    event_name = EVENT_ID_MAP[mdata[0x05]]
-
-    if mdata[0x05] == 0x10:
-        bpm_bpm = struct.unpack("<I", mdata[0x08:0x0c])[0]
-        packet_data['bpm'] = 60000000 / bpm_bpm
-    elif mdata[0x05] == 0x20:
-        # Time signature is represented as numerator/(1<<denominator)
-        packet_data['numerator'] = mdata[0x0c]
-        packet_data['denominator'] = 1 << mdata[0x0d]
-    elif mdata[0x05] == 0x00:
-        packet_data['sound_id'] = struct.unpack("<H", mdata[0x08:0x0A])[0]
-        packet_data['sound_unk'] = struct.unpack("<H", mdata[0x0A:0x0C])[0]
-        packet_data['volume'] = mdata[0x0c]
-
-        if (mdata[0x04] & 0x10) == 0x10:
-            # Open note
-            packet_data['note'] = NOTE_MAPPING[game][mdata[0x04] & 0x10] # note
-        else:
-            packet_data['note'] = NOTE_MAPPING[game][mdata[0x04] & 0x0f] # note
+def get_lookup_table(mapping):
+    table = numpy.full(0x100, None, dtype=object)
 
-        is_wail = (mdata[0x04] & 0x20) == 0x20
+    for k in mapping:
+        table[k] = mapping[k]
 
-        packet_data['wail_misc'] = 1 if is_wail else 0
-        packet_data['guitar_special'] = 1 if is_wail else 0
+    return table
 
-        # TODO: Update code to work with .EVT file data
-        # if beat in events:
-        #     for event in events[beat]:
-        #         is_gametype = event['game_type'] == game_type_id
-        #         is_eventtype = event['event_type'] == 0
-        #         is_note = packet_data['sound_id'] == event['note']
-        #         is_diff = (event['gamelevel'] & (1 << difficulty)) != 0
 
-        #         if is_gametype and is_eventtype and is_note and is_diff:
-        #             packet_data['bonus_note'] = True
+EVENT_NAME_TABLE = get_lookup_table(EVENT_ID_MAP)
+NOTE_NAME_TABLES = {k: get_lookup_table(NOTE_MAPPING[k]) for k in NOTE_MAPPING}
 
-        if is_metadata:
-            event_name = "meta"
 
-    elif mdata[0x05] == 0x01:
-        # Auto note
-        packet_data['sound_id'] = struct.unpack("<H", mdata[0x08:0x0A])[0]
-        packet_data['sound_unk'] = struct.unpack("<H", mdata[0x0A:0x0C])[0]
-        packet_data['volume'] = mdata[0x0c]
-        packet_data['note'] = "auto"
-        packet_data['auto_volume'] = 1
-        packet_data['auto_note'] = 1
-        event_name = "note"
+def parse_event_blocks(entries, game, difficulty, events={}, is_metadata=False, info=None):
+    event_ids = entries['id']
+    is_note = event_ids == 0x00
+    is_auto = event_ids == 0x01
 
-    return {
-        "id": mdata[0x04],
-        "name": event_name,
-        'timestamp': struct.unpack("<I", mdata[0x00:0x04])[0],
-        "data": packet_data
-    }
+    names = EVENT_NAME_TABLE[event_ids]
+    unknown = numpy.flatnonzero(numpy.equal(names, None))
+    if len(unknown) > 0:
+        raise KeyError(int(event_ids[unknown[0]]))
 
+    # Open notes use the 0x10 bit, everything else is in the low nibble
+    note_ids = numpy.where(entries['note'] & 0x10, 0x10, entries['note'] & 0x0f)
+    notes = NOTE_NAME_TABLES[game][note_ids]
+    unknown = numpy.flatnonzero(numpy.equal(notes, None) & is_note)
+    if len(unknown) > 0:
+        raise KeyError(int(note_ids[unknown[0]]))
 
-def read_sq2_data(data, events):
-    output = {
-        "beat_data": []
-    }
+    notes[is_auto] = "auto"
+    names[is_auto] = "note"
+
+    if is_metadata:
+        names[is_note] = "meta"
+
+    is_bpm = event_ids == 0x10
+    bpms = numpy.zeros(len(entries), dtype=numpy.float64)
+    bpms[is_bpm] = 60000000 / entries['bpm_mpm'][is_bpm].astype(numpy.float64)
+
+    is_wail = (entries['note'] & 0x20 == 0x20).astype(numpy.uint8)
+
+    columns = {name: entries[name] for name in entries.dtype.names}
+    columns['note'] = notes
+    columns['bpm'] = bpms
+    # Time signature is represented as numerator/(1<<denominator)
+    columns['denominator'] = numpy.left_shift(1, entries['denominator_orig'].astype(numpy.uint32))
+    columns['wail_misc'] = is_wail
+    columns['guitar_special'] = is_wail
+    columns['auto_volume'] = numpy.ones(len(entries), dtype=numpy.uint8)
+    columns['auto_note'] = columns['auto_volume']
+
+    order = numpy.argsort(entries['timestamp'], kind='stable')
+    columns = {k: v[order] for k, v in columns.items()}
+
+    chart = chartdata.ChartData.from_columns(info, columns['timestamp'], names[order], {
+        'id': entries['note'][order],
+    })
+
+    def set_fields(is_event, fields):
+        for field in fields:
+            chart.set_values(field, is_event, columns[field][is_event])
+
+    set_fields(columns['id'] == 0x10, ['bpm'])
+    set_fields(columns['id'] == 0x20, ['numerator', 'denominator'])
+
+    # TODO: Update code to work with .EVT file data
+    set_fields(columns['id'] == 0x00, ['sound_id', 'sound_unk', 'volume', 'note', 'wail_misc', 'guitar_special'])
+    set_fields(columns['id'] == 0x01, ['sound_id', 'sound_unk', 'volume', 'note', 'auto_volume', 'auto_note'])
+
+    return chart
 
+
+def read_sq2_data(data, events):
     if data is None:
         return None
 
@@ -1159,63 +1121,37 @@ def read_sq2_data(data, events):
     entry_count = struct.unpack("<I", data[0x10:0x14])[0]
     time_division = 300
     beat_division = 480
-    entry_size = 0x10
 
     if is_metadata not in [0, 1]: # Only support metadata and note charts. Not sure what type 2 is yet
         return None
 
-    output['header'] = {
-        "unk_sys": unk_sys,
-        "is_metadata": is_metadata,
-        "difficulty": difficulty,
-        "game_type": game_type,
-        "time_division": time_division,
-        "beat_division": beat_division,
+    info = {
+        'header': {
+            "unk_sys": unk_sys,
+            "is_metadata": is_metadata,
+            "difficulty": difficulty,
+            "game_type": game_type,
+            "time_division": time_division,
+            "beat_division": beat_division,
+        }
     }
 
-    for i in range(entry_count):
-        mdata = data[header_size + (i * entry_size):header_size + (i * entry_size) + entry_size]
-        part = ["drum", "guitar", "bass", "open"][game_type]
-        parsed_data = parse_event_block(mdata, part, difficulty, events, is_metadata=is_metadata)
-        output['beat_data'].append(parsed_data)
-
-    return output
-
-
-def convert_to_timestamp_chart(chart):
-    chart['timestamp'] = {}
+    entries = numpy.frombuffer(data, dtype=SQ2_EVENT_DTYPE, count=entry_count, offset=header_size)
+    part = ["drum", "guitar", "bass", "open"][game_type]
 
-    for x in chart['beat_data']:
-        if x['timestamp'] not in chart['timestamp']:
-            chart['timestamp'][x['timestamp']] = []
-
-        beat = x['timestamp']
-        del x['timestamp']
-
-        chart['timestamp'][beat].append(x)
-
-    del chart['beat_data']
-
-    return chart
+    return parse_event_blocks(entries, part, difficulty, events, is_metadata, info)
 
 
 def parse_chart_intermediate(chart, events):
     chart_raw = read_sq2_data(chart, events)
 
-    if not chart_raw:
+    if chart_raw is None:
         return None
 
-    chart_raw = convert_to_timestamp_chart(chart_raw)
+    start_timestamp = get_start_timestamp(chart_raw)
+    end_timestamp = get_end_timestamp(chart_raw)
 
-    start_timestamp = int(get_start_timestamp(chart_raw))
-    end_timestamp = int(get_end_timestamp(chart_raw))
-
-    # Handle events based on beat offset in ascending order
-    for timestamp_key in sorted(chart_raw['timestamp'].keys(), key=lambda x: int(x)):
-        if int(timestamp_key) < start_timestamp or int(timestamp_key) > end_timestamp:
-            del chart_raw['timestamp'][timestamp_key]
-
-    return chart_raw
+    return chart_raw.select((chart_raw.timestamp >= start_timestamp) & (chart_raw.timestamp <= end_timestamp))
 
 
 def add_song_info(charts, music_id, music_db):
@@ -1326,7 +1262,7 @@ def combine_guitar_charts(guitar_charts, bass_charts):
     # Combine guitar and bass charts
     parsed_bass_charts = []
 
-    for chart in guitar_charts:
+    for chart_idx, chart in enumerate(guitar_charts):
         # Find equivalent chart
         for chart2 in bass_charts:
             if chart['header']['difficulty'] != chart2['header']['difficulty']:
@@ -1339,17 +1275,13 @@ def combine_guitar_charts(guitar_charts, bass_charts):
                 for k in chart2['header']['level']:
                     chart['header']['level'][k] = chart2['header']['level'][k]
 
-                for event in chart2['timestamp'][timestamp_key]:
-                    if event['name'] != "note":
-                        continue
-
-                    if timestamp_key not in chart['timestamp']:
-                        chart['timestamp'][timestamp_key] = []
-
-                    chart['timestamp'][timestamp_key].append(event)
+            # Add all bass notes to guitar chart data
+            chart = chart.merge(chart2.select(chart2.get_event_mask(["note"])))
 
             parsed_bass_charts.append(chart2)
 
+        guitar_charts[chart_idx] = chart
+
     for chart in parsed_bass_charts:
         bass_charts.remove(chart)
 
@@ -1365,13 +1297,15 @@ def add_note_durations(chart, sound_metadata):
     for entry in sound_metadata['entries']:
         duration_lookup[entry['sound_id']] = entry.get('duration', 0)
 
-    for k in chart['timestamp']:
-        for i in range(0, len(chart['timestamp'][k])):
-            if chart['timestamp'][k][i]['name'] in ['note', 'auto']:
-                chart['timestamp'][k][i]['data']['note_length'] = int(round(duration_lookup.get(chart['timestamp'][k][i]['data']['sound_id'], 0) * 300))
+    rows = numpy.flatnonzero(chart.get_event_mask(['note', 'auto']))
+    if not numpy.all(chart.has_values('sound_id', rows)):
+        raise KeyError('sound_id')
+
+    chart.set_values('note_length', rows, [int(round(duration_lookup.get(sound_id, 0) * 300)) for sound_id in chart.get_values('sound_id', rows)])
 
     return chart
 
+
 def generate_json_from_sq2(params):
     combine_guitars = params['merge_guitars'] if 'merge_guitars' in params else False
     data = open(params['input'], "rb").read() if 'input' in params else None
@@ -1429,7 +1363,7 @@ def generate_json_from_sq2(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Sq2Format:
@@ -1445,21 +1379,6 @@ class Sq2Format:
     def to_chart(params):
         generate_sq2_file_from_json(params)
 
-    @staticmethod
-    def is_format(filename):
-        header = open(filename, "rb").read(0x40)
-
-        try:
-            is_seqp = header[0x00:0x04].decode('ascii') == "SEQP"
-            is_seqt = header[0x30:0x34].decode('ascii') == "SEQT"
-            is_ver2 = header[0x36] == 0x02
-            if is_seqp and is_ver2 and is_seqt:
-                return True
-        except:
-            return False
-
-        return False
-
 
 def get_class():
     return Sq2Format
@@ -1,5 +1,6 @@
 import copy
 import json
+import numpy
 import os
 import shutil
 import struct
@@ -8,6 +9,7 @@ from lxml import etree
 from lxml.builder import E
 import uuid
 
+import chartdata
 import helper
 import mdb
 import eamxml
@@ -246,140 +248,78 @@ REVERSE_NOTE_MAPPING = {
 }
 
 
-def combine_metadata_with_chart(metadata, chart):
-    chart_combined = copy.deepcopy(chart)
+def get_time_signatures(chart):
+    # Time signature of every event, taken from the last barinfo event at or before it
+    barinfo_rows = numpy.flatnonzero(chart.get_event_mask(["barinfo"]))
+    numerators = numpy.array([4] + chart.get_values('numerator', barinfo_rows), dtype=numpy.int64)
+    denominators = numpy.array([4] + chart.get_values('denominator', barinfo_rows), dtype=numpy.int64)
 
-    for timestamp_key in sorted(metadata['timestamp'].keys(), key=lambda x: int(x)):
-        if timestamp_key not in chart_combined['timestamp']:
-            chart_combined['timestamp'][timestamp_key] = []
+    idx = numpy.searchsorted(chart.timestamp[barinfo_rows], chart.timestamp, side='right')
 
-        for d in metadata['timestamp'][timestamp_key]:
-            chart_combined['timestamp'][timestamp_key].append(d)
+    return numerators[idx], denominators[idx]
 
-    return chart_combined
 
+def generate_beats_by_timestamp(chart, numerators, denominators):
+    # Generate beats based on measures and line markers.
+    # Until the first measure a marker uses its own time signature, after that it uses
+    # the time signature of the previous timestamp.
+    groups = chart.get_timestamp_groups()
+    group_idx = numpy.searchsorted(groups, numpy.arange(len(chart)), side='right') - 1
+    previous_rows = groups[numpy.maximum(group_idx - 1, 0)]
 
-def get_timesigs_by_timestamp(chart_combined):
-    time_signatures_by_timestamp = {
-        0: {
-            'numerator': 4,
-            'denominator': 4,
-            'timesig': 1,
-        }
-    }
-
-    for k in sorted(chart_combined['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart_combined['timestamp'][k]:
-            if beat['name'] == "barinfo":
-                time_signatures_by_timestamp[k] = {
-                    'numerator': beat['data']['numerator'],
-                    'denominator': beat['data']['denominator'],
-                    'timesig': beat['data']['numerator'] / beat['data']['denominator']
-                }
-
-    return time_signatures_by_timestamp
-
-
-def generate_timesigs_for_events(chart):
-    time_signatures_by_timestamp = get_timesigs_by_timestamp(chart)
-
-    # Generate a time_signature field for everything based on timestamp
-    for k in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        idx = [x for x in sorted(time_signatures_by_timestamp.keys(),
-                                 key=lambda x: int(x)) if int(x) <= int(k)][-1]
-        time_signature = time_signatures_by_timestamp[idx]
+    measure_rows = numpy.flatnonzero(chart.get_event_mask(["measure"]))
+    first_group = group_idx[measure_rows[0]] if len(measure_rows) else len(groups)
+    timesig_rows = numpy.where(group_idx > first_group, previous_rows, numpy.arange(len(chart)))
 
-        for idx in range(len(chart['timestamp'][k])):
-            chart['timestamp'][k][idx]['time_signature'] = time_signature
+    marker_rows = numpy.flatnonzero(chart.get_event_mask(["measure", "beat"]))
+    is_measure = numpy.isin(marker_rows, measure_rows).tolist()
+    steps = (1920 // denominators[timesig_rows[marker_rows]]).tolist()
+    marker_numerators = numerators[timesig_rows[marker_rows]].tolist()
 
-    return chart
-
-
-def generate_beats_by_timestamp(chart):
-    # Generate beats based on measures and line markers
-    current_timesig = {'numerator': 4, 'denominator': 4}
     current_measures = 0
     current_beats = 0
-    beats_by_timestamp = {}
-
     found_first = False
+    marker_beats = []
 
-    hold_timesig = None
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
+    for measure, step, numerator in zip(is_measure, steps, marker_numerators):
+        if measure:
+            if found_first:
+                current_beats = 0
+                current_measures += step * numerator
 
-            if not found_first:
-                current_timesig = beat['time_signature']
-                hold_timesig = current_timesig
-            else:
-                hold_timesig = beat['time_signature']
+            found_first = True
 
-            if name == "measure":
-                if found_first:
-                    current_beats = 0
-                    current_measures += (1920 // current_timesig['denominator']) * current_timesig['numerator']
+        else:
+            current_beats += step
 
-                found_first = True
+        marker_beats.append(current_measures + current_beats)
 
-            if name == "beat":
-                current_beats += (1920 // current_timesig['denominator'])
+    # Keep the last marker of each timestamp
+    marker_timestamps = chart.timestamp[marker_rows]
+    is_last = numpy.append(marker_timestamps[1:] != marker_timestamps[:-1], True) if len(marker_rows) else []
 
-            if name in ["measure", "beat"]:
-                last_beat = current_measures + current_beats
-                beats_by_timestamp[timestamp] = last_beat
+    return marker_timestamps[is_last], numpy.array(marker_beats, dtype=numpy.int64)[is_last]
 
-        current_timesig = hold_timesig
 
-    return beats_by_timestamp
+def generate_beats_for_events(chart):
+    numerators, denominators = get_time_signatures(chart)
+    marker_timestamps, marker_beats = generate_beats_by_timestamp(chart, numerators, denominators)
 
+    # Events on a marker get its beat, everything else is offset from the last marker
+    # using the first BPM of the last timestamp that had one
+    marker_idx = numpy.searchsorted(marker_timestamps, chart.timestamp, side='right') - 1
+    if numpy.any(marker_idx < 0):
+        raise KeyError(0)
 
-def generate_beats_for_events(chart):
-    beats_by_timestamp = generate_beats_by_timestamp(chart)
-
-    # Set base beat for every event at timestamp
-    last_timestamp = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            beat['beat'] = beats_by_timestamp[last_timestamp]
-
-    last_timestamp = 0
-    cur_bpm = 0
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            if timestamp in beats_by_timestamp:
-                last_timestamp = timestamp
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] == "bpm":
-                cur_bpm = beat['data']['bpm']
-                break
-
-        for beat in chart['timestamp'][timestamp_key]:
-            name = beat['name']
-            timestamp = int(timestamp_key)
-
-            keys = list(sorted(beats_by_timestamp.keys(), key=lambda x: int(x))) + [0]
-            next_timestamp = keys[keys.index(last_timestamp) + 1]
-            if timestamp not in beats_by_timestamp:
-                diff = int(timestamp_key) - last_timestamp
-                tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // beat['time_signature']['denominator'])
-
-                beat['beat'] = beat['beat'] + int(tf)
+    bpm_rows = numpy.flatnonzero(chart.get_event_mask(["bpm"]))
+    bpm_timestamps, first_bpm_rows = numpy.unique(chart.timestamp[bpm_rows], return_index=True)
+    bpms = numpy.array([0] + chart.get_values('bpm', bpm_rows[first_bpm_rows]), dtype=numpy.float64)
+    cur_bpm = bpms[numpy.searchsorted(bpm_timestamps, chart.timestamp, side='right')]
+
+    diff = chart.timestamp - marker_timestamps[marker_idx]
+    tf = ((diff / 300) * (cur_bpm / 60)) * (1920 // denominators)
+
+    chart.set_values('beat', None, marker_beats[marker_idx] + tf.astype(numpy.int64))
 
     return chart
 
@@ -388,8 +328,6 @@ def generate_metadata_fields(metadata, chart):
     # Generate and add any important data that isn't guaranteed
     # to be there (namely, beat markers for SQ3)
 
-    # TODO: This code is slow
-
     # I know they're read, but I'm curious if these are actually
     # ever used in game or not. The required info can be calculated
     # using the time signature and deriving it from the value 1920.
@@ -401,49 +339,38 @@ def generate_metadata_fields(metadata, chart):
     if 'time_division' not in metadata['header']:
         metadata['header']['time_division'] = 300
 
-    chart_combined = combine_metadata_with_chart(metadata, chart)
-    chart_combined = generate_timesigs_for_events(chart_combined)
-    chart_combined = generate_beats_for_events(chart_combined)
-
-    return chart_combined
+    # The metadata events go after the chart's own events at the same timestamp
+    return generate_beats_for_events(chart.merge(metadata))
 
 
 def get_note_counts_from_json(chart, part):
     note_counts = {}
 
-    total_notes = 0
-    for k in chart['timestamp']:
-        for event in chart['timestamp'][k]:
-            if 'data' not in event:
-                continue
+    # Auto notes aren't counted
+    rows = numpy.flatnonzero(chart.get_event_mask(["note"]) & chart.has_values('note') & ~chart.get_note_mask(["auto"]))
+    rows = rows[numpy.array(chart.get_values('auto_note', rows), dtype=object) != 1]
+
+    # Count each note name once, in the order the notes first appear
+    note_indexes, first_rows, counts = numpy.unique(chart.note[rows], return_index=True, return_counts=True)
+    order = numpy.argsort(first_rows)
+
+    for note_index, count in zip(note_indexes[order].tolist(), counts[order].tolist()):
+        note_name = chart.note_names[note_index]
+
+        # Drum and guitar must be calculated separately because
+        # Guitar needs R G B Y P Open calculated by bit flag may be the most accurate
+        if part == "drum":
+            note_counts[note_name] = note_counts.get(note_name, 0) + count
+        elif part in ['guitar', 'bass']:
+            n = note_name[2:]
+
+            if n == "open":
+                note_counts[n] = note_counts.get(n, 0) + count
+            else:
+                for note in [c for c in n if c != 'x']:
+                    note_counts[note] = note_counts.get(note, 0) + count
 
-            is_note = event['name'] == "note"
-            is_auto = event['data'].get('note') == "auto"
-            is_auto_note = event['data'].get('auto_note') == 1
-
-            if is_note and not is_auto and not is_auto_note:
-                # Drum and guitar must be calculated separately because
-                # Guitar needs R G B Y P Open calculated by bit flag may be the most accurate
-
-                if part == "drum":
-                    if event['data']['note'] not in note_counts:
-                        note_counts[event['data']['note']] = 0
-                    note_counts[event['data']['note']] += 1
-                    total_notes += 1
-                elif part in ['guitar', 'bass']:
-                    n = event['data']['note'][2:]
-
-                    if n == "open":
-                        if n not in note_counts:
-                            note_counts[n] = 0
-                        note_counts[n] += 1
-                        total_notes += 1
-                    else:
-                        for note in [c for c in n if c != 'x']:
-                            if note not in note_counts:
-                                note_counts[note] = 0
-                            note_counts[note] += 1
-                        total_notes += 1
+    total_notes = len(rows) if part in ['drum', 'guitar', 'bass'] else 0
 
     return {'total': total_notes, 'notes': note_counts}
 
@@ -475,37 +402,47 @@ def create_preview(json_sq3, params, part):
     return running_threads
 
 
-def create_bgm_render(json_sq3, params, target_parts, output_bgm_filename):
-    def _create_bgm_render(params_bgm, target_parts, output_bgm_filename):
-        wav.generate_wav_from_json(params_bgm, generate_output_filename=False)
-        wavbintool.parse_wav(params_bgm['output'], output_bgm_filename)
+def create_bgm_renders(json_sq3, params, renders):
+    def _create_bgm_renders(params_bgm, bgm_renders, output_bgm_filenames):
+        wav.generate_bgm_renders(params_bgm, bgm_renders)
 
-    print("Creating BGM render", target_parts)
+        for (_, _, wav_filename), output_bgm_filename in zip(bgm_renders, output_bgm_filenames):
+            if os.path.exists(wav_filename):
+                wavbintool.parse_wav(wav_filename, output_bgm_filename)
 
-    params_bgm = copy.deepcopy(params)
+    print("Creating BGM renders", [target_parts for target_parts, _ in renders])
+
+    # The chart document is only read by the renders so it doesn't need to be copied
+    params_bgm = copy.copy(params)
     params_bgm['render_ext'] = "wav"
-    params_bgm['output'] = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
 
-    if os.path.exists(params_bgm['output']):
-        os.unlink(params_bgm['output'])
+    # All of the renders share the same keysounds and stems so they are made in one go
+    bgm_renders = []
+    output_bgm_filenames = []
+    for target_parts, output_bgm_filename in renders:
+        wav_filename = tmpfile.mkstemp(suffix="." + params_bgm.get('render_ext', 'wav'))
+
+        if os.path.exists(wav_filename):
+            os.unlink(wav_filename)
 
-    if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
-        params_bgm['render_ignore_auto'] = True
+        ignore_auto = params_bgm.get('render_ignore_auto', False)
+        if 'guitar' in target_parts or 'bass' in target_parts or 'open' in target_parts:
+            ignore_auto = True
 
-    params_bgm['parts'] = target_parts
-    params_bgm['difficulty'] = ['max']
+        bgm_renders.append((target_parts, ignore_auto, wav_filename))
+        output_bgm_filenames.append(output_bgm_filename)
 
     running_threads = []
 
     if USE_THREADS:
-        bgm_thread = threading.Thread(target=_create_bgm_render,
+        bgm_thread = threading.Thread(target=_create_bgm_renders,
                                       args=(params_bgm,
-                                            target_parts,
-                                            output_bgm_filename))
+                                            bgm_renders,
+                                            output_bgm_filenames))
         bgm_thread.start()
         running_threads.append(bgm_thread)
     else:
-        _create_bgm_render(params_bgm, target_parts, output_bgm_filename)
+        _create_bgm_renders(params_bgm, bgm_renders, output_bgm_filenames)
 
     return running_threads
 
@@ -550,13 +487,15 @@ def create_va3(json_sq3, params, part):
         va3_thread = threading.Thread(target=vas3tool.write_vas3,
                                       args=(params['sound_folder'],
                                             output_filename,
-                                            json_sq3['sound_metadata'][part]))
+                                            json_sq3['sound_metadata'][part],
+                                            params.get('sound_workers', 1)))
         va3_thread.start()
         running_threads.append(va3_thread)
     else:
         vas3tool.write_vas3(params['sound_folder'],
                             output_filename,
-                            json_sq3['sound_metadata'][part])
+                            json_sq3['sound_metadata'][part],
+                            params.get('sound_workers', 1))
 
     return running_threads
 
@@ -569,27 +508,27 @@ def create_event_file(json_sq3, params, charts):
     # easier to handle the data for multiple difficulties
     bonus_notes = {}
     for chart in charts:
-        for x in chart['timestamp']:
-            for x2 in chart['timestamp'][x]:
-                if not (x2['name'] == "note" and x2['data'].get('bonus_note', 0) == 1):
-                    continue
-
-                if x2['beat'] not in bonus_notes:
-                    bonus_notes[x2['beat']] = {}
-
-                gamelevel = 1 << chart['header']['difficulty']
-                if x2['data']['sound_id'] in bonus_notes[x2['beat']]:
-                    gamelevel |= bonus_notes[x2['beat']][x2['data']['sound_id']]['gamelevel']
-
-                bonus_notes[x2['beat']][x2['data']['sound_id']] = {
-                    'sound_id': x2['data']['sound_id'],
-                    'time': x2['beat'],
-                    'gamelevel': gamelevel,
-                }
+        rows = numpy.flatnonzero(chart.get_event_mask(["note"]))
+        rows = rows[numpy.array(chart.get_values('bonus_note', rows, 0), dtype=object) == 1]
+        gamelevel_bit = 1 << chart['header']['difficulty']
+
+        for beat, sound_id in zip(chart.get_values('beat', rows), chart.get_values('sound_id', rows)):
+            if beat not in bonus_notes:
+                bonus_notes[beat] = {}
+
+            gamelevel = gamelevel_bit
+            if sound_id in bonus_notes[beat]:
+                gamelevel |= bonus_notes[beat][sound_id]['gamelevel']
+
+            bonus_notes[beat][sound_id] = {
+                'sound_id': sound_id,
+                'time': beat,
+                'gamelevel': gamelevel,
+            }
 
     # Convert the dictionary into a flat list
     bonus_notes_flat = []
-    for beat in sorted(bonus_notes.keys(), key=lambda x: int(x)):
+    for beat in sorted(bonus_notes.keys()):
         for sound_id in bonus_notes[beat]:
             bonus_notes_flat.append(bonus_notes[beat][sound_id])
 
@@ -838,27 +777,26 @@ def create_sq3_file(json_sq3, params, target_parts, charts_data):
     # Create actual SQ3 data
     archive_size = 0x20 + (0x10 * len(charts_data)) + sum([len(x['data']) for x in charts_data])
 
-    output_data = [0] * 0x20
+    output_data = bytearray(archive_size)
     output_data[0x00:0x04] = b'SEQP'
     output_data[0x04] = 0x01
     output_data[0x06] = 0x01
     output_data[0x0a] = 0x03
-    output_data[0x0c:0x10] = struct.pack("<I", archive_size)
-    output_data[0x10:0x14] = struct.pack("<I", 0x20)  # Size of header
-    output_data[0x14:0x18] = struct.pack("<I", json_sq3['musicid'])
-    output_data[0x18:0x1c] = struct.pack("<I", len(charts_data))
-    output_data[0x1c:0x20] = struct.pack("<I", 0x12345678)
+    struct.pack_into("<I", output_data, 0x0c, archive_size)
+    struct.pack_into("<I", output_data, 0x10, 0x20)  # Size of header
+    struct.pack_into("<I", output_data, 0x14, json_sq3['musicid'])
+    struct.pack_into("<I", output_data, 0x18, len(charts_data))
+    struct.pack_into("<I", output_data, 0x1c, 0x12345678)
 
-    output_data = bytearray(output_data)
+    offset = 0x20
     for chart_data in charts_data:
         data = chart_data['data']
 
-        file_header = [0] * 0x10
-        file_header[0x00:0x04] = struct.pack("<I", len(data) + 0x10)
-        file_header[0x04] = 0x10
+        struct.pack_into("<I", output_data, offset, len(data) + 0x10)
+        output_data[offset + 0x04] = 0x10
 
-        output_data += bytearray(file_header)
-        output_data += data
+        output_data[offset + 0x10:offset + 0x10 + len(data)] = data
+        offset += 0x10 + len(data)
 
     if 'drum' in target_parts:
         output_filename = 'd%04d.sq3' % (json_sq3['musicid'])
@@ -886,14 +824,17 @@ def create_sound_files(json_sq3, params, target_parts):
         running_threads += create_bgm(json_sq3, params, output_bgm_filename)
 
         if params.get('generate_bgms', False):
+            bgm_renders = []
+
             if 'guitar' in target_parts or 'bass' in target_parts:
-                running_threads += create_bgm_render(json_sq3, params, ['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq3['musicid'])))
-                running_threads += create_bgm_render(json_sq3, params, ['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq3['musicid'])))
+                bgm_renders.append((['bass'], os.path.join(output_folder, 'bgm%04d__bk.bin' % (json_sq3['musicid']))))
+                bgm_renders.append((['guitar', 'bass', 'open'], os.path.join(output_folder, 'bgm%04d_gbk.bin' % (json_sq3['musicid']))))
 
             if 'drum' in target_parts:
-                running_threads += create_bgm_render(json_sq3, params, ['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq3['musicid'])))
+                bgm_renders.append((['drum'], os.path.join(output_folder, 'bgm%04dd__k.bin' % (json_sq3['musicid']))))
 
-            running_threads += create_bgm_render(json_sq3, params, ['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq3['musicid'])))
+            bgm_renders.append((['drum', 'bass'], os.path.join(output_folder, 'bgm%04dd_bk.bin' % (json_sq3['musicid']))))
+            running_threads += create_bgm_renders(json_sq3, params, bgm_renders)
 
         if 'drum' in target_parts:
             running_threads += create_va3(json_sq3, params, 'drum')
@@ -933,14 +874,16 @@ def create_sound_files(json_sq3, params, target_parts):
 
 
 def generate_sq3_file_from_json(params):
-    json_sq3 = json.loads(params['input']) if 'input' in params else None
+    json_sq3 = params['input'] if 'input' in params else None
 
     if not json_sq3:
         print("Couldn't find input data")
         return
 
+    charts = chartdata.get_charts(json_sq3)
+
     # Generate metadata charts for each chart
-    chart_metadata = [x for x in json_sq3['charts'] if x['header']['is_metadata'] == 1]
+    chart_metadata = [x for x in charts if x['header']['is_metadata'] == 1]
 
     if len(chart_metadata) == 0:
         print("Couldn't find metadata chart")
@@ -958,19 +901,20 @@ def generate_sq3_file_from_json(params):
         metadata_chart = chart_metadata[0]
 
         filtered_charts = [
-            generate_metadata_fields(metadata_chart, x) for x in json_sq3['charts']
+            generate_metadata_fields(metadata_chart, x) for x in charts
             if x['header']['is_metadata'] == 0
             and x['header']['game_type'] < len(parts)
             and parts[x['header']['game_type']] in valid_parts
         ]
 
-        found_parts += [parts[x['header']['game_type']] for x in json_sq3['charts'] if x['header']['is_metadata'] == 0]
+        found_parts += [parts[x['header']['game_type']] for x in charts if x['header']['is_metadata'] == 0]
 
         if len(filtered_charts) == 0:
             continue
 
+        # The metadata chart's beats don't depend on the other charts' events
         charts_data = [{
-            'data': generate_sq3_chart_data_from_json(metadata_chart),
+            'data': generate_sq3_chart_data_from_json(generate_metadata_fields(metadata_chart, chartdata.ChartData(metadata_chart.info))),
             'metadata': metadata_chart,
         }]
 
@@ -1009,156 +953,144 @@ def generate_sq3_file_from_json(params):
 
 
 def get_start_timestamp(chart):
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] in ["startpos"]:
-                return timestamp_key
-
-    return sorted(chart['timestamp'].keys(), key=lambda x: int(x))[0]
+    rows = numpy.flatnonzero(chart.get_event_mask(["startpos"]))
+    return chart.timestamp[rows[0] if len(rows) > 0 else 0]
 
 
 def get_end_timestamp(chart):
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        for beat in chart['timestamp'][timestamp_key]:
-            if beat['name'] in ["endpos"]:
-                return timestamp_key
-
-    return sorted(chart['timestamp'].keys(), key=lambda x: int(x))[-1]
-
-
-def generate_sq3_chart_data_from_json(chart):
-    metadata = True if chart['header']['is_metadata'] == 1 else False
-
-    event_data = []
-    found_events = []
-
-    start_timestamp = int(get_start_timestamp(chart))
-    end_timestamp = int(get_end_timestamp(chart))
-
-    # Handle events based on beat offset in ascending order
-    for timestamp_key in sorted(chart['timestamp'].keys(), key=lambda x: int(x)):
-        if int(timestamp_key) < start_timestamp or int(timestamp_key) > end_timestamp:
-            continue
-
-        for beat in chart['timestamp'][timestamp_key]:
-            chart_events = [
-                "chipstart",
-                "chipend",
-                "startpos",
-                "endpos",
-                "note"
-            ]
-
-            metadata_events = [
-                "bpm",
-                "barinfo",
-                "baron",
-                "baroff",
-                "measure",
-                "beat",
-                "startpos",
-                "endpos"
-            ]
-
-            if not metadata and beat['name'] not in chart_events:
-                continue
-
-            elif metadata and beat['name'] not in metadata_events:
-                continue
-
-            if beat['name'] in ["startpos", "endpos"] and EVENT_ID_REVERSE[beat['name']] in found_events:
-                # Don't duplicate these events
-                continue
+    rows = numpy.flatnonzero(chart.get_event_mask(["endpos"]))
+    return chart.timestamp[rows[0] if len(rows) > 0 else -1]
 
-            found_events.append(EVENT_ID_REVERSE[beat['name']])
 
-            mdata = [0] * 0x40  # Use proper section size here
+def write_event_table(output_data, offset, entry_size, count, columns):
+    # Fill the event entries in place, one bulk write per field
+    entries = numpy.frombuffer(output_data, dtype=get_event_dtype(entry_size), count=count, offset=offset)
 
-            mdata[0x00:0x04] = struct.pack("<I", int(timestamp_key))
-            mdata[0x04] = EVENT_ID_REVERSE[beat['name']] & 0xff
-            mdata[0x10:0x14] = struct.pack("<I", beat['beat'])
+    for field in columns:
+        rows, values = columns[field]
+        entries[field][rows] = values
 
-            if beat['name'] == "bpm":
-                mdata[0x34:0x38] = struct.pack("<I", int(round(60000000 / beat['data']['bpm'])))
-            elif beat['name'] == "barinfo":
-                mdata[0x34] = beat['data']['numerator'] & 0xff
 
-                denominator = 1 << (beat['data']['denominator'].bit_length() - 1)
-                if denominator != beat['data']['denominator']:
-                    raise Exception("ERROR: The time signature denominator must be divisible by 2."
-                                    "Found {}".format(beat['data']['denominator']))
+def generate_sq3_chart_data_from_json(chart):
+    metadata = True if chart['header']['is_metadata'] == 1 else False
 
-                mdata[0x35] = (beat['data']['denominator'].bit_length() - 1) & 0xff
-            elif beat['name'] == "chipstart":
-                if 'unk' in beat['data']:
-                    mdata[0x14:0x18] = struct.pack("<I", beat['data']['unk'])
-            elif beat['name'] == "note":
-                if beat['data']['note'] not in REVERSE_NOTE_MAPPING:
-                    # Set all unknown events to auto play
-                    REVERSE_NOTE_MAPPING[beat['data']['note']] = 0xff
+    chart_events = [
+        "chipstart",
+        "chipend",
+        "startpos",
+        "endpos",
+        "note"
+    ]
+
+    metadata_events = [
+        "bpm",
+        "barinfo",
+        "baron",
+        "baroff",
+        "measure",
+        "beat",
+        "startpos",
+        "endpos"
+    ]
+
+    start_timestamp = get_start_timestamp(chart)
+    end_timestamp = get_end_timestamp(chart)
+
+    # Events are already in ascending timestamp order
+    is_valid = (chart.timestamp >= start_timestamp) & (chart.timestamp <= end_timestamp)
+    is_valid &= chart.get_event_mask(metadata_events if metadata else chart_events)
+
+    # Don't duplicate these events
+    for name in ["startpos", "endpos"]:
+        duplicates = numpy.flatnonzero(is_valid & chart.get_event_mask([name]))[1:]
+        is_valid[duplicates] = False
+
+    rows = numpy.flatnonzero(is_valid)
+    event_count = len(rows)
+
+    def get_event_rows(name):
+        # Output positions and chart rows of the events with the given name
+        is_event = chart.get_event_mask([name])[rows]
+        return numpy.flatnonzero(is_event), rows[is_event]
+
+    # Event fields are collected by column and only written once the event count is known
+    event_ids = numpy.array([EVENT_ID_REVERSE.get(name, 0) & 0xff for name in chart.event_names], dtype=numpy.uint8)
+    columns = {
+        'timestamp': (slice(None), chart.timestamp[rows].astype(numpy.int64)),
+        'id': (slice(None), event_ids[chart.event[rows]]),
+        'beat': (slice(None), chart.get_values('beat', rows)),
+    }
 
-                if 'hold_duration' in beat['data']:
-                    mdata[0x08:0x0c] = struct.pack("<I", beat['data']['hold_duration'])
+    positions, event_rows = get_event_rows("bpm")
+    columns['bpm_mpm'] = (positions, [int(round(60000000 / bpm)) for bpm in chart.get_values('bpm', event_rows)])
 
-                if 'unk' in beat['data']:
-                    mdata[0x14:0x18] = struct.pack("<I", beat['data']['unk'])
-                else:
-                    mdata[0x14:0x18] = struct.pack("<I", 0x16c)
+    positions, event_rows = get_event_rows("barinfo")
+    columns['numerator'] = (positions, [x & 0xff for x in chart.get_values('numerator', event_rows)])
 
-                if 'sound_id' in beat['data']:
-                    mdata[0x20:0x24] = struct.pack("<I", beat['data']['sound_id'])
+    denominators = chart.get_values('denominator', event_rows)
+    for denominator in denominators:
+        if 1 << (denominator.bit_length() - 1) != denominator:
+            raise Exception("ERROR: The time signature denominator must be divisible by 2."
+                            "Found {}".format(denominator))
 
-                if chart['header']['game_type'] != 0:
-                    if 'note_length' in beat['data']:
-                        mdata[0x24:0x28] = struct.pack("<I", beat['data']['note_length'])
-                    else:
-                        mdata[0x24:0x28] = struct.pack("<I", 0x40)
+    columns['denominator_orig'] = (positions, [(x.bit_length() - 1) & 0xff for x in denominators])
 
-                if 'volume' in beat['data']:
-                    mdata[0x2d] = beat['data']['volume'] & 0xff
+    positions, event_rows = get_event_rows("chipstart")
+    has_unk = chart.has_values('unk', event_rows)
+    unk_positions = [positions[has_unk]]
+    unk_values = chart.get_values('unk', event_rows[has_unk])
 
-                if 'auto_volume' in beat['data']:
-                    mdata[0x2e] = beat['data']['auto_volume'] & 0xff
+    positions, event_rows = get_event_rows("note")
+    if not numpy.all(chart.has_values('note', event_rows)):
+        raise KeyError('note')
 
-                if 'note' in beat['data']:
-                    mdata[0x30] = REVERSE_NOTE_MAPPING[beat['data']['note']] & 0xff
+    # Set all unknown notes to auto play
+    note_codes = numpy.array([REVERSE_NOTE_MAPPING.get(note, 0xff) & 0xff for note in chart.note_names], dtype=numpy.uint8)
+    columns['note'] = (positions, note_codes[chart.note[event_rows]])
 
-                if 'wail_misc' in beat['data']:
-                    mdata[0x31] = beat['data']['wail_misc'] & 0xff
+    # chipstart and note events share the unk field
+    unk_positions.append(positions)
+    unk_values += chart.get_values('unk', event_rows, 0x16c)
+    columns['unk'] = (numpy.concatenate(unk_positions), unk_values)
 
-                if 'guitar_special' in beat['data']:
-                    mdata[0x32] = beat['data']['guitar_special'] & 0xff
+    if chart['header']['game_type'] != 0:
+        columns['note_length'] = (positions, chart.get_values('note_length', event_rows, 0x40))
 
-                if 'auto_note' in beat['data']:
-                    mdata[0x34] = beat['data']['auto_note'] & 0xff
+    for field in ['hold_duration', 'sound_id']:
+        has_field = chart.has_values(field, event_rows)
+        columns[field] = (positions[has_field], chart.get_values(field, event_rows[has_field]))
 
-                if beat['data'].get('note') == "auto":
-                    mdata[0x34] = 1  # Auto note
-                    mdata[0x2e] = 1  # Auto volume
+    for field in ['volume', 'wail_misc', 'guitar_special']:
+        has_field = chart.has_values(field, event_rows)
+        columns[field] = (positions[has_field], [x & 0xff for x in chart.get_values(field, event_rows[has_field])])
 
-            event_data.append(bytearray(mdata))
+    # Auto notes always set the auto note and auto volume flags
+    is_auto = chart.get_note_mask(["auto"])[event_rows]
+    for field in ['auto_note', 'auto_volume']:
+        has_field = chart.has_values(field, event_rows) & ~is_auto
+        values = [1] * int(numpy.count_nonzero(is_auto))
+        values += [x & 0xff for x in chart.get_values(field, event_rows[has_field])]
+        columns[field] = (numpy.concatenate([positions[is_auto], positions[has_field]]), values)
 
-    output_data = [0] * 0x20
+    output_data = bytearray(0x20 + event_count * 0x40)
     output_data[0x00:0x04] = b'SQ3T'
     output_data[0x06] = 0x03  # SQ3 flag
     output_data[0x0a] = 0x03  # SQ3 flag 2?
-    output_data[0x0c:0x10] = struct.pack("<I", 0x20)  # Size of header
-    output_data[0x10:0x14] = struct.pack("<I", len(event_data))  # Number of events
+    struct.pack_into("<I", output_data, 0x0c, 0x20)  # Size of header
+    struct.pack_into("<I", output_data, 0x10, event_count)  # Number of events
     output_data[0x14] = chart['header']['unk_sys'] & 0xff
     output_data[0x15] = chart['header']['is_metadata'] & 0xff
     output_data[0x16] = chart['header']['difficulty'] & 0xff
     output_data[0x17] = chart['header']['game_type'] & 0xff
-    output_data[0x18:0x1a] = struct.pack("<H", chart['header']['time_division'])
-    output_data[0x1a:0x1c] = struct.pack("<H", chart['header']['beat_division'])
-    output_data[0x1c:0x20] = struct.pack("<I", 0x40)  # Size of each entry
+    struct.pack_into("<H", output_data, 0x18, chart['header']['time_division'])
+    struct.pack_into("<H", output_data, 0x1a, chart['header']['beat_division'])
+    struct.pack_into("<I", output_data, 0x1c, 0x40)  # Size of each entry
 
     if metadata:
         output_data[0x15] = 0x01
         output_data[0x16] = 0x01
 
-    output_data = bytearray(output_data)
-    for data in event_data:
-        output_data += data
+    write_event_table(output_data, 0x20, 0x40, event_count, columns)
 
     return output_data
 
@@ -1167,74 +1099,146 @@ def generate_sq3_chart_data_from_json(chart):
 #   SQ3 parsing code   #
 ########################
 
-def parse_event_block(mdata, game, difficulty, events={}):
-    packet_data = {}
+# Layout of a single SQ3T event entry.
+# The fields at 0x34 overlap depending on the event type:
+# bpm events store microseconds per minute, barinfo events store the time signature
+# and note events store the auto note flag.
+SQ3_EVENT_FIELDS = [
+    ('timestamp', '<u4', 0x00),
+    ('id', 'u1', 0x04),
+    ('hold_duration', '<u4', 0x08),
+    ('beat', '<u4', 0x10),
+    ('unk', '<u4', 0x14),
+    ('sound_id', '<u4', 0x20),
+    ('note_length', '<u4', 0x24),
+    ('volume', 'u1', 0x2d),
+    ('auto_volume', 'u1', 0x2e),
+    ('note', 'u1', 0x30),
+    ('wail_misc', 'u1', 0x31),
+    ('guitar_special', 'u1', 0x32),
+    ('bpm_mpm', '<u4', 0x34),
+    ('numerator', 'u1', 0x34),
+    ('denominator_orig', 'u1', 0x35),
+    ('auto_note', 'u1', 0x34),
+]
+
+
+def get_event_dtype(entry_size):
+    return numpy.dtype({
+        'names': [x[0] for x in SQ3_EVENT_FIELDS],
+        'formats': [x[1] for x in SQ3_EVENT_FIELDS],
+        'offsets': [x[2] for x in SQ3_EVENT_FIELDS],
+        'itemsize': entry_size,
+    })
+
+
+def get_lookup_table(mapping):
+    table = numpy.full(0x100, None, dtype=object)
+
+    for k in mapping:
+        table[k] = mapping[k]
+
+    return table
+
+
+EVENT_NAME_TABLE = get_lookup_table(EVENT_ID_MAP)
+NOTE_NAME_TABLES = {k: get_lookup_table(NOTE_MAPPING[k]) for k in NOTE_MAPPING}
+
+
+def get_bonus_note_mask(entries, game_type_id, events):
+    # Match notes against bonus events using a combined (beat, sound_id) key
+    bonus_keys = []
+    for beat in events:
+        if not 0 <= beat <= 0xffffffff:
+            continue
+
+        for event in events[beat]:
+            is_gametype = event['game_type'] == game_type_id
+            is_eventtype = event['event_type'] == 0
+
+            # This field seems to be maybe left over from previous games?
+            # 1852 doesn't work properly set the gamelevel fields
+            #is_diff = (event['gamelevel'] & (1 << difficulty)) != 0
 
-    timestamp = struct.unpack("<I", mdata[0x00:0x04])[0]
-    beat = struct.unpack("<I", mdata[0x10:0x14])[0]
+            if is_gametype and is_eventtype and 0 <= event['note'] <= 0xffffffff:
+                bonus_keys.append((beat << 32) | event['note'])
+
+    if not bonus_keys:
+        return numpy.zeros(len(entries), dtype=bool)
+
+    keys = numpy.left_shift(entries['beat'].astype(numpy.uint64), numpy.uint64(32)) | entries['sound_id']
+    return numpy.isin(keys, numpy.array(bonus_keys, dtype=numpy.uint64))
+
+
+def decode_event_table(entries, game, difficulty, events={}):
     game_type_id = {"drum": 0, "guitar": 1, "bass": 2, "open": 3}[game]
 
-    if mdata[0x04] == 0x01:
-        bpm_mpm = struct.unpack("<I", mdata[0x34:0x38])[0]
-        packet_data['bpm'] = 60000000 / bpm_mpm
-    elif mdata[0x04] == 0x02:
-        # Time signature is represented as numerator/(1<<denominator)
-        packet_data['numerator'] = mdata[0x34]
-        packet_data['denominator'] = 1 << mdata[0x35]
-        packet_data['denominator_orig'] = mdata[0x35]
-    elif mdata[0x04] == 0x07:
-        packet_data['unk'] = struct.unpack("<I", mdata[0x14:0x18])[0]  # What is this?
-    elif mdata[0x04] == 0x10:
-        packet_data['hold_duration'] = struct.unpack("<I", mdata[0x08:0x0c])[0]
-        packet_data['unk'] = struct.unpack("<I", mdata[0x14:0x18])[0]  # What is this?
-        packet_data['sound_id'] = struct.unpack("<I", mdata[0x20:0x24])[0]
-
-        # Note length (relation to hold duration)
-        packet_data['note_length'] = struct.unpack("<I", mdata[0x24:0x28])[0]
-
-        packet_data['volume'] = mdata[0x2d]
-        packet_data['auto_volume'] = mdata[0x2e]
-        packet_data['note'] = NOTE_MAPPING[game][mdata[0x30]]
-
-        # wail direction? 0/1 = up, 2 = down. Seems to alternate 0 and 1 if wailing in succession
-        packet_data['wail_misc'] = mdata[0x31]
-
-        # 2 = hold note, 1 = wail (bitmasks, so 3 = wail + hold)
-        packet_data['guitar_special'] = mdata[0x32]
-
-        # Auto note
-        packet_data['auto_note'] = mdata[0x34]
-
-        if packet_data['auto_note'] == 1:
-            packet_data['note'] = "auto"
-
-        if beat in events:
-            for event in events[beat]:
-                is_gametype = event['game_type'] == game_type_id
-                is_eventtype = event['event_type'] == 0
-                is_note = packet_data['sound_id'] == event['note']
-
-                # This field seems to be maybe left over from previous games?
-                # 1852 doesn't work properly set the gamelevel fields
-                #is_diff = (event['gamelevel'] & (1 << difficulty)) != 0
-
-                if is_gametype and is_eventtype and is_note:
-                    packet_data['bonus_note'] = True
+    event_ids = entries['id']
+    is_note = event_ids == 0x10
 
-    return {
-        "id": mdata[0x04],
-        "name": EVENT_ID_MAP[mdata[0x04]],
-        'timestamp': struct.unpack("<I", mdata[0x00:0x04])[0],
-        'beat': beat,
-        "data": packet_data
-    }
+    names = EVENT_NAME_TABLE[event_ids]
+    unknown = numpy.flatnonzero(numpy.equal(names, None))
+    if len(unknown) > 0:
+        raise KeyError(int(event_ids[unknown[0]]))
 
+    notes = NOTE_NAME_TABLES[game][entries['note']]
+    unknown = numpy.flatnonzero(numpy.equal(notes, None) & is_note)
+    if len(unknown) > 0:
+        raise KeyError(int(entries['note'][unknown[0]]))
 
-def read_sq3_data(data, events):
-    output = {
-        "beat_data": []
-    }
+    notes[entries['auto_note'] == 1] = "auto"
+
+    is_bpm = event_ids == 0x01
+    bpms = numpy.zeros(len(entries), dtype=numpy.float64)
+    bpms[is_bpm] = 60000000 / entries['bpm_mpm'][is_bpm].astype(numpy.float64)
+
+    columns = {name: entries[name] for name in entries.dtype.names}
+    columns['name'] = names
+    columns['note'] = notes
+    columns['bpm'] = bpms
+    # Time signature is represented as numerator/(1<<denominator)
+    columns['denominator'] = numpy.left_shift(1, entries['denominator_orig'].astype(numpy.uint32))
+    columns['bonus_note'] = is_note & get_bonus_note_mask(entries, game_type_id, events)
+
+    return columns
+
+
+def parse_event_blocks(entries, game, difficulty, events={}, info=None):
+    columns = decode_event_table(entries, game, difficulty, events)
+
+    order = numpy.argsort(columns['timestamp'], kind='stable')
+    columns = {k: v[order] for k, v in columns.items()}
+
+    chart = chartdata.ChartData.from_columns(info, columns['timestamp'], columns['name'], {
+        'id': columns['id'],
+        'beat': columns['beat'],
+    })
+
+    def set_fields(event_id, fields):
+        is_event = columns['id'] == event_id
+
+        for field in fields:
+            chart.set_values(field, is_event, columns[field][is_event])
+
+    set_fields(0x01, ['bpm'])
+    set_fields(0x02, ['numerator', 'denominator', 'denominator_orig'])
+    set_fields(0x07, ['unk'])  # What is this?
 
+    # unk: What is this?
+    # note_length: Note length (relation to hold duration)
+    # wail_misc: wail direction? 0/1 = up, 2 = down. Seems to alternate 0 and 1 if wailing in succession
+    # guitar_special: 2 = hold note, 1 = wail (bitmasks, so 3 = wail + hold)
+    set_fields(0x10, [
+        'hold_duration', 'unk', 'sound_id', 'note_length', 'volume', 'auto_volume',
+        'note', 'wail_misc', 'guitar_special', 'auto_note',
+    ])
+
+    chart.set_values('bonus_note', columns['bonus_note'], True)
+
+    return chart
+
+
+def read_sq3_data(data, events):
     if data is None:
         return None
 
@@ -1252,58 +1256,33 @@ def read_sq3_data(data, events):
     if is_metadata not in [0, 1]: # Only support metadata and note charts. Not sure what type 2 is yet
         return None
 
-    output['header'] = {
-        "unk_sys": unk_sys,
-        "is_metadata": is_metadata,
-        "difficulty": difficulty,
-        "game_type": game_type,
-        "time_division": time_division,
-        "beat_division": beat_division,
+    info = {
+        'header': {
+            "unk_sys": unk_sys,
+            "is_metadata": is_metadata,
+            "difficulty": difficulty,
+            "game_type": game_type,
+            "time_division": time_division,
+            "beat_division": beat_division,
+        }
     }
 
-    for i in range(entry_count):
-        mdata = data[header_size + (i * entry_size):header_size + (i * entry_size) + entry_size]
-        part = ["drum", "guitar", "bass"][game_type]
-        parsed_data = parse_event_block(mdata, part, difficulty, events)
-        output['beat_data'].append(parsed_data)
-
-    return output
-
-
-def convert_to_timestamp_chart(chart):
-    chart['timestamp'] = {}
-
-    for x in chart['beat_data']:
-        if x['timestamp'] not in chart['timestamp']:
-            chart['timestamp'][x['timestamp']] = []
-
-        beat = x['timestamp']
-        del x['timestamp']
+    entries = numpy.frombuffer(data, dtype=get_event_dtype(entry_size), count=entry_count, offset=header_size)
+    part = ["drum", "guitar", "bass"][game_type]
 
-        chart['timestamp'][beat].append(x)
-
-    del chart['beat_data']
-
-    return chart
+    return parse_event_blocks(entries, part, difficulty, events, info)
 
 
 def parse_chart_intermediate(chart, events):
     chart_raw = read_sq3_data(chart, events)
 
-    if not chart_raw:
+    if chart_raw is None:
         return None
 
-    chart_raw = convert_to_timestamp_chart(chart_raw)
+    start_timestamp = get_start_timestamp(chart_raw)
+    end_timestamp = get_end_timestamp(chart_raw)
 
-    start_timestamp = int(get_start_timestamp(chart_raw))
-    end_timestamp = int(get_end_timestamp(chart_raw))
-
-    # Handle events based on beat offset in ascending order
-    for timestamp_key in sorted(chart_raw['timestamp'].keys(), key=lambda x: int(x)):
-        if int(timestamp_key) < start_timestamp or int(timestamp_key) > end_timestamp:
-            del chart_raw['timestamp'][timestamp_key]
-
-    return chart_raw
+    return chart_raw.select((chart_raw.timestamp >= start_timestamp) & (chart_raw.timestamp <= end_timestamp))
 
 
 def add_song_info(charts, music_id, music_db):
@@ -1402,7 +1381,7 @@ def combine_guitar_charts(guitar_charts, bass_charts):
     # Combine guitar and bass charts
     parsed_bass_charts = []
 
-    for chart in guitar_charts:
+    for chart_idx, chart in enumerate(guitar_charts):
         # Find equivalent chart
         for chart2 in bass_charts:
             if chart['header']['difficulty'] != chart2['header']['difficulty']:
@@ -1416,18 +1395,12 @@ def combine_guitar_charts(guitar_charts, bass_charts):
                     chart['header']['level'][k] = chart2['header']['level'][k]
 
             # Add all bass notes to guitar chart data
-            for timestamp_key in chart2['timestamp']:
-                for event in chart2['timestamp'][timestamp_key]:
-                    if event['name'] != "note":
-                        continue
-
-                    if timestamp_key not in chart['timestamp']:
-                        chart['timestamp'][timestamp_key] = []
-
-                    chart['timestamp'][timestamp_key].append(event)
+            chart = chart.merge(chart2.select(chart2.get_event_mask(["note"])))
 
             parsed_bass_charts.append(chart2)
 
+        guitar_charts[chart_idx] = chart
+
     for chart in parsed_bass_charts:
         bass_charts.remove(chart)
 
@@ -1485,7 +1458,7 @@ def generate_json_from_sq3(params):
 
     output_data['charts'] = charts
 
-    return json.dumps(output_data, indent=4, sort_keys=True)
+    return output_data
 
 
 class Sq3Format:
@@ -1501,21 +1474,6 @@ class Sq3Format:
     def to_chart(params):
         generate_sq3_file_from_json(params)
 
-    @staticmethod
-    def is_format(filename):
-        header = open(filename, "rb").read(0x40)
-
-        try:
-            is_seqp = header[0x00:0x04].decode('ascii') == "SEQP"
-            is_sq3t = header[0x30:0x34].decode('ascii') == "SQ3T"
-            is_ver3 = header[0x36] == 0x03
-            if is_seqp and is_ver3 and is_sq3t:
-                return True
-        except:
-            return False
-
-        return False
-
 
 def get_class():
     return Sq3Format
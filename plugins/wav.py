@@ -1,19 +1,19 @@
+import contextlib
 import glob
 import json
 import math
-import pydub
+import numpy
 import os
 import re
 import string
 
 import tmpfile
 import audio
+import chartdata
 import wavbintool
+import vas3tool
 import helper
 
-import imageio
-imageio.plugins.ffmpeg.download()
-
 
 def percentage_to_db(percentage):
     if percentage == 0:
@@ -22,28 +22,38 @@ def percentage_to_db(percentage):
     return 20 * math.log10(percentage / 100)
 
 
-def get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm):
-    if no_bgm:
-        # Find last timestamp
-        last_timestamp = int(sorted(chart_data['timestamp'].keys(), key=lambda x: int(x))[-1])
+# Keysounds are mixed at the BGM's rate, or this rate when rendering without a BGM
+DEFAULT_RATE = 48000
+
 
+def get_last_timestamp(chart_data):
+    return int(chart_data.timestamp[-1]) if len(chart_data) else 0
+
+
+def get_base_samples(input_foldername, bgm_filename, charts, no_bgm, volume_bgm=100):
+    if no_bgm:
         # TODO: Find a better way to calculate the ending of the audio
         # Convert last timestamp into a duration and add 2 seconds in
         # case the final notes ring out for long
-        duration = ((last_timestamp) / 0x12c) + 2
+        duration = max([get_last_timestamp(chart_data) for chart_data in charts], default=0) / 0x12c + 2
 
-        # Create silent audio file
-        output_audio = pydub.AudioSegment.silent(duration=duration * 1000)
-    else:
-        filename = os.path.join(input_foldername, bgm_filename)
-        filename = helper.getCaseInsensitivePath(filename)
-        output_audio = audio.get_audio_file(filename)
+        # Create silent audio
+        return numpy.zeros((int(duration * DEFAULT_RATE), 2), dtype=numpy.float32), DEFAULT_RATE
+
+    filename = os.path.join(input_foldername, bgm_filename)
+    filename = helper.getCaseInsensitivePath(filename)
+    bgm_pcm = audio.get_pcm(filename)
 
-    return output_audio
+    if bgm_pcm is None:
+        raise Exception("Couldn't find BGM: %s" % filename)
 
+    bgm_samples, bgm_rate = bgm_pcm
+    samples = audio.get_samples_from_pcm(bgm_samples)
 
-def make_silent(audio):
-    return pydub.AudioSegment.silent(duration=len(audio))
+    if volume_bgm != 100:
+        samples *= volume_bgm / 100
+
+    return samples, bgm_rate
 
 
 def find_sound_filename(path):
@@ -55,108 +65,143 @@ def find_sound_filename(path):
     return path
 
 
-def create_wav_from_chart(chart_data,
-                          input_foldername,
-                          sound_metadata,
-                          output_filename,
-                          bgm_filename="bgm.wav",
-                          tags=None,
-                          no_bgm=False,
-                          ext="mp3",
-                          quality="320k",
-                          volume_part=100,
-                          volume_bgm=100,
-                          volume_auto=100,
-                          ignore_auto=False):
-
-    output_audio = get_base_audio(input_foldername, bgm_filename, chart_data, no_bgm)
-    output_audio = make_silent(output_audio)
+def get_pan_gains(pan):
+    # Same balance law as pydub's pan effect, -1.0 is 100% left and 1.0 is 100% right
+    pan = min(max(pan, -1.0), 1.0)
 
-    if volume_bgm != 100:
-        volume_bgm_db = percentage_to_db(volume_bgm)
-        if not volume_bgm_db:
-            output_audio = make_silent(output_audio)
-        elif volume_bgm_db != 0:
-            output_audio += volume_bgm_db
+    boost_factor = 2 ** abs(pan)
+    reduce_factor = 2 - boost_factor
+    boost_factor = math.sqrt(boost_factor)
 
-    sound_files = {}
+    if pan < 0:
+        return boost_factor, reduce_factor
 
-    for timestamp_key in sorted(chart_data['timestamp'].keys(), key=lambda x: int(x)):
-        for cd in chart_data['timestamp'][timestamp_key]:
-            if cd['name'] != "note":
-                continue
+    return reduce_factor, boost_factor
 
-            if ignore_auto and (cd['data'].get('auto_volume', 0) != 0 or cd['data'].get('auto_note', 0) != 0):
-                continue
 
-            if 'volume' not in cd['data']:
-                cd['data']['volume'] = 127
+def get_keysound(filename, rate, keysounds):
+    # Each keysound file is only decoded once per render
+    if filename not in keysounds:
+        if os.path.exists(filename):
+            keysounds[filename] = audio.get_cached_samples(filename, rate)
+        else:
+            print("Couldn't find file: %s" % filename)
+            keysounds[filename] = None
+
+    return keysounds[filename]
 
-            is_auto = cd['data'].get('auto_volume') == 1 and cd['data'].get('auto_note') != 0
-            if is_auto:
-                # Change 2/3 later if other games use different ratios
-                cd['data']['volume'] = int(round(cd['data']['volume'] * (2/3)))
 
-            if 'pan' not in cd['data']:
-                cd['data']['pan'] = 64
+def get_archive_keysound(sound_id, rate, sound_archive, keysounds):
+    # Keysounds pulled from a VA3 archive share the PCM cache with keysound files
+    if sound_id not in keysounds:
+        entry = sound_archive.get_entry_by_sound_id(sound_id)
 
-            volume = 127  # 100% volume
-            pan = 64  # Center
-            wav_filename = "%04x.wav" % int(cd['data']['sound_id'])
+        if entry:
+            pcm = audio.get_archive_pcm(sound_archive.filename, sound_id,
+                                        lambda: (sound_archive.get_samples(entry), entry['rate']),
+                                        rate)
+            keysounds[sound_id] = audio.get_samples_from_pcm(pcm[0])
+        else:
+            print("Couldn't find sound id %04x in %s" % (sound_id, sound_archive.filename))
+            keysounds[sound_id] = None
+
+    return keysounds[sound_id]
 
-            sound_key = "%04d_%03d_%03d" % (cd['data']['sound_id'],
-                                            cd['data']['volume'],
-                                            cd['data']['pan'])
 
-            if sound_metadata and 'entries' in sound_metadata:
-                for sound_entry in sound_metadata['entries']:
-                    if int(sound_entry['sound_id']) == int(cd['data']['sound_id']):
-                        volume = sound_entry.get('volume', volume)
-                        pan = sound_entry.get('pan', pan)
+def get_sound_entries(sound_metadata):
+    sound_entries = {}
 
-                        if 'flags' not in sound_entry or "NoFilename" not in sound_entry['flags']:
-                            wav_filename = sound_entry['filename']
+    if sound_metadata and 'entries' in sound_metadata:
+        for sound_entry in sound_metadata['entries']:
+            sound_entries.setdefault(int(sound_entry['sound_id']), sound_entry)
 
-                        break
+    return sound_entries
 
-            if sound_key not in sound_files:
-                if cd['data'].get('volume'):
-                    volume = (cd['data']['volume'] / 127) * (volume / 127) * 127
 
-                if cd['data'].get('pan'):
-                    pan = (cd['data']['pan'] - ((128 - pan) / 2)) / (128 / 2)
-                else:
-                    pan = (pan - (128 / 2)) / (128 / 2)
+def mix_chart(output,
+              rate,
+              chart_data,
+              input_foldername,
+              sound_metadata,
+              volume_part=100,
+              volume_auto=100,
+              ignore_auto=False,
+              keysounds=None,
+              auto_output=None,
+              sound_archive=None):
+    # Notes that ignore_auto would skip are mixed into auto_output instead when it's given.
+    # Keysounds are decoded straight from sound_archive (a VA3Archive) when it's given.
 
-                wav_filename = find_sound_filename(helper.getCaseInsensitivePath(os.path.join(input_foldername, wav_filename)))
-                if os.path.exists(wav_filename):
-                    keysound = audio.get_audio_file(wav_filename)
-                    keysound = keysound.pan(pan)
-                    db = percentage_to_db((volume / 127) * 100)
-                    keysound += db
+    if keysounds is None:
+        keysounds = {}
 
-                    if is_auto:
-                        volume_key = volume_auto
-                    else:
-                        volume_key = volume_part
+    sound_entries = get_sound_entries(sound_metadata)
 
-                    if volume_key != 100:
-                        volume_db = percentage_to_db(volume_key)
-                        if not volume_db:
-                            keysound = make_silent(keysound)
-                        elif volume_db != 0:
-                            keysound += volume_db
+    rows = numpy.flatnonzero(chart_data.get_event_mask(["note"]))
+    fields = zip(
+        chart_data.get_timestamp_keys(rows, True),
+        chart_data.get_values('sound_id', rows),
+        chart_data.get_values('volume', rows, 127),
+        chart_data.get_values('pan', rows, 64),
+        chart_data.get_values('auto_volume', rows),
+        chart_data.get_values('auto_note', rows),
+    )
 
-                    sound_files[sound_key] = keysound
-                else:
-                    print("Couldn't find file: %s" % wav_filename)
+    for timestamp, sound_id, note_volume, note_pan, auto_volume, auto_note in fields:
+        position = int(int(timestamp) / 0x12c * 1000 * (rate / 1000))
 
-            if sound_key in sound_files:
-                position = int(timestamp_key) / 0x12c
-                #print("Overlaying sound at %f" % position)
-                output_audio = output_audio.overlay(sound_files[sound_key], position=position * 1000)
+        if position >= len(output):
+            continue
+
+        target = output
+        if auto_volume or auto_note:
+            if auto_output is not None:
+                target = auto_output
+            elif ignore_auto:
+                continue
 
-    return output_audio
+        is_auto = auto_volume == 1 and auto_note != 0
+        if is_auto:
+            # Change 2/3 later if other games use different ratios
+            note_volume = int(round(note_volume * (2/3)))
+
+        volume = 127  # 100% volume
+        pan = 64  # Center
+        wav_filename = "%04x.wav" % int(sound_id)
+
+        sound_entry = sound_entries.get(int(sound_id))
+        if sound_entry:
+            volume = sound_entry.get('volume', volume)
+            pan = sound_entry.get('pan', pan)
+
+            if 'flags' not in sound_entry or "NoFilename" not in sound_entry['flags']:
+                wav_filename = sound_entry['filename']
+
+        if note_volume:
+            volume = (note_volume / 127) * (volume / 127) * 127
+
+        if note_pan:
+            pan = (note_pan - ((128 - pan) / 2)) / (128 / 2)
+        else:
+            pan = (pan - (128 / 2)) / (128 / 2)
+
+        if sound_archive is not None:
+            keysound = get_archive_keysound(int(sound_id), rate, sound_archive, keysounds)
+        else:
+            wav_filename = find_sound_filename(helper.getCaseInsensitivePath(os.path.join(input_foldername, wav_filename)))
+            keysound = get_keysound(wav_filename, rate, keysounds)
+
+        if keysound is None:
+            continue
+
+        volume_key = volume_auto if is_auto else volume_part
+        gain = (volume / 127) * (volume_key / 100)
+
+        if gain == 0:
+            continue
+
+        end = min(position + len(keysound), len(target))
+        target[position:end] += keysound[:end - position] * (numpy.array(get_pan_gains(pan), dtype=numpy.float32) * gain)
 
 
 def get_selected_difficulty(json_data, params):
@@ -186,9 +231,11 @@ def get_selected_difficulty(json_data, params):
     return selected_difficulty
 
 
-def get_sound_metadata(params, json_data, input_foldername, game_type):
+def get_sound_metadata(params, json_data, input_foldername, game_type, sound_archive=None):
     if 'sound_metadata' in json_data and game_type in json_data['sound_metadata']:
         return json_data['sound_metadata'][game_type]
+    elif sound_archive is not None and not params.get('sound_metadata'):
+        return sound_archive.metadata
     elif 'sound_metadata' in params:
         return params['sound_metadata']
     else:
@@ -210,6 +257,14 @@ def get_sound_metadata(params, json_data, input_foldername, game_type):
     return None
 
 
+def open_sound_archive(params):
+    # Keysounds can be read from a VA3 archive instead of an extracted sound folder
+    if params.get('sound_archive'):
+        return vas3tool.VA3Archive(params['sound_archive'])
+
+    return contextlib.nullcontext()
+
+
 def get_sanitized_filename(filename, invalid_chars='<>:;\"\\/|?*'):
     for c in invalid_chars:
         filename = filename.replace(c, "_")
@@ -252,22 +307,6 @@ def get_output_filename(json_data, chart_data, params):
     return get_sanitized_filename(output_filename)
 
 
-def get_tags(json_data, chart_data):
-    tags = {}
-
-    if 'title' in chart_data['header']:
-        tags['title'] = chart_data['header']['title']
-
-    if 'artist' in chart_data['header']:
-        tags['artist'] = chart_data['header']['artist']
-
-    game_type = ['Drum', 'Guitar', 'Bass'][chart_data['header']['game_type']]
-    difficulty = ['NOV', 'BSC', 'ADV', 'EXT', 'MST'][chart_data['header']['difficulty']]
-    tags['comments'] = "%s %s %s" % (json_data['musicid'], game_type, difficulty)
-
-    return tags
-
-
 def get_bgm_filename(json_data, chart_data, input_foldername):
     if 'bgm' in json_data:
         bgm_filename = audio.merge_bgm(json_data['bgm'], input_foldername)
@@ -280,7 +319,7 @@ def get_bgm_filename(json_data, chart_data, input_foldername):
 
 
 def generate_wav_from_json(params, generate_output_filename=True):
-    input_json = params.get('input')
+    json_data = params.get('input')
     input_foldername = params.get('sound_folder')
     output_filename = params.get('output')
 
@@ -293,79 +332,173 @@ def generate_wav_from_json(params, generate_output_filename=True):
 
         params['render_ext'] = ext
 
-    if not input_json:
+    if not json_data:
         raise Exception("Couldn't find input data")
 
-    json_data = json.loads(input_json)
     selected_difficulty = get_selected_difficulty(json_data, params)
 
     if not selected_difficulty:
         raise Exception("Couldn't find selected difficulty")
 
-    bgms = []
-    bgm_filename = None
-    for chart_data in json_data['charts']:
-        # Skip metadata charts and stuff not specified by the user
-        if chart_data['header']['is_metadata'] != 0:
-            continue
+    with open_sound_archive(params) as sound_archive:
+        charts = []
+        bgm_filename = None
+        for chart_data in chartdata.get_charts(json_data):
+            # Skip metadata charts and stuff not specified by the user
+            if chart_data['header']['is_metadata'] != 0:
+                continue
 
-        if chart_data['header']['difficulty'] != selected_difficulty:
-            continue
+            if chart_data['header']['difficulty'] != selected_difficulty:
+                continue
 
-        game_type = ['drum', 'guitar', 'bass'][chart_data['header']['game_type']]
-        if game_type not in params['parts']:
-            continue
+            game_type = ['drum', 'guitar', 'bass'][chart_data['header']['game_type']]
+            if game_type not in params['parts']:
+                continue
 
-        if generate_output_filename:
-            output_filename = get_output_filename(json_data, chart_data, params)
-        else:
-            output_filename = params['output']
+            if generate_output_filename:
+                output_filename = get_output_filename(json_data, chart_data, params)
+            else:
+                output_filename = params['output']
 
-        tags = get_tags(json_data, chart_data)
+            if not bgm_filename:
+                bgm_filename = get_bgm_filename(json_data, chart_data, input_foldername)
+
+            sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
+            json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type, sound_archive)
+            if not json_sound_metadata:
+                raise Exception("Couldn't find sound metadata")
+
+            print("Exporting %s..." % output_filename)
+
+            charts.append((chart_data, json_sound_metadata))
 
         if not bgm_filename:
-            bgm_filename = get_bgm_filename(json_data, chart_data, input_foldername)
+            return
+
+        print("Saving to %s..." % output_filename)
+
+        # All charts are mixed into one float buffer and only clipped once at the end
+        output, rate = get_base_samples(input_foldername,
+                                        bgm_filename,
+                                        [chart_data for chart_data, _ in charts],
+                                        params.get('render_no_bgm', False),
+                                        params.get('render_volume_bgm', 100))
+
+        keysounds = {}
+        for chart_data, json_sound_metadata in charts:
+            mix_chart(output,
+                      rate,
+                      chart_data,
+                      input_foldername,
+                      json_sound_metadata,
+                      volume_part=params.get('render_volume', 100),
+                      volume_auto=params.get('render_volume_auto', 100),
+                      ignore_auto=params.get('render_ignore_auto', False),
+                      keysounds=keysounds,
+                      sound_archive=sound_archive)
+
+    audio.export_samples(output, rate, params['output'], format=params.get('render_ext', "mp3"), bitrate=params.get('render_quality', '320k'))
+
+def generate_bgm_renders(params, renders):
+    # Renders several BGMs at once, renders is a list of (parts, ignore_auto, output filename).
+    # Each chart is mixed once into a stem and every output is the base BGM plus the stems it needs.
+    json_data = params.get('input')
+    input_foldername = params.get('sound_folder')
+    no_bgm = params.get('render_no_bgm', False)
 
-        sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
-        json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type)
-        if not json_sound_metadata:
-            raise Exception("Couldn't find sound metadata")
+    if not json_data:
+        raise Exception("Couldn't find input data")
 
-        print("Exporting %s..." % output_filename)
+    selected_difficulty = get_selected_difficulty(json_data, {'difficulty': ['max']})
 
-        bgms.append(create_wav_from_chart(chart_data,
-                              input_foldername,
-                              json_sound_metadata,
-                              output_filename,
-                              bgm_filename,
-                              tags=tags,
-                              no_bgm=params.get('render_no_bgm', False),
-                              ext=params.get('render_ext', "mp3"),
-                              quality=params.get('render_quality', '320k'),
-                              volume_part=params.get('render_volume', 100),
-                              volume_bgm=params.get('render_volume_bgm', 100),
-                              volume_auto=params.get('render_volume_auto', 100),
-                              ignore_auto=params.get('render_ignore_auto', False)))
+    if not selected_difficulty:
+        raise Exception("Couldn't find selected difficulty")
 
+    charts = []
+    for chart_data in chartdata.get_charts(json_data):
+        if chart_data['header']['is_metadata'] != 0:
+            continue
 
-    if not bgm_filename:
-        return
+        if chart_data['header']['difficulty'] != selected_difficulty:
+            continue
 
-    print("Saving to %s..." % output_filename)
+        charts.append(chart_data)
 
-    if not params.get('render_no_bgm', False):
-        output_audio = audio.get_audio_file(bgm_filename)
-    else:
-        if len(bgms) == 0:
-            return
+    bgm_filenames = {}
+    bases = {}
+    outputs = []
+    for parts, ignore_auto, output_filename in renders:
+        render_charts = [chart_data for chart_data in charts if ['drum', 'guitar', 'bass'][chart_data['header']['game_type']] in parts]
 
-        output_audio = bgms[0]
-        bgms = bgms[1:]
+        if not render_charts:
+            continue
+
+        # The merged BGM is the same for every render, XG style BGMs depend on the first part
+        bgm_key = 'bgm' if 'bgm' in json_data else render_charts[0]['header']['game_type']
+        if bgm_key not in bgm_filenames:
+            bgm_filenames[bgm_key] = get_bgm_filename(json_data, render_charts[0], input_foldername)
+
+        base_key = (bgm_filenames[bgm_key], tuple(id(chart_data) for chart_data in render_charts) if no_bgm else None)
+        if base_key not in bases:
+            bases[base_key] = get_base_samples(input_foldername,
+                                               bgm_filenames[bgm_key],
+                                               render_charts,
+                                               no_bgm,
+                                               params.get('render_volume_bgm', 100))
+
+        outputs.append((render_charts, ignore_auto, output_filename, base_key))
+
+    # Stems are mixed at every rate and length used by a base
+    lengths = {}
+    for output, rate in bases.values():
+        lengths[rate] = max(lengths.get(rate, 0), len(output))
+
+    with open_sound_archive(params) as sound_archive:
+        stems = {}
+        keysounds = {}
+        for chart_data in charts:
+            used = [(ignore_auto, bases[base_key][1]) for render_charts, ignore_auto, _, base_key in outputs if any(x is chart_data for x in render_charts)]
+
+            for rate in sorted(set([rate for _, rate in used])):
+                needs_auto = any(not ignore_auto for ignore_auto, x in used if x == rate)
+
+                stem = numpy.zeros((lengths[rate], 2), dtype=numpy.float32)
+                auto_stem = numpy.zeros((lengths[rate], 2), dtype=numpy.float32) if needs_auto else None
+
+                sound_metadata_type = ['drum', 'guitar', 'guitar'][chart_data['header']['game_type']]
+                json_sound_metadata = get_sound_metadata(params, json_data, input_foldername, sound_metadata_type, sound_archive)
+                if not json_sound_metadata:
+                    raise Exception("Couldn't find sound metadata")
+
+                mix_chart(stem,
+                          rate,
+                          chart_data,
+                          input_foldername,
+                          json_sound_metadata,
+                          volume_part=params.get('render_volume', 100),
+                          volume_auto=params.get('render_volume_auto', 100),
+                          ignore_auto=True,
+                          keysounds=keysounds.setdefault(rate, {}),
+                          auto_output=auto_stem,
+                          sound_archive=sound_archive)
+
+                stems[(id(chart_data), rate)] = (stem, auto_stem)
+
+    for render_charts, ignore_auto, output_filename, base_key in outputs:
+        base, rate = bases[base_key]
+        output = base.copy()
 
-    for bgm in bgms:
-        output_audio = output_audio.overlay(bgm)
+        for chart_data in render_charts:
+            stem, auto_stem = stems[(id(chart_data), rate)]
+            output += stem[:len(output)]
+
+            if not ignore_auto:
+                output += auto_stem[:len(output)]
+
+        print("Saving to %s..." % output_filename)
+
+        audio.export_samples(output, rate, output_filename, format=params.get('render_ext', "wav"), bitrate=params.get('render_quality', '320k'))
 
-    output_audio.export(params['output'], format=params.get('render_ext', "mp3"), tags={}, bitrate=params.get('render_quality', '320k'))
 
 class WavFormat:
     @staticmethod
@@ -376,10 +509,6 @@ class WavFormat:
     def to_chart(params):
         return generate_wav_from_json(params)
 
-    @staticmethod
-    def is_format(filename):
-        return False
-
 
 def get_class():
     return WavFormat
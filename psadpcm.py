@@ -0,0 +1,59 @@
+import numpy
+
+# PS-ADPCM (SPU/VAG) filter coefficients
+COEFS = [
+    (0, 0),
+    (60, 0),
+    (115, -52),
+    (98, -55),
+    (122, -60),
+]
+
+
+def decode_data(data):
+    # Frames are 16 bytes: shift/filter, flags and 28 4-bit samples, low nibble first
+    data = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+    frames = data[:len(data) // 0x10 * 0x10].reshape(-1, 0x10)
+
+    nibbles = numpy.empty((len(frames), 28), dtype=numpy.int32)
+    nibbles[:, 0::2] = frames[:, 2:] & 0x0f
+    nibbles[:, 1::2] = frames[:, 2:] >> 4
+    nibbles = (nibbles ^ 8) - 8
+
+    # Shifts above 12 are invalid and decoded as 9.
+    # Only filters 0 to 4 exist, higher filter indices are decoded as filter 0 (no prediction).
+    shifts = (frames[:, 0] & 0x0f).astype(numpy.int32)
+    shifts[shifts > 12] = 9
+    filters = (frames[:, 0] >> 4).astype(numpy.int32)
+    filters[filters >= len(COEFS)] = 0
+
+    # Everything but the prediction from the previous samples can be done on whole arrays
+    scaled = (nibbles << 12) >> shifts[:, None]
+
+    output = numpy.empty(len(frames) * 28, dtype=numpy.int16)
+
+    hist1 = 0
+    hist2 = 0
+    for i, (samples, filter_index) in enumerate(zip(scaled.tolist(), filters.tolist())):
+        if filter_index != 0:
+            coef1, coef2 = COEFS[filter_index]
+
+            for j, sample in enumerate(samples):
+                sample += (coef1 * hist1 + coef2 * hist2) >> 6
+
+                if sample > 32767:
+                    sample = 32767
+                elif sample < -32768:
+                    sample = -32768
+
+                samples[j] = sample
+                hist2 = hist1
+                hist1 = sample
+
+        else:
+            hist2 = samples[-2]
+            hist1 = samples[-1]
+
+        output[i*28:(i+1)*28] = samples
+
+    return output
@@ -1,13 +1,16 @@
 # Gitadora Re:evolve SQ3 format
 import argparse
+import concurrent.futures
+import fnmatch
 import glob
-import importlib
 import json
 import os
 import shutil
 import sys
 import threading
 
+import audio
+import convcache
 import tmpfile
 
 import wavbintool
@@ -19,40 +22,72 @@ import event
 import plugins
 
 running_threads = []
+thread_errors = []
+
+# Options that change the output of a conversion, used for the conversion cache key
+CACHE_OPTIONS = [
+    'input_format',
+    'output_format',
+    'ifs_target',
+    'parts',
+    'difficulty',
+    'merge_guitars',
+    'no_sounds',
+    'copy_raw_files',
+    'generate_bgms',
+    'music_id',
+    'render_auto_name',
+    'render_ext',
+    'render_quality',
+    'render_volume',
+    'render_volume_bgm',
+    'render_volume_auto',
+    'render_no_bgm',
+    'render_ignore_auto',
+    'dtx_pad_start',
+    'dtx_pad_end',
+    'dtx_fake_timesigs',
+]
 
 def find_handler(input_filename, input_format):
-    formats = [importlib.import_module('plugins.' + name).get_class() for name in plugins.__all__]
+    # Only the selected plugin is imported
+    module = None
 
-    for handler in formats:
-        if input_format is not None and handler.get_format_name().lower() == input_format.lower():
-            return handler
-        elif input_filename is not None and handler.is_format(input_filename):
-            return handler
+    if input_format is not None:
+        module = plugins.get_module_by_format_name(input_format)
 
-    return None
+    if module is None and input_filename is not None:
+        module = plugins.get_module_by_header(input_filename)
+
+    if module is None:
+        return None
 
+    return plugins.load_handler(module)
 
-def filter_charts(json_data, params):
-    json_data = json.loads(json_data)
 
+def filter_charts(json_data, params):
     if 'charts' not in json_data:
         return json_data
 
     min_diff = None
     max_diff = None
     for chart in json_data['charts']:
-        if min_diff == None or chart['header']['difficulty'] < min_diff:
-            min_diff = chart['header']['difficulty']
+        header = chart['header']
+
+        if min_diff == None or header['difficulty'] < min_diff:
+            min_diff = header['difficulty']
 
-        if max_diff == None or chart['header']['difficulty'] > max_diff:
-            max_diff = chart['header']['difficulty']
+        if max_diff == None or header['difficulty'] > max_diff:
+            max_diff = header['difficulty']
 
     filtered_charts = []
     for chart in json_data['charts']:
-        if chart['header']['is_metadata'] != 0:
+        header = chart['header']
+
+        if header['is_metadata'] != 0:
             continue
 
-        part = ["drum", "guitar", "bass", "open"][chart['header']['game_type']]
+        part = ["drum", "guitar", "bass", "open"][header['game_type']]
         has_all = 'all' in params['parts']
         has_part = part in params['parts']
 
@@ -60,9 +95,9 @@ def filter_charts(json_data, params):
             filtered_charts.append(chart)
             continue
 
-        diff = ["nov", "bsc", "adv", "ext", "mst"][chart['header']['difficulty']]
-        has_min = 'min' in params['difficulty'] and chart['header']['difficulty'] == min_diff
-        has_max = 'max' in params['difficulty'] and chart['header']['difficulty'] == max_diff
+        diff = ["nov", "bsc", "adv", "ext", "mst"][header['difficulty']]
+        has_min = 'min' in params['difficulty'] and header['difficulty'] == min_diff
+        has_max = 'max' in params['difficulty'] and header['difficulty'] == max_diff
         has_all = 'all' in params['difficulty']
         has_diff = diff in params['difficulty']
 
@@ -73,7 +108,7 @@ def filter_charts(json_data, params):
     for chart in filtered_charts:
         json_data['charts'].remove(chart)
 
-    return json.dumps(json_data, indent=4)
+    return json_data
 
 
 def process_file(params):
@@ -100,6 +135,7 @@ def process_file(params):
 
     print("Using {} handler to process this file...".format(input_handler.get_format_name()))
 
+    # Handlers exchange the chart document in memory, only the JSON handler serializes it
     json_data = input_handler.to_json(params)
 
     # Filter based on difficulty and parts here
@@ -125,12 +161,414 @@ def get_sound_metadata(sound_folder):
     return None
 
 
+def get_ifs_file_sets(filenames, ifs_target=None, no_sounds=False):
+    # Try to match charts with sound files
+    guitar = {}
+    drum = {}
+    for filename in filenames:
+        base_filename = os.path.basename(filename)
+
+        target_charts = [".sq3", ".sq2"]
+        target_events = [".ev2", ".evt"]
+        if ifs_target:
+            if ifs_target.lower() == "sq2":
+                target_charts = [".sq2"]
+                target_events = [".evt", ".ev2"]
+            elif ifs_target.lower() == "sq3":
+                target_charts = [".sq3"]
+                target_events = [".ev2", ".evt"]
+            else:
+                raise Exception("Invalid IFS target selected")
+
+        if base_filename[-4:] in target_charts:
+            if base_filename[0] == 'd':
+                drum['seq'] = filename
+            elif base_filename[0] == 'g':
+                guitar['seq'] = filename
+        elif base_filename[-4:] == ".va3" and not no_sounds:
+            if base_filename[-5] == 'd':
+                drum['sound'] = filename
+            elif base_filename[-5] == 'g':
+                guitar['sound'] = filename
+        elif base_filename[-4:] in target_events:
+            # Give priority to the events file at the top of the list
+            if base_filename[-4:] != target_events[0] and 'events' in drum:
+                continue
+
+            event_xml = eamxml.get_raw_xml(open(filename, "rb").read())
+
+            if len(event_xml) > 0:
+                events = event.get_bonus_notes_by_timestamp(event_xml)
+                drum['events'] = events
+                guitar['events'] = events
+
+    return drum, guitar
+
+
+def get_params(args, **kwargs):
+    params = {
+        "input": args.input if args.input else None,
+        "input_format": args.input_format if args.input_format else None,
+        "output": args.output,
+        "output_format": args.output_format,
+        "sound_folder": args.sound_folder,
+        "sound_metadata": None,
+        "sound_archive": args.sound_archive,
+        "event_file": args.event_file if args.event_file else None,
+        "parts": args.parts,
+        "difficulty": args.difficulty,
+        "merge_guitars": args.merge_guitars,
+        "events": {},
+        "musicdb": args.music_db,
+        "musicid": args.music_id,
+        "input_split": {
+            part: {diff: getattr(args, "input_%s_%s" % (part, diff)) for diff in ['nov', 'bsc', 'adv', 'ext', 'mst']}
+            for part in ['drum', 'guitar', 'bass', 'open']
+        },
+        "render_no_bgm": args.render_no_bgm,
+        "render_auto_name": args.render_auto_name,
+        "render_ext": args.render_ext,
+        "render_quality": args.render_quality,
+        "render_volume": args.render_volume,
+        "render_volume_bgm": args.render_volume_bgm,
+        "render_ignore_auto": args.render_ignore_auto,
+        "dtx_pad_start": args.dtx_pad_start,
+        "dtx_pad_end": args.dtx_pad_end,
+        "dtx_fake_timesigs": args.dtx_fake_timesigs,
+        "no_sounds": args.no_sounds,
+        "generate_bgms": args.generate_bgms,
+        "sound_workers": args.sound_workers,
+    }
+
+    params.update(kwargs)
+
+    return params
+
+
+def get_set_params(args, file_set, sound_folder):
+    return get_params(
+        args,
+        input=file_set['seq'],
+        input_format=None,
+        sound_folder=sound_folder,
+        sound_metadata=get_sound_metadata(sound_folder),
+        event_file=file_set['event'] if 'event' in file_set else None,
+        events=file_set['events'] if 'events' in file_set else {},
+    )
+
+
+def get_ifs_files(filename, pattern="*", path=None):
+    if os.path.isdir(filename):
+        return glob.glob(os.path.join(filename, pattern))
+
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+
+    filenames, _ = ifs.extract(filename, path)
+
+    if pattern != "*":
+        filenames = [x for x in filenames if fnmatch.fnmatch(os.path.basename(x), pattern)]
+
+    return filenames
+
+
+def get_cache_inputs(args, inputs):
+    # The music database is read when converting from SQ2/SQ3 so it's part of the input too
+    if args.music_db:
+        inputs.append(('musicdb', args.music_db))
+    else:
+        inputs += [('musicdb', "gitadora_music.csv"), ('musicdb', "mdb_xg.xml")]
+
+    inputs = [(role, filename) for role, filename in inputs if filename and os.path.exists(filename)]
+
+    options = {k: getattr(args, k) for k in CACHE_OPTIONS}
+    options['inputs'] = [role for role, _ in inputs]
+
+    return [filename for _, filename in inputs], options
+
+
+def get_cache_key(args, inputs, roots):
+    input_filenames, options = get_cache_inputs(args, inputs)
+    return convcache.get_cache_key(input_filenames, options, convcache.get_output_filenames(args.cache_folder, roots))
+
+
+def get_cache_roots(output, sound_folder=None):
+    roots = [output]
+
+    if sound_folder and os.path.abspath(sound_folder) != os.path.abspath(output):
+        roots.append(sound_folder)
+
+    return roots
+
+
+def record_thread_error(hook_args):
+    thread_errors.append("%s: %s" % (hook_args.exc_type.__name__, hook_args.exc_value))
+    threading.__excepthook__(hook_args)
+
+
+########################
+#     Batch mode       #
+########################
+
+def get_batch_songs(input_batch):
+    # Takes either a game data folder containing m####_seq.ifs/m####_bgm.ifs pairs
+    # or a JSON manifest listing {"seq": ..., "bgm": ...} entries
+    songs = []
+
+    if os.path.isdir(input_batch):
+        for seq_filename in sorted(glob.glob(os.path.join(input_batch, "**", "m*_seq.ifs"), recursive=True)):
+            bgm_filename = seq_filename[:-len("_seq.ifs")] + "_bgm.ifs"
+            songs.append({
+                'seq': seq_filename,
+                'bgm': bgm_filename if os.path.exists(bgm_filename) else None,
+            })
+
+    else:
+        with open(input_batch, "r") as f:
+            manifest = json.loads(f.read())
+
+        base_path = os.path.dirname(input_batch)
+        for entry in manifest:
+            songs.append({
+                'seq': os.path.join(base_path, entry['seq']),
+                'bgm': os.path.join(base_path, entry['bgm']) if entry.get('bgm') else None,
+            })
+
+    for song in songs:
+        name = os.path.splitext(os.path.basename(song['seq'].rstrip("/\\")))[0]
+        song['name'] = name[:-len("_seq")] if name.endswith("_seq") else name
+
+    return songs
+
+
+def run_batch_task(func, *args):
+    # Runs inside a worker process. Errors are returned instead of raised so
+    # a broken song only fails itself and not the rest of the batch.
+    # Handlers write VA3s and BGMs from their own threads, those errors count too.
+    threading.excepthook = record_thread_error
+    del thread_errors[:]
+
+    try:
+        result = func(*args)
+    except (Exception, SystemExit) as e:
+        return False, "%s: %s" % (type(e).__name__, e)
+    finally:
+        tmpfile.tmpcleanup()
+
+    if thread_errors:
+        return False, "Thread failed: %s" % ", ".join(thread_errors)
+
+    return True, result
+
+
+def extract_batch_seq(filename, path, ifs_target, no_sounds, copy_folder=None):
+    filenames = get_ifs_files(filename, "*", path)
+
+    if copy_folder:
+        for filename in filenames:
+            shutil.copy2(filename, os.path.join(copy_folder, os.path.basename(filename)))
+
+    return get_ifs_file_sets(filenames, ifs_target, no_sounds)
+
+
+def extract_batch_bgm(filename, path, copy_folder=None):
+    filenames = get_ifs_files(filename, "*.bin", path)
+
+    if copy_folder:
+        for filename in filenames:
+            shutil.copy2(filename, os.path.join(copy_folder, os.path.basename(filename)))
+
+    return filenames
+
+
+def convert_batch_set(params):
+    params['sound_metadata'] = get_sound_metadata(params['sound_folder'])
+    process_file(params)
+
+
+def run_batch(args):
+    songs = get_batch_songs(args.input_batch)
+    workers = 1 if args.single_threaded else args.batch_workers
+
+    # Only a few songs are worked on at a time so extracted files don't pile up
+    queued_songs = list(reversed(songs))
+    max_active_songs = workers * 2
+    active_songs = []
+    pending = {}
+    failed = []
+
+    work_folder = tmpfile.mkdtemp(prefix="batch")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        def submit(song, stage, func, *func_args):
+            future = executor.submit(run_batch_task, func, *func_args)
+            pending[future] = (song, stage)
+            song['tasks'] += 1
+
+        def start_song(song):
+            song['output'] = os.path.join(args.output, song['name'])
+            song['sound_folder'] = os.path.join(args.sound_folder, song['name']) if args.sound_folder else song['output']
+            song['work'] = os.path.join(work_folder, song['name'])
+            song['sets'] = None
+            song['bgm_tasks'] = None
+            song['set_stage'] = None
+            song['tasks'] = 0
+            song['error'] = None
+            song['cache_key'] = None
+
+            for foldername in [song['output'], song['sound_folder']]:
+                if not os.path.exists(foldername):
+                    os.makedirs(foldername)
+
+            if args.cache_folder:
+                song['cache_roots'] = get_cache_roots(song['output'], song['sound_folder'])
+                song['cache_key'] = get_cache_key(args, [('seq', song['seq']), ('bgm', song['bgm'])], song['cache_roots'])
+
+                if convcache.restore(args.cache_folder, song['cache_key'], song['cache_roots']):
+                    print("Restored %s from cache" % song['name'])
+                    return
+
+                song['cache_snapshot'] = convcache.get_snapshot(song['cache_roots'])
+
+            print("Starting %s..." % song['name'])
+
+            copy_folder = song['sound_folder'] if args.copy_raw_files else None
+            submit(song, 'seq', extract_batch_seq, song['seq'], os.path.join(song['work'], "seq"), args.ifs_target, args.no_sounds, copy_folder)
+
+            if song['bgm'] and (args.copy_raw_files or not args.no_sounds):
+                copy_folder = song['output'] if args.copy_raw_files else None
+                submit(song, 'bgm', extract_batch_bgm, song['bgm'], os.path.join(song['work'], "bgm"), copy_folder)
+            else:
+                song['bgm_tasks'] = 0
+
+            active_songs.append(song)
+
+        def advance_song(song):
+            # Sets are handled one after another because the VA3 extraction
+            # writes the metadata.json that the chart conversion reads
+            if song['error'] or song['sets'] is None or song['set_stage'] is not None:
+                return
+
+            while song['sets']:
+                file_set = song['sets'][0]
+
+                if 'sound' in file_set and not args.no_sounds and not file_set.get('sound_done'):
+                    song['set_stage'] = 'va3'
+                    # The batch pool already runs songs in parallel, decode the entries serially
+                    submit(song, 'va3', vas3tool.read_vas3, file_set['sound'], song['sound_folder'], False, False, 1)
+                    return
+
+                if song['bgm_tasks'] != 0:
+                    # Wait for the BGMs, they are needed when rendering audio
+                    return
+
+                output = song['output']
+                if args.output_format.lower() == "wav":
+                    output = os.path.join(song['output'], "%s.%s" % (song['name'], args.render_ext if args.render_ext else "mp3"))
+
+                params = get_params(
+                    args,
+                    input=file_set['seq'],
+                    input_format=None,
+                    output=output,
+                    sound_folder=song['sound_folder'],
+                    event_file=file_set['event'] if 'event' in file_set else None,
+                    events=file_set['events'] if 'events' in file_set else {},
+                    sound_workers=1,
+                )
+
+                song['set_stage'] = 'convert'
+                submit(song, 'convert', convert_batch_set, params)
+                return
+
+        def finish_song(song):
+            active_songs.remove(song)
+            shutil.rmtree(song['work'], ignore_errors=True)
+
+            if song['error']:
+                print("Failed %s: %s" % (song['name'], song['error']))
+                failed.append(song)
+                return
+
+            if song['cache_key']:
+                changed_files = convcache.get_changed_files(song['cache_snapshot'], song['cache_roots'])
+                convcache.store(args.cache_folder, song['cache_key'], song['cache_roots'], changed_files, args.cache_size * 1024 * 1024)
+
+            print("Finished %s" % song['name'])
+
+        while queued_songs or active_songs:
+            while queued_songs and len(active_songs) < max_active_songs:
+                start_song(queued_songs.pop())
+
+            done, _ = concurrent.futures.wait(list(pending.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                song, stage = pending.pop(future)
+                song['tasks'] -= 1
+
+                try:
+                    success, result = future.result()
+                except Exception as e:
+                    success, result = False, "%s: %s" % (type(e).__name__, e)
+
+                if not success:
+                    song['error'] = song['error'] or "%s (%s)" % (result, stage)
+
+                elif song['error']:
+                    # Let the song's remaining tasks drain without starting new ones
+                    pass
+
+                elif stage == 'seq':
+                    drum, guitar = result
+                    song['sets'] = []
+
+                    if "guitar" in args.parts or "bass" in args.parts or "open" in args.parts:
+                        song['sets'].append(guitar)
+
+                    if "drum" in args.parts:
+                        song['sets'].append(drum)
+
+                    song['sets'] = [x for x in song['sets'] if x.get('seq')]
+
+                elif stage == 'bgm':
+                    song['bgm_tasks'] = 0
+
+                    if not args.no_sounds:
+                        for filename in result:
+                            output_filename = os.path.join(song['sound_folder'], os.path.basename(filename).replace(".bin", ".wav"))
+                            submit(song, 'bgm_decode', wavbintool.parse_bin, filename, output_filename)
+                            song['bgm_tasks'] += 1
+
+                elif stage == 'bgm_decode':
+                    song['bgm_tasks'] -= 1
+
+                elif stage == 'va3':
+                    song['sets'][0]['sound_done'] = True
+                    song['set_stage'] = None
+
+                elif stage == 'convert':
+                    song['sets'].pop(0)
+                    song['set_stage'] = None
+
+                advance_song(song)
+
+                if song['tasks'] == 0 and (song['error'] or song['sets'] == []):
+                    finish_song(song)
+
+    print("Converted %d of %d songs" % (len(songs) - len(failed), len(songs)))
+    for song in failed:
+        print("\t%s: %s" % (song['name'], song['error']))
+
+    return len(failed) == 0
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     input_group = parser.add_argument_group('input')
     input_group.add_argument('--input', help='Input file/folder')
     input_group.add_argument('--input-format', help='Input file format')
     input_group.add_argument('--sound-folder', help='Input folder containing sounds', default="")
+    input_group.add_argument('--sound-archive', help='Input VA3 archive to read keysounds from instead of an extracted sound folder (for WAV/DTX)', default=None)
     input_group.add_argument('--event-file', help='Input file containing event information (for SQ2/SQ3)')
 
     input_split_group = parser.add_argument_group('input_split')
@@ -146,6 +584,10 @@ if __name__ == "__main__":
     input_ifs_group.add_argument('--input-ifs-bgm', help='Input file/folder for BGM (IFS)')
     input_ifs_group.add_argument('--ifs-target', help="Target specific chart type within IFS", default=None, choices=['sq3', 'sq2'])
 
+    input_batch_group = parser.add_argument_group('input_batch')
+    input_batch_group.add_argument('--input-batch', help='Game data folder containing m####_seq.ifs/m####_bgm.ifs pairs, or a JSON manifest of {"seq": ..., "bgm": ...} entries. Each song is converted into its own folder under --output')
+    input_batch_group.add_argument('--batch-workers', help="Number of worker processes for batch conversion", default=os.cpu_count(), type=int)
+
     parser.add_argument('--output', help='Output file/folder', required=True)
     parser.add_argument('--output-format', help='Output file format', required=True)
 
@@ -173,9 +615,18 @@ if __name__ == "__main__":
     parser.add_argument('--dtx-fake-timesigs', help="Fake time signatures when converting to DTX to work around x/4 limitation", default=False, action='store_true')
 
     parser.add_argument('--single-threaded', help="Process charts in single threads", default=False, action='store_true')
+    parser.add_argument('--sound-workers', help="Number of processes used to encode or decode VA3 keysounds, shared by the drum and guitar archives (batch mode always uses 1 per song)", default=os.cpu_count() or 1, type=int)
+
+    parser.add_argument('--cache-folder', help="Reuse outputs of previous conversions with the same input files and options, stored in this folder", default=None)
+    parser.add_argument('--cache-size', help="Maximum size of the conversion cache in MB, least recently used outputs are removed first", default=10240, type=int)
+
+    parser.add_argument('--pcm-cache-size', help="Memory budget in MB for decoded sounds shared between renders and conversions", default=audio.DEFAULT_PCM_CACHE_SIZE // 1024 // 1024, type=int)
+    parser.add_argument('--pcm-cache-folder', help="Also keep decoded sounds in this folder so later runs and worker processes can reuse them", default=None)
 
     args = parser.parse_args()
 
+    audio.set_pcm_cache(args.pcm_cache_size * 1024 * 1024, args.pcm_cache_folder)
+
     # Clean parts and difficulty
     if 'all' in args.parts:
         args.parts = ['drum', 'guitar', 'bass', 'open']
@@ -191,7 +642,55 @@ if __name__ == "__main__":
         if 'all' in args.difficulty or len(args.difficulty) > 1:
             raise Exception("Can only specify one difficulty for WAV export mode")
 
-    if args.input_ifs_seq:
+    success = True
+    cache_key = None
+    cache_names = None
+
+    if args.cache_folder and not args.input_batch:
+        if args.output_format.lower() == "wav":
+            # Only the rendered file is an output, the folder it's in isn't walked
+            cache_roots = get_cache_roots(os.path.dirname(args.output) or ".")
+            cache_names = [os.path.basename(args.output)]
+        elif args.input_ifs_seq:
+            cache_roots = get_cache_roots(args.output, args.sound_folder)
+        else:
+            cache_roots = get_cache_roots(args.output)
+
+        cache_inputs = [
+            ('input', args.input),
+            ('ifs_seq', args.input_ifs_seq),
+            ('ifs_bgm', args.input_ifs_bgm),
+            ('event_file', args.event_file),
+        ]
+
+        for part in ['drum', 'guitar', 'bass', 'open']:
+            for diff in ['nov', 'bsc', 'adv', 'ext', 'mst']:
+                cache_inputs.append(('input_%s_%s' % (part, diff), getattr(args, "input_%s_%s" % (part, diff))))
+
+        if not args.input_ifs_seq:
+            # Sounds are read from the sound folder when creating SQ2/SQ3/WAV files
+            cache_inputs.append(('sound_folder', args.sound_folder))
+
+        cache_inputs.append(('sound_archive', args.sound_archive))
+
+        cache_key = get_cache_key(args, cache_inputs, cache_roots)
+        cache_snapshot = convcache.get_snapshot(cache_roots, cache_names)
+        threading.excepthook = record_thread_error
+
+    if args.single_threaded or args.input_batch:
+        args.sound_workers = 1
+    else:
+        # The pool is created here on the main thread and shared by the VA3 threads
+        vas3tool.start_executor(args.sound_workers)
+
+    if args.input_batch:
+        success = run_batch(args)
+
+    elif cache_key and convcache.restore(args.cache_folder, cache_key, cache_roots):
+        print("Restored outputs from cache")
+        cache_key = None
+
+    elif args.input_ifs_seq:
         if os.path.isdir(args.input_ifs_seq):
             filenames = glob.glob(args.input_ifs_seq + "/*")
             ifs_path = args.input_ifs_seq
@@ -199,44 +698,7 @@ if __name__ == "__main__":
             filenames, ifs_path = ifs.extract(args.input_ifs_seq)
 
         # Try to match charts with sound files, then extract as required
-        guitar = {}
-        drum = {}
-        for filename in filenames:
-            base_filename = os.path.basename(filename)
-
-            target_charts = [".sq3", ".sq2"]
-            target_events = [".ev2", ".evt"]
-            if args.ifs_target:
-                if args.ifs_target.lower() == "sq2":
-                    target_charts = [".sq2"]
-                    target_events = [".evt", ".ev2"]
-                elif args.ifs_target.lower() == "sq3":
-                    target_charts = [".sq3"]
-                    target_events = [".ev2", ".evt"]
-                else:
-                    raise Exception("Invalid IFS target selected")
-
-            if base_filename[-4:] in target_charts:
-                if base_filename[0] == 'd':
-                    drum['seq'] = filename
-                elif base_filename[0] == 'g':
-                    guitar['seq'] = filename
-            elif base_filename[-4:] == ".va3" and not args.no_sounds:
-                if base_filename[-5] == 'd':
-                    drum['sound'] = filename
-                elif base_filename[-5] == 'g':
-                    guitar['sound'] = filename
-            elif base_filename[-4:] in target_events:
-                # Give priority to the events file at the top of the list
-                if base_filename[-4:] != target_events[0] and 'events' in drum:
-                    continue
-
-                event_xml = eamxml.get_raw_xml(open(filename, "rb").read())
-
-                if len(event_xml) > 0:
-                    events = event.get_bonus_notes_by_timestamp(event_xml)
-                    drum['events'] = events
-                    guitar['events'] = events
+        drum, guitar = get_ifs_file_sets(filenames, args.ifs_target, args.no_sounds)
 
         if args.sound_folder:
             sound_folder = args.sound_folder
@@ -292,67 +754,9 @@ if __name__ == "__main__":
             # Extract va3 files
             if 'sound' in file_set and not args.no_sounds:
                 print("Parsing %s..." % file_set['sound'])
-                vas3tool.read_vas3(file_set['sound'], sound_folder)
-
-            params = {
-                "input": file_set['seq'],
-                "input_format": None,
-                "output": args.output,
-                "output_format": args.output_format,
-                "sound_folder": sound_folder,
-                "sound_metadata": get_sound_metadata(sound_folder),
-                "event_file": file_set['event'] if 'event' in file_set else None,
-                "parts": args.parts,
-                "difficulty": args.difficulty,
-                "merge_guitars": args.merge_guitars,
-                "events": file_set['events'] if 'events' in file_set else {},
-                "musicdb": args.music_db,
-                "musicid": args.music_id,
-                "input_split": {
-                    "drum": {
-                        "nov": args.input_drum_nov,
-                        "bsc": args.input_drum_bsc,
-                        "adv": args.input_drum_adv,
-                        "ext": args.input_drum_ext,
-                        "mst": args.input_drum_mst,
-                    },
-                    "guitar": {
-                        "nov": args.input_guitar_nov,
-                        "bsc": args.input_guitar_bsc,
-                        "adv": args.input_guitar_adv,
-                        "ext": args.input_guitar_ext,
-                        "mst": args.input_guitar_mst,
-                    },
-                    "bass": {
-                        "nov": args.input_bass_nov,
-                        "bsc": args.input_bass_bsc,
-                        "adv": args.input_bass_adv,
-                        "ext": args.input_bass_ext,
-                        "mst": args.input_bass_mst,
-                    },
-                    "open": {
-                        "nov": args.input_open_nov,
-                        "bsc": args.input_open_bsc,
-                        "adv": args.input_open_adv,
-                        "ext": args.input_open_ext,
-                        "mst": args.input_open_mst,
-                    }
-                },
-                "render_no_bgm": args.render_no_bgm,
-                "render_auto_name": args.render_auto_name,
-                "render_ext": args.render_ext,
-                "render_quality": args.render_quality,
-                "render_volume": args.render_volume,
-                "render_volume_bgm": args.render_volume_bgm,
-                "render_ignore_auto": args.render_ignore_auto,
-                "dtx_pad_start": args.dtx_pad_start,
-                "dtx_pad_end": args.dtx_pad_end,
-                "dtx_fake_timesigs": args.dtx_fake_timesigs,
-                "no_sounds": args.no_sounds,
-                "generate_bgms": args.generate_bgms,
-            }
+                vas3tool.read_vas3(file_set['sound'], sound_folder, workers=args.sound_workers)
 
-            process_file(params)
+            process_file(get_set_params(args, file_set, sound_folder))
 
 
             if args.input_ifs_seq and args.copy_raw_files:
@@ -383,63 +787,11 @@ if __name__ == "__main__":
                 handle_set(drum)
 
     else:
-        params = {
-            "input": args.input if args.input else None,
-            "input_format": args.input_format if args.input_format else None,
-            "output": args.output,
-            "output_format": args.output_format,
-            "sound_folder": args.sound_folder,
-            "sound_metadata": get_sound_metadata(args.sound_folder),
-            "event_file": args.event_file if args.event_file else None,
-            "parts": args.parts,
-            "difficulty": args.difficulty,
-            "merge_guitars": args.merge_guitars,
-            "events": event.get_bonus_notes_by_timestamp(eamxml.get_raw_xml(open(args.event_file, "rb").read())) if args.event_file else {},
-            "musicdb": args.music_db,
-            "musicid": args.music_id,
-            "input_split": {
-                "drum": {
-                    "nov": args.input_drum_nov,
-                    "bsc": args.input_drum_bsc,
-                    "adv": args.input_drum_adv,
-                    "ext": args.input_drum_ext,
-                    "mst": args.input_drum_mst,
-                },
-                "guitar": {
-                    "nov": args.input_guitar_nov,
-                    "bsc": args.input_guitar_bsc,
-                    "adv": args.input_guitar_adv,
-                    "ext": args.input_guitar_ext,
-                    "mst": args.input_guitar_mst,
-                },
-                "bass": {
-                    "nov": args.input_bass_nov,
-                    "bsc": args.input_bass_bsc,
-                    "adv": args.input_bass_adv,
-                    "ext": args.input_bass_ext,
-                    "mst": args.input_bass_mst,
-                },
-                "open": {
-                    "nov": args.input_open_nov,
-                    "bsc": args.input_open_bsc,
-                    "adv": args.input_open_adv,
-                    "ext": args.input_open_ext,
-                    "mst": args.input_open_mst,
-                }
-            },
-            "render_no_bgm": args.render_no_bgm,
-            "render_auto_name": args.render_auto_name,
-            "render_ext": args.render_ext,
-            "render_quality": args.render_quality,
-            "render_volume": args.render_volume,
-            "render_volume_bgm": args.render_volume_bgm,
-            "render_ignore_auto": args.render_ignore_auto,
-            "dtx_pad_start": args.dtx_pad_start,
-            "dtx_pad_end": args.dtx_pad_end,
-            "dtx_fake_timesigs": args.dtx_fake_timesigs,
-            "no_sounds": args.no_sounds,
-            "generate_bgms": args.generate_bgms,
-        }
+        params = get_params(
+            args,
+            sound_metadata=get_sound_metadata(args.sound_folder),
+            events=event.get_bonus_notes_by_timestamp(eamxml.get_raw_xml(open(args.event_file, "rb").read())) if args.event_file else {},
+        )
 
         if not args.single_threaded:
             parse_thread = threading.Thread(target=process_file, args=(params,))
@@ -452,4 +804,12 @@ if __name__ == "__main__":
         for thread in running_threads:
             thread.join()
 
+    vas3tool.stop_executor()
+
+    if cache_key and not thread_errors:
+        convcache.store(args.cache_folder, cache_key, cache_roots, convcache.get_changed_files(cache_snapshot, cache_roots, cache_names), args.cache_size * 1024 * 1024)
+
     tmpfile.tmpcleanup()
+
+    if not success:
+        exit(1)
@@ -0,0 +1,68 @@
+import numpy
+import pytest
+
+import adpcmwave
+
+# Known vectors made with the original encoder/decoder in _misc/adpcmwavetool.cpp
+STEREO_PCM = [
+    -6000, 0, -4500, 3926, -3000, 7420, -1500, 10097, 0, 11663, 1500, 11944,
+    3000, 10911, 4500, 8677, 6000, 5487, 7500, 1693, 9000, -2286, 10500, -6015,
+    12000, -9081, 13500, -11148, 15000, -11987, 16500, -11507, 18000, -9759, 19500, -6938,
+    21000, -3352, 22500, 601, 24000, 4489, 25500, 7883, 27000, 10409, 28500, 11790,
+]
+STEREO_ADPCM = bytes.fromhex("f0f7d7374722384a3a3c3b4b3b3a49303344353344333240")
+STEREO_DECODED = [
+    -480, 32, -1500, 512, -3106, 1532, -1608, 3722, 138, 8432, 1318, 11802,
+    2816, 11188, 4562, 8398, 6214, 5868, 7712, 1728, 9070, -2178, 10654, -5720,
+    12152, -8940, 13510, -11030, 15094, -12170, 16592, -11824, 17950, -9626, 19534, -7052,
+    21032, -3246, 22390, 296, 23974, 4436, 25472, 8342, 26830, 10872, 28414, 11332,
+]
+
+MONO_PCM = [0, 3000, 9000, 20000, 32767, 32767, 20000, 5000, -5000, -20000, -32768, -32768, -10000, 0, 100, -100]
+MONO_ADPCM = bytes.fromhex("0777770dacb05280")
+MONO_DECODED = [32, 512, 1532, 3722, 8432, 18542, 19990, 5514, -4116, -19884, -32768, -30842, -11570, 1250, -1082, 1038]
+
+VECTORS = [
+    (2, STEREO_PCM, STEREO_ADPCM, STEREO_DECODED),
+    (1, MONO_PCM, MONO_ADPCM, MONO_DECODED),
+]
+
+
+def decode(data, channels, states=None):
+    return numpy.frombuffer(bytes(adpcmwave.decode_data(data, 48000, channels, 16, states)), dtype='<i2').tolist()
+
+
+@pytest.mark.parametrize("channels, pcm, encoded, decoded", VECTORS)
+def test_encode(channels, pcm, encoded, decoded):
+    assert bytes(adpcmwave.encode_data(numpy.array(pcm, dtype='<i2'), channels)) == encoded
+
+
+@pytest.mark.parametrize("channels, pcm, encoded, decoded", VECTORS)
+def test_decode(channels, pcm, encoded, decoded):
+    assert decode(encoded, channels) == decoded
+
+
+@pytest.mark.parametrize("channels, pcm, encoded, decoded", VECTORS)
+def test_decode_blocks(channels, pcm, encoded, decoded):
+    # Decoding block by block with the same states gives the same samples as decoding everything at once
+    states = adpcmwave.get_decoder_states(channels)
+    output = []
+
+    for i in range(0, len(encoded), 3):
+        output += decode(encoded[i:i+3], channels, states)
+
+    assert output == decoded
+
+
+@pytest.mark.parametrize("channels", [1, 2])
+def test_round_trip(channels):
+    # Once the step size has adapted the decoded samples stay close to the input
+    t = numpy.arange(4096)
+    pcm = (numpy.sin(t / 20) * 8000 + numpy.sin(t / 3) * 2000).astype('<i2')
+
+    encoded = adpcmwave.encode_data(pcm, channels)
+    decoded = numpy.array(decode(encoded, channels), dtype=numpy.int32)
+
+    assert len(encoded) == len(pcm) // 2
+    assert len(decoded) == len(pcm)
+    assert numpy.abs(decoded[256:] - pcm[256:]).max() < 1000
@@ -0,0 +1,79 @@
+import os
+
+import convcache
+
+
+def write(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    with open(filename, "w") as f:
+        f.write(data)
+
+
+def get_key(cache_folder, inputs, roots):
+    return convcache.get_cache_key(inputs, {}, convcache.get_output_filenames(cache_folder, roots))
+
+
+def test_editing_input_changes_key(tmp_path):
+    cache_folder = str(tmp_path / "cache")
+    input_filename = str(tmp_path / "in" / "a.dtx")
+    roots = [str(tmp_path / "out")]
+
+    write(input_filename, "a")
+    key = get_key(cache_folder, [input_filename], roots)
+
+    write(input_filename, "b")
+    assert get_key(cache_folder, [input_filename], roots) != key
+
+
+def test_earlier_output_used_as_input(tmp_path):
+    # A file written by an earlier cached conversion is still hashed when it is the input of the next one
+    cache_folder = str(tmp_path / "cache")
+    out = str(tmp_path / "out")
+    write(os.path.join(out, "a.dtx"), "a")
+    write(os.path.join(out, "b.dtx"), "b")
+    convcache.store(cache_folder, "0" * 64, [out], [(0, "a.dtx"), (0, "b.dtx")])
+
+    roots = [str(tmp_path / "out2")]
+    key_a = get_key(cache_folder, [os.path.join(out, "a.dtx")], roots)
+    key_b = get_key(cache_folder, [os.path.join(out, "b.dtx")], roots)
+    assert key_a != key_b
+
+    write(os.path.join(out, "a.dtx"), "edited")
+    assert get_key(cache_folder, [os.path.join(out, "a.dtx")], roots) != key_a
+
+
+def test_outputs_in_sound_folder_keep_key(tmp_path):
+    # When the sound folder is also the output folder, the files written there don't change the next key
+    cache_folder = str(tmp_path / "cache")
+    out = str(tmp_path / "out")
+    write(os.path.join(out, "0001.wav"), "sound")
+    roots = [out]
+
+    key = get_key(cache_folder, [out], roots)
+    snapshot = convcache.get_snapshot(roots)
+    write(os.path.join(out, "d0001.sq3"), "chart")
+    convcache.store(cache_folder, key, roots, convcache.get_changed_files(snapshot, roots))
+
+    assert get_key(cache_folder, [out], roots) == key
+
+    # Other roots don't share the exclusions
+    assert get_key(cache_folder, [out], [str(tmp_path / "other")]) != key
+
+    write(os.path.join(out, "0001.wav"), "edited")
+    assert get_key(cache_folder, [out], roots) != key
+
+
+def test_restore(tmp_path):
+    cache_folder = str(tmp_path / "cache")
+    out = str(tmp_path / "out")
+    write(os.path.join(out, "sub", "a.sq3"), "chart")
+    convcache.store(cache_folder, "1" * 64, [out], [(0, os.path.join("sub", "a.sq3"))])
+
+    restored = str(tmp_path / "restored")
+    assert convcache.restore(cache_folder, "1" * 64, [restored])
+
+    with open(os.path.join(restored, "sub", "a.sq3"), "r") as f:
+        assert f.read() == "chart"
+
+    assert not convcache.restore(cache_folder, "2" * 64, [restored])
@@ -0,0 +1,158 @@
+import collections
+import shutil
+import struct
+import subprocess
+
+import numpy
+import pytest
+
+import audio
+import wavfile
+
+HAS_FFMPEG = shutil.which("ffmpeg") is not None
+
+# MPEG 1 layer 3, 128kbps, 44100Hz, stereo: 417 bytes and 1152 samples per frame
+MP3_HEADER = b"\xff\xfb\x90\x00"
+MP3_FRAME_SIZE = 417
+MP3_SIDE_INFO_END = 4 + 32
+
+
+def get_duration(samples, rate=44100):
+    return round(1000 * (samples / rate)) / 1000
+
+
+def make_mp3_frame(tag=b""):
+    # Zeroed side info and main data decode to silence
+    frame = bytearray(MP3_HEADER + b"\x00" * (MP3_FRAME_SIZE - 4))
+    frame[MP3_SIDE_INFO_END:MP3_SIDE_INFO_END+len(tag)] = tag
+    return bytes(frame)
+
+
+def make_cbr_mp3(frames):
+    return make_mp3_frame() * frames
+
+
+def make_xing_mp3(frames, delay=0, padding=0, lame=True):
+    # Xing header with only the frame count, followed by a LAME tag holding the encoder delay and padding
+    tag = b"Xing" + struct.pack(">II", 0x01, frames)
+
+    if lame:
+        tag += b"LAME3.100" + b"\x00" * 12 + bytes([delay >> 4, (delay & 0x0f) << 4 | padding >> 8, padding & 0xff])
+
+    return make_mp3_frame(tag) + make_cbr_mp3(frames)
+
+
+def make_vbri_mp3(frames):
+    tag = b"VBRI" + struct.pack(">HHHI", 1, 0, 0, frames * MP3_FRAME_SIZE) + struct.pack(">I", frames)
+    return make_mp3_frame(tag) + make_cbr_mp3(frames)
+
+
+def make_ogg_page(packet, granule, header_type=0, sequence=0):
+    # The probe doesn't check the CRC so it's left empty
+    return b"OggS" + struct.pack("<BBqIIIB", 0, header_type, granule, 1, sequence, 0, 1) + bytes([len(packet)]) + packet
+
+
+def make_ogg(header, granule):
+    return make_ogg_page(header, 0, 0x02) + make_ogg_page(b"\x00" * 32, granule, 0x04, 1)
+
+
+def make_vorbis(rate, samples):
+    header = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, rate, 0, 0, 0, 0xb8, 1)
+    return make_ogg(header, samples)
+
+
+def make_opus(pre_skip, samples):
+    header = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, pre_skip, 48000, 0, 0)
+    return make_ogg(header, pre_skip + samples)
+
+
+PROBE_FIXTURES = {
+    "mp3_cbr": (".mp3", make_cbr_mp3(40), get_duration(40 * 1152)),
+    "mp3_id3": (".mp3", b"ID3\x04\x00\x00\x00\x00\x00\x10" + b"\x00" * 16 + make_cbr_mp3(40), get_duration(40 * 1152)),
+    "mp3_xing": (".mp3", make_xing_mp3(40, lame=False), get_duration(40 * 1152)),
+    "mp3_lame": (".mp3", make_xing_mp3(40, 576, 1000), get_duration(40 * 1152 - 576 - 1000)),
+    "mp3_vbri": (".mp3", make_vbri_mp3(40), get_duration(40 * 1152)),
+    "vorbis": (".ogg", make_vorbis(44100, 100000), get_duration(100000)),
+    "opus": (".opus", make_opus(312, 96000), get_duration(96000, 48000)),
+}
+
+# Encoder arguments for the files made by ffmpeg, which decode to the real number of samples
+ENCODED_FIXTURES = {
+    "vorbis": (".ogg", ["-c:a", "libvorbis"]),
+    "opus": (".opus", ["-c:a", "libopus"]),
+    "mp3_lame": (".mp3", ["-c:a", "libmp3lame"]),
+    "mp3_cbr": (".mp3", ["-c:a", "libmp3lame", "-write_xing", "0"]),
+}
+
+
+def write_fixture(tmp_path, name, extension, data):
+    filename = str(tmp_path / (name + extension))
+
+    with open(filename, "wb") as f:
+        f.write(data)
+
+    return filename
+
+
+def get_pydub_duration(filename):
+    import pydub
+    return len(pydub.AudioSegment.from_file(filename)) / 1000
+
+
+@pytest.mark.parametrize("name", sorted(PROBE_FIXTURES))
+def test_probe(tmp_path, name):
+    extension, data, duration = PROBE_FIXTURES[name]
+    assert audio.probe_duration(write_fixture(tmp_path, name, extension, data)) == duration
+
+
+def test_probe_wav(tmp_path):
+    filename = str(tmp_path / "a.wav")
+    wavfile.write(filename, 22050, numpy.zeros((33075, 2), dtype='<i2'))
+
+    assert audio.probe_duration(filename) == 1.5
+
+
+def test_probe_unknown(tmp_path):
+    # Anything that isn't recognized is left to ffmpeg
+    assert audio.probe_duration(write_fixture(tmp_path, "a", ".mp3", b"\x00" * 0x1000)) is None
+    assert audio.probe_duration(write_fixture(tmp_path, "b", ".xa", b"RIFF" + b"\x00" * 0x100)) is None
+
+
+@pytest.mark.skipif(not HAS_FFMPEG, reason="pydub needs ffmpeg")
+@pytest.mark.parametrize("name", sorted(name for name in PROBE_FIXTURES if name.startswith("mp3")))
+def test_probe_matches_pydub(tmp_path, name):
+    extension, data, _ = PROBE_FIXTURES[name]
+    filename = write_fixture(tmp_path, name, extension, data)
+
+    assert audio.probe_duration(filename) == get_pydub_duration(filename)
+
+
+@pytest.mark.skipif(not HAS_FFMPEG, reason="pydub needs ffmpeg")
+@pytest.mark.parametrize("name", sorted(ENCODED_FIXTURES))
+def test_encoded_matches_pydub(tmp_path, name):
+    extension, args = ENCODED_FIXTURES[name]
+
+    input_filename = str(tmp_path / "input.wav")
+    t = numpy.arange(48000 * 2 + 123)
+    wavfile.write(input_filename, 48000, (numpy.sin(t / 20) * 8000).astype('<i2'))
+
+    filename = str(tmp_path / (name + extension))
+    if subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", input_filename] + args + [filename]).returncode != 0:
+        pytest.skip("ffmpeg can't encode %s" % name)
+
+    assert audio.probe_duration(filename) == get_pydub_duration(filename)
+
+
+def test_duration_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(audio, "DURATION_CACHE_SIZE", 2)
+    monkeypatch.setattr(audio, "duration_cache", collections.OrderedDict())
+
+    filenames = [write_fixture(tmp_path, str(i), ".mp3", make_cbr_mp3(10 * (i + 1))) for i in range(3)]
+
+    assert audio.get_duration(filenames[0]) == get_duration(10 * 1152)
+    assert audio.get_duration(filenames[1]) == get_duration(20 * 1152)
+    assert audio.get_duration(filenames[0]) == get_duration(10 * 1152)
+    assert audio.get_duration(filenames[2]) == get_duration(30 * 1152)
+
+    # The least recently used file is dropped first
+    assert [key[0] for key in audio.duration_cache] == [filenames[0], filenames[2]]
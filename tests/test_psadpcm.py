@@ -0,0 +1,109 @@
+import glob
+import os
+import shutil
+
+import numpy
+import pytest
+
+import psadpcm
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Set to a VAS1 archive to compare the builtin decoder against vgmstream
+VAS1_SAMPLE = os.environ.get("VAS1_SAMPLE")
+
+
+def make_frame(header, nibbles=()):
+    # header is the shift/filter byte, the 28 nibbles are stored low nibble first
+    nibbles = list(nibbles) + [0] * (28 - len(nibbles))
+    data = bytearray([header, 0])
+
+    for low, high in zip(nibbles[0::2], nibbles[1::2]):
+        data.append((low & 0x0f) | ((high & 0x0f) << 4))
+
+    return bytes(data)
+
+
+def test_no_prediction():
+    # Shift 12 keeps the signed nibbles as they are
+    output = psadpcm.decode_data(make_frame(0x0c, [0, 1, 2, 3, 7, -8, -7, -1]))
+
+    assert output.dtype == numpy.int16
+    assert output.tolist() == [0, 1, 2, 3, 7, -8, -7, -1] + [0] * 20
+
+
+def test_shift():
+    # Shift 0 puts the nibble in the top 4 bits
+    output = psadpcm.decode_data(make_frame(0x00, [7, -8, 1]))
+
+    assert output[:3].tolist() == [28672, -32768, 4096]
+
+
+def test_invalid_shift():
+    # Shifts above 12 are decoded as 9
+    output = psadpcm.decode_data(make_frame(0x0d, [1, -1]))
+
+    assert output[:2].tolist() == [8, -8]
+
+
+def test_prediction():
+    # The first frame leaves hist2 = 4096 and hist1 = 8192
+    history = make_frame(0x00, [0] * 26 + [1, 2])
+
+    # Filter 1: 0 + (60 * 8192) >> 6 = 7680, then (60 * 7680) >> 6 = 7200, ...
+    output = psadpcm.decode_data(history + make_frame(0x1c))
+    assert output[28:34].tolist() == [7680, 7200, 6750, 6328, 5932, 5561]
+
+    # Filter 2: 1 + (115 * 8192 - 52 * 4096) >> 6 = 11393, ...
+    output = psadpcm.decode_data(history + make_frame(0x2c, [1] * 28))
+    assert output[28:32].tolist() == [11393, 13816, 15569, 16751]
+
+
+def test_prediction_clamps():
+    # Filter 4: 28672 + (122 * 28672 - 60 * 28672) >> 6 = 56448, clamped to 32767
+    history = make_frame(0x00, [0] * 26 + [7, 7])
+    output = psadpcm.decode_data(history + make_frame(0x40, [7, 7]))
+
+    assert output[28:30].tolist() == [32767, 32767]
+
+
+@pytest.mark.parametrize("filter_index", [5, 8, 15])
+def test_invalid_filter(filter_index):
+    # Filters above 4 don't exist and are decoded as filter 0
+    history = make_frame(0x00, [0] * 26 + [1, 2])
+    nibbles = [3, -3, 5]
+
+    output = psadpcm.decode_data(history + make_frame((filter_index << 4) | 0x0c, nibbles))
+    expected = psadpcm.decode_data(history + make_frame(0x0c, nibbles))
+
+    assert output.tolist() == expected.tolist()
+    assert output[28:31].tolist() == nibbles
+
+
+def test_partial_frame():
+    # A trailing partial frame is ignored
+    output = psadpcm.decode_data(make_frame(0x0c, [1]) + b"\x0c\x00\x11")
+
+    assert len(output) == 28
+
+
+@pytest.mark.skipif(not VAS1_SAMPLE, reason="VAS1_SAMPLE is not set")
+@pytest.mark.skipif(os.name != "nt" and not shutil.which("wine"), reason="vgmstream needs wine")
+def test_matches_vgmstream(tmp_path, monkeypatch):
+    import vas1tool
+    import wavfile
+
+    # vgmstream_cli.exe is run from the current folder
+    monkeypatch.chdir(REPO_DIR)
+
+    vas1tool.read_vas3(VAS1_SAMPLE, str(tmp_path / "vgmstream"), use_vgmstream=True)
+    vas1tool.read_vas3(VAS1_SAMPLE, str(tmp_path / "builtin"), workers=1)
+
+    filenames = sorted(glob.glob(str(tmp_path / "vgmstream" / "*.wav")))
+    assert filenames
+
+    for filename in filenames:
+        _, expected = wavfile.read(filename)[:2]
+        _, output = wavfile.read(str(tmp_path / "builtin" / os.path.basename(filename)))[:2]
+
+        assert output.tolist() == expected.tolist(), os.path.basename(filename)
@@ -3,6 +3,7 @@
 # TODO: Figure out differences between GF and DM VAS archives
 
 import argparse
+import concurrent.futures
 import io
 import json
 import math
@@ -18,6 +19,8 @@ import audio
 import tmpfile
 import helper
 
+import psadpcm
+
 FLAG_MAP = {
     "DefaultSound": 0x04,
     "NoFilename": 0x0100
@@ -41,7 +44,17 @@ VOLUME_TABLE = [ 0, 14, 21, 28,  33,  37,  41,  44,
                 99, 99, 99, 99, 100, 100, 100, 100 ]
 
 
-def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, is_guitar=False):
+def decode_entries(wave_datas, workers=None):
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1 or len(wave_datas) <= 1:
+        return [psadpcm.decode_data(wave_data) for wave_data in wave_datas]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(psadpcm.decode_data, wave_datas))
+
+
+def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, is_guitar=False, workers=None, use_vgmstream=False):
     data = open(input_filename, "rb").read()
 
     entry_count = struct.unpack("<I", data[0x00:0x04])[0]
@@ -77,22 +90,33 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, i
     if not os.path.exists(basepath):
         os.makedirs(basepath)
 
-    for idx, entry_info in enumerate(entries[:-1]):
-        entry, filesize, sound_id = entry_info
-        #filesize = entries[idx + 1] - entry
+    if use_vgmstream:
+        for idx, entry_info in enumerate(entries[:-1]):
+            entry, filesize, sound_id = entry_info
+            #filesize = entries[idx + 1] - entry
 
-        output_filename = os.path.join(basepath, "%04x.pcm" % (idx))
+            output_filename = os.path.join(basepath, "%04x.pcm" % (idx))
 
-        print("Extracting", output_filename)
-        with open(output_filename, "wb") as outfile:
-            outfile.write(struct.pack(">IHHB", filesize, 0, sample_rate if is_guitar else 44100, 1))
-            outfile.write(bytearray([0] * 7))
-            outfile.write(bytearray([0] * 0x800))
-            outfile.write(data[entry:entry+filesize])
+            print("Extracting", output_filename)
+            with open(output_filename, "wb") as outfile:
+                outfile.write(struct.pack(">IHHB", filesize, 0, sample_rate if is_guitar else 44100, 1))
+                outfile.write(bytearray([0] * 7))
+                outfile.write(bytearray([0] * 0x800))
+                outfile.write(data[entry:entry+filesize])
+
+            audio.get_wav_from_pcm(output_filename)
+            os.remove(output_filename)
 
-        audio.get_wav_from_pcm(output_filename)
-        os.remove(output_filename)
+        return
 
+    # Decode the entries in memory instead of going through vgmstream for every one of them
+    wave_datas = [data[entry:entry+filesize] for entry, filesize, _ in entries[:-1]]
+    outputs = decode_entries(wave_datas, workers)
+
+    for idx, output in enumerate(outputs):
+        output_filename = os.path.join(basepath, "%04x.wav" % (idx))
+        print("Extracting", output_filename)
+        wavfile.write(output_filename, sample_rate if is_guitar else 44100, output)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -101,6 +125,8 @@ if __name__ == "__main__":
     parser.add_argument('-m', '--mix', action='store_true', help='Mix output files using volume and pan parameters', required=False, default=False)
     parser.add_argument('-g', '--guitar', action='store_true', help='Is extracting guitar archive', required=False, default=False)
     parser.add_argument('-f', '--force-hex', action='store_true', help='Force hex filenames', required=False, default=False)
+    parser.add_argument('-w', '--workers', help='Number of processes used to decode the keysounds (default: CPU count)', type=int, required=False, default=None)
+    parser.add_argument('--vgmstream', action='store_true', help='Decode the keysounds with vgmstream instead of the builtin decoder', required=False, default=False)
     args = parser.parse_args()
 
-    read_vas3(args.input, args.output, args.force_hex, args.mix, args.guitar)
\ No newline at end of file
+    read_vas3(args.input, args.output, args.force_hex, args.mix, args.guitar, args.workers, args.vgmstream)
\ No newline at end of file
@@ -1,7 +1,10 @@
 import argparse
+import concurrent.futures
 import io
 import json
 import math
+import mmap
+import multiprocessing
 import numpy
 import os
 import pydub
@@ -16,9 +19,6 @@ import helper
 
 import adpcmwave
 
-import imageio
-imageio.plugins.ffmpeg.download()
-
 
 GDX_SIZES = {
     'GDXH': 0x14,
@@ -47,7 +47,62 @@ VOLUME_TABLE = [ 0, 14, 21, 28,  33,  37,  41,  44,
                 98, 98, 98, 98,  99,  99,  99,  99,
                 99, 99, 99, 99, 100, 100, 100, 100 ]
 
-def write_vas3(input_foldername, output_filename, metadata=None):
+def encode_entry(filename):
+    # Decode, resample and ADPCM encode a single keysound
+    samples, rate = audio.get_pcm(filename, channels=1, rate=48000, bits=16)
+
+    channels = samples.shape[1]
+
+    encoded_data = adpcmwave.encode_data(samples, channels)
+
+    return rate, channels, encoded_data
+
+
+# Pool shared by every VA3 build and extraction of a run, see start_executor
+shared_executor = None
+
+
+def get_executor(workers):
+    # Workers are spawned instead of forked so they never inherit a lock
+    # (ffmpeg setup, PCM cache) that another thread was holding at the time
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def start_executor(workers):
+    # Call from the main thread, the drum and guitar builds then share one pool
+    # instead of each starting their own
+    global shared_executor
+
+    if workers > 1:
+        shared_executor = get_executor(workers)
+
+    return shared_executor
+
+
+def stop_executor():
+    global shared_executor
+
+    if shared_executor:
+        shared_executor.shutdown()
+        shared_executor = None
+
+
+def map_entries(func, items, workers=1):
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    if shared_executor:
+        return list(shared_executor.map(func, items))
+
+    with get_executor(workers) as executor:
+        return list(executor.map(func, items))
+
+
+def encode_entries(filenames, workers=1):
+    return map_entries(encode_entry, filenames, workers)
+
+
+def write_vas3(input_foldername, output_filename, metadata=None, workers=1):
     if not input_foldername:
         input_foldername = ""
 
@@ -107,6 +162,9 @@ def write_vas3(input_foldername, output_filename, metadata=None):
         defaults = [metadata['defaults'][x] for x in metadata['defaults']]
         data_section = bytearray()
 
+        # Find the files for all entries first, the audio is then encoded in parallel
+        # and the entry table is written in order from the results
+        found_entries = []
         for entry in metadata['entries']:
             filename = entry['filename']
 
@@ -140,23 +198,11 @@ def write_vas3(input_foldername, output_filename, metadata=None):
             if 'extra' not in entry:
                 entry['extra'] = 255 # Normal?
 
-            # try:
-            #     rate, raw_data, bits = wavfile.read(filename)
-            # except:
-
-            # Try using pysoundfile if wavfile failed
-            # If this code works well enough, I can probably get rid of
-            # wavfile for the was3tool since looping isn't required
-            # TODO: Replace this with code to detect if it's a WAV, 16bit, mono, and 48000 and if so, use wavfile instead
-            #print(filename)
-            filename = audio.get_processed_wav(filename, channels=1, rate=48000, bits=16)
+            found_entries.append((entry, filename))
 
-            rate, raw_data, bits = wavfile.read(filename)
-
-            channels = 1 if len(raw_data.shape) == 1 else raw_data.shape[1]
-
-            encoded_data = adpcmwave.encode_data(raw_data, channels)
+        encoded_entries = encode_entries([filename for _, filename in found_entries], workers)
 
+        for (entry, _), (rate, channels, encoded_data) in zip(found_entries, encoded_entries):
             sound_flag = 0
             for flag in entry['flags']:
                 if flag in FLAG_MAP:
@@ -209,24 +255,25 @@ def write_vas3(input_foldername, output_filename, metadata=None):
         outfile.write(data_section)
 
 
-def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
-    data = open(input_filename, "rb").read()
+def decode_entry(args):
+    wave_data, rate, channels, bits = args
+    return adpcmwave.decode_data(wave_data, rate, channels, bits)
+
+
+def decode_entries(decode_args, workers=1):
+    return map_entries(decode_entry, decode_args, workers)
 
-    if data[0:4].decode('ascii') != "VA3W":
-        print("Not a valid VA3 file")
-        exit(1)
+
+def parse_vas3(data):
+    if data[0:4] != b"VA3W":
+        raise Exception("Not a valid VA3 file")
 
     # v3 header is 1 0 0 2
     version_flag1, version_flag2, version_flag3, version_flag4, entry_count, gdx_size, gdx_start, entry_start, data_start = struct.unpack("<BBBBIIIII", data[0x04:0x1c])
 
-    if entry_count <= 0:
-        print("No files to extract")
-        exit(1)
-
     gdx_magic = data[gdx_start:gdx_start+4].decode('ascii')
     if gdx_magic != "GDXH" and gdx_magic != "GDXG":
-        print("Not a valid GDXH header")
-        exit(1)
+        raise Exception("Not a valid GDXH header")
 
     default_hihat, default_snare, default_bass, default_hightom, default_lowtom, default_rightcymbal = struct.unpack("<HHHHHH", data[gdx_start+0x04:gdx_start+0x10])
     if gdx_magic == "GDXH":
@@ -302,8 +349,7 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
              # This code shouldn't be hit unless you're working
              # with some really old files I suspect
             volume = 3 * volume / 2
-            print("Verify volume when gdx_volume_flag == 0")
-            exit(1)
+            raise Exception("Verify volume when gdx_volume_flag == 0")
         else:
             volume = min(volume, 127)
 
@@ -317,8 +363,7 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
             pass
 
         if sound_id >= 0xfff0:
-            print("Verify when sound_id >= 0xfff0")
-            exit(1)
+            raise Exception("Verify when sound_id >= 0xfff0")
 
         if sound_id == 0xfff0:
             sound_id = default_leftcymbal
@@ -328,6 +373,7 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
             sound_id = default_leftpedal
 
         entries.append({
+            'index': i,
             'sound_id': sound_id,
             'filename': filename,
             'offset': offset,
@@ -337,6 +383,7 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
             'rate': rate,
             'volume': volume,
             'pan': pan,
+            'sound_flag': sound_flag,
         })
 
         metadata['entries'].append({
@@ -359,6 +406,97 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
         if (sound_flag & 0x0100) != 0:
             metadata['entries'][-1]['flags'].append("NoFilename")
 
+    return metadata, entries, data_start
+
+
+class VA3Archive:
+    # Random access to the entries of a VA3 archive.
+    # Only the header and entry table are parsed, audio is decoded when requested.
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.metadata, self.entries, self.data_start = parse_vas3(self.data)
+        except Exception:
+            self.close()
+            raise
+
+        self.entries_by_sound_id = {}
+        self.entries_by_filename = {}
+        for entry, metadata_entry in zip(self.entries, self.metadata['entries']):
+            metadata_entry['duration'] = self.get_duration(entry)
+            self.entries_by_sound_id.setdefault(entry['sound_id'], entry)
+            self.entries_by_filename.setdefault(entry['filename'].lower(), entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def close(self):
+        if getattr(self, 'data', None) is not None:
+            self.data.close()
+            self.data = None
+
+        self.file.close()
+
+    def get_entry_by_sound_id(self, sound_id):
+        return self.entries_by_sound_id.get(sound_id)
+
+    def get_entry_by_filename(self, filename):
+        filename = os.path.splitext(os.path.basename(filename))[0]
+        return self.entries_by_filename.get(filename.lower())
+
+    def get_wav_filename(self, entry):
+        if (entry['sound_flag'] & 0x100) != 0:
+            return "%04x.wav" % entry['sound_id']
+
+        return "{}.wav".format(entry['filename'])
+
+    def get_duration(self, entry):
+        # Every byte holds one sample of each channel in stereo entries and two samples in mono entries
+        frames = entry['filesize'] * 2 // entry['channels']
+        return round(1000 * (frames / entry['rate'])) / 1000
+
+    def get_entry_data(self, entry):
+        offset = self.data_start + entry['offset']
+        return self.data[offset:offset+entry['filesize']]
+
+    def get_samples(self, entry):
+        # Decoded 16-bit samples shaped (frames, channels)
+        output = adpcmwave.decode_data(self.get_entry_data(entry), entry['rate'], entry['channels'], entry['bits'])
+        return numpy.frombuffer(output, dtype='<i2', count=len(output) // 2 // entry['channels'] * entry['channels']).reshape(-1, entry['channels'])
+
+    def extract(self, entry, output_filename):
+        wavfile.write(output_filename, entry['rate'], self.get_samples(entry))
+
+
+def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False, workers=1):
+    with VA3Archive(input_filename) as archive:
+        metadata = archive.metadata
+        entries = archive.entries
+
+        if len(entries) <= 0:
+            print("No files to extract")
+            exit(1)
+
+        # Decode every entry in memory first, then write them all out
+        decode_args = [(archive.get_entry_data(entry), entry['rate'], entry['channels'], entry['bits']) for entry in entries]
+
+    sound_flag = entries[-1]['sound_flag']
+
     if output_folder:
         basepath = output_folder
     else:
@@ -367,13 +505,12 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
     if not os.path.exists(basepath):
         os.makedirs(basepath)
 
-    for entry in entries:
+    outputs = decode_entries(decode_args, workers)
+
+    for entry, output in zip(entries, outputs):
         #print("Extracting", entry['filename'])
         #print(entry)
 
-        wave_data = bytearray(data[data_start+entry['offset']:data_start+entry['offset']+entry['filesize']])
-        output = adpcmwave.decode_data(wave_data, entry['rate'], entry['channels'], entry['bits'])
-
         output_filename = os.path.join(basepath, "{}.wav".format(entry['filename']))
 
         if (sound_flag & 0x100) != 0 or force_hex:
@@ -392,6 +529,7 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
             #     channels=entry['channels']
             # )
 
+            helper.ensure_ffmpeg()
             audio_segment = pydub.AudioSegment.from_file(output_filename)
             pan = (entry['pan'] - (128 / 2)) / (128 / 2)
             audio_segment = audio_segment.pan(pan)
@@ -402,7 +540,8 @@ def read_vas3(input_filename, output_folder, force_hex=False, mix_audio=False):
             entry['volume'] = 127
             entry['pan'] = 64
 
-        entry['duration'] = len(pydub.AudioSegment.from_file(output_filename)) / 1000
+        # Same rounding as len(AudioSegment) without reading the file back
+        entry['duration'] = round(1000 * (len(output) / entry['rate'])) / 1000
 
         for idx in range(len(metadata['entries'])):
             if metadata['entries'][idx]['sound_id'] == entry['sound_id']:
@@ -423,9 +562,12 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', help='Output file', required=True)
     parser.add_argument('-m', '--mix', action='store_true', help='Mix output files using volume and pan parameters', required=False, default=False)
     parser.add_argument('-f', '--force-hex', action='store_true', help='Force hex filenames', required=False, default=False)
+    parser.add_argument('-w', '--workers', help='Number of processes used to encode or decode the keysounds (default: CPU count)', type=int, required=False, default=None)
     args = parser.parse_args()
 
+    workers = args.workers or os.cpu_count() or 1
+
     if args.create:
-        write_vas3(args.input, args.output)
+        write_vas3(args.input, args.output, workers=workers)
     elif args.extract:
-        read_vas3(args.input, args.output, args.force_hex, args.mix)
\ No newline at end of file
+        read_vas3(args.input, args.output, args.force_hex, args.mix, workers)
\ No newline at end of file
@@ -11,35 +11,39 @@ import tmpfile
 
 import helper
 
-helper.check_ffmpeg()
+# Bytes of ADPCM data decoded at a time, each byte is 4 bytes of 16-bit PCM
+BLOCK_SIZE = 0x40000
 
 def parse_bin(input_filename, output_filename):
     with open(input_filename,"rb") as f:
-        data = f.read()
+        header = f.read(0x20)
 
-    if data[0:4].decode('ascii') != "BMP\0":
-        print("Not a BMP audio file")
-        exit(1)
+        if header[0:4].decode('ascii') != "BMP\0":
+            print("Not a BMP audio file")
+            exit(1)
 
-    data_size, loop_start, loop_end = struct.unpack(">III", data[0x04:0x10])
-    channels, bits = struct.unpack("<HH", data[0x10:0x14])
-    rate, = struct.unpack(">I", data[0x14:0x18])
+        data_size, loop_start, loop_end = struct.unpack(">III", header[0x04:0x10])
+        channels, bits = struct.unpack("<HH", header[0x10:0x14])
+        rate, = struct.unpack(">I", header[0x14:0x18])
 
-    is_looped = True if loop_start > 0 or loop_end > 0 else False
+        is_looped = True if loop_start > 0 or loop_end > 0 else False
 
-    if is_looped:
-        loops = [(loop_start, loop_end)]
-        print("Found loop offsets: start = %d, end = %d" % (loop_start, loop_end))
+        if is_looped:
+            loops = [(loop_start, loop_end)]
+            print("Found loop offsets: start = %d, end = %d" % (loop_start, loop_end))
 
-        # foobar2000 plugin (rename .wav to .wavloop): http://slemanique.com/software/foo_input_wave_loop.html
-        print("Loop information will be stored in a SMPL chunk for playback in players that have support for SMPL loops")
-    else:
-        loops = None
+            # foobar2000 plugin (rename .wav to .wavloop): http://slemanique.com/software/foo_input_wave_loop.html
+            print("Loop information will be stored in a SMPL chunk for playback in players that have support for SMPL loops")
+        else:
+            loops = None
+
+        # The data is decoded block by block straight into the WAV so memory use doesn't grow with the song length
+        states = adpcmwave.get_decoder_states(channels)
 
-    data = bytearray(data[0x20:])
-    output = adpcmwave.decode_data(data, rate, channels, bits)
-    output = numpy.ndarray((int(len(output) // 2 // channels), channels), numpy.int16, output, 0)
-    wavfile.write(output_filename, rate, output, loops=loops)
+        with wavfile.WavWriter(output_filename, rate, channels, loops=loops) as writer:
+            for data in iter(lambda: f.read(BLOCK_SIZE), b""):
+                output = adpcmwave.decode_data(data, rate, channels, bits, states)
+                writer.write(numpy.frombuffer(output, dtype='<i2').reshape(-1, channels))
 
 def parse_wav(input_filename, output_filename, loop_start=None, loop_end=None, channels=2, rate=48000):
     input_filename = audio.get_processed_wav(input_filename, channels=channels, rate=rate, bits=16)
@@ -47,7 +51,8 @@ def parse_wav(input_filename, output_filename, loop_start=None, loop_end=None, c
     if not input_filename:
         return
 
-    rate, data, bits, loops = wavfile.read(input_filename, readloops=True)
+    # The samples are mapped rather than copied into memory before encoding
+    rate, data, bits, loops = wavfile.read(input_filename, readloops=True, mmap=True)
     channels = 1 if len(data.shape) == 1 else data.shape[1]
 
     if len(loops) > 0:
@@ -18,6 +18,10 @@
 # * removed RIFX support (big-endian) (never seen one in 10+ years of audio production/audio programming), only RIFF (little-endian) are supported
 # * removed read(..., mmap)
 #
+# * read: mmap=True returns a read-only numpy.memmap of the data chunk instead of loading it
+# * info: reads format, rate, channels, bits, frame count and loops from the header without the samples
+# * WavWriter: writes a WAV file block by block, sizes and loops are filled in on close
+#
 #
 # Test:
 # ..\wav\____wavfile_demo.py
@@ -30,11 +34,16 @@ Functions
 ---------
 `read`: Return the sample rate (in samples/sec) and data from a WAV file.
 
+`info`: Return the format, length and loops of a WAV file without reading the data.
+
 `write`: Write a numpy array as a WAV file.
 
+`WavWriter`: Write a WAV file from blocks of samples.
+
 """
 from __future__ import division, print_function, absolute_import
 
+import os
 import numpy
 import struct
 import warnings
@@ -64,7 +73,7 @@ def _read_fmt_chunk(fid):
 
 # assumes file pointer is immediately
 #   after the 'data' id
-def _read_data_chunk(fid, noc, bits, normalized=False):
+def _read_data_chunk(fid, noc, bits, normalized=False, mmap=False):
     size = struct.unpack('<i',fid.read(4))[0]
 
     if bits == 8 or bits == 24:
@@ -77,7 +86,21 @@ def _read_data_chunk(fid, noc, bits, normalized=False):
     if bits == 32 and _ieee:
        dtype = 'float32'
 
-    data = numpy.fromfile(fid, dtype=dtype, count=size//bytes)
+    if mmap:
+        if bits == 24 or normalized:
+            raise ValueError("mmap is not supported for 24-bit or normalized data")
+
+        # Read-only view of the data chunk, only the parts that are used get loaded.
+        # A data chunk that runs past the end of the file is cut at the file end.
+        start = fid.tell()
+        count = min(size, os.fstat(fid.fileno()).st_size - start) // bytes
+        if count > 0:
+            data = numpy.memmap(fid, dtype=dtype, mode='r', offset=start, shape=(count,))
+        else:
+            data = numpy.zeros(0, dtype=dtype)
+        fid.seek(start + size)
+    else:
+        data = numpy.fromfile(fid, dtype=dtype, count=size//bytes)
 
     if bits == 24:
         a = numpy.empty((len(data) // 3, 4), dtype='u1')
@@ -116,7 +139,7 @@ def _read_riff_chunk(fid):
     return fsize
 
 
-def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False, readloops=False, readpitch=False, normalized=False, forcestereo=False):
+def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False, readloops=False, readpitch=False, normalized=False, forcestereo=False, mmap=False):
     """
     Return the sample rate (in samples/sec) and data from a WAV file
 
@@ -124,6 +147,10 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
     ----------
     file : file
         Input wav file.
+    mmap : bool, optional
+        Whether to return the data as a read-only memory-map instead of
+        loading it. Only works with real files, not with 24-bit or
+        normalized data.
 
     Returns
     -------
@@ -161,7 +188,7 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
         if chunk_id == b'fmt ':
             size, comp, noc, rate, sbytes, ba, bits = _read_fmt_chunk(fid)
         elif chunk_id == b'data':
-            data = _read_data_chunk(fid, noc, bits, normalized)
+            data = _read_data_chunk(fid, noc, bits, normalized, mmap)
         elif chunk_id == b'cue ':
             str1 = fid.read(8)
             size, numcue = struct.unpack('<ii',str1)
@@ -213,6 +240,125 @@ def read(file, readmarkers=False, readmarkerlabels=False, readmarkerslist=False,
         + ((pitch,) if readpitch else ())
 
 
+WavInfo = collections.namedtuple('WavInfo', ['format', 'rate', 'channels', 'bits', 'frames', 'loops'])
+
+def info(file):
+    """
+    Return the format, length and loops of a WAV file without reading the data
+
+    Parameters
+    ----------
+    file : file
+        Input wav file.
+
+    Returns
+    -------
+    info : WavInfo
+        Format tag, sample rate, number of channels, bits per sample,
+        number of frames and loops as [start, end] pairs
+
+    Notes
+    -----
+
+    * The file can be an open file or a filename.
+    * The format tag is 0 if there is no fmt chunk.
+    * A data chunk that runs past the end of the file is counted up to
+      the end of the file, the same as pydub.
+
+    """
+    if hasattr(file,'read'):
+        fid = file
+    else:
+        fid = open(file, 'rb')
+
+    start = fid.tell()
+    fid.seek(0, 2)
+    file_end = fid.tell()
+    fid.seek(start)
+
+    fsize = _read_riff_chunk(fid)
+    comp = 0
+    noc = 1
+    bits = 8
+    rate = 0
+    data_size = None
+    loops = []
+    while (fid.tell() < fsize):
+        chunk_id = fid.read(4)
+        if len(chunk_id) < 4:
+            break
+        elif chunk_id == b'fmt ':
+            size, comp, noc, rate, sbytes, ba, bits = _read_fmt_chunk(fid)
+        elif chunk_id == b'data':
+            # Only the size of the first data chunk is needed, the samples are skipped
+            size = struct.unpack('<I',fid.read(4))[0]
+            if data_size is None:
+                data_size = min(size, file_end - fid.tell())
+            fid.seek(size + (size & 1), 1)
+        elif chunk_id == b'smpl':
+            str1 = fid.read(40)
+            size, manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack('<iiiiiIiiii', str1)
+            for i in range(numsampleloops):
+                str1 = fid.read(24)
+                cuepointid, type, start, end, fraction, playcount = struct.unpack('<iiiiii', str1)
+                loops.append([start, end])
+            fid.seek(size - 36 - numsampleloops * 24 + (size & 1), 1)
+        else:
+            _skip_unknown_chunk(fid)
+    fid.close()
+
+    frame_width = noc * ((bits + 7) // 8)
+    frames = (data_size or 0) // frame_width if frame_width else 0
+
+    return WavInfo(comp & 0xffff, rate, noc, bits, frames, loops)
+
+
+# writes the RIFF header, fmt chunk and the start of the data chunk,
+#   the samples have to follow right after
+def _write_header(fid, rate, noc, bits, data_size):
+    fid.write(b'RIFF')
+    fid.write(b'\x00\x00\x00\x00')
+    fid.write(b'WAVE')
+
+    # fmt chunk
+    fid.write(b'fmt ')
+    sbytes = rate * (bits // 8) * noc
+    ba = noc * (bits // 8)
+    fid.write(struct.pack('<ihHIIHH', 16, 1, noc, rate, sbytes, ba, bits))
+
+    fid.write(b'data')
+    fid.write(struct.pack('<i', data_size))
+
+
+# writes a smpl chunk with the loops (start, end in frames) and the pitch
+def _write_smpl_chunk(fid, rate, loops, pitch=None):
+    if not loops:
+        loops = []
+    if pitch:
+        midiunitynote = 12 * numpy.log2(pitch * 1.0 / 440.0) + 69
+        midipitchfraction = int((midiunitynote - int(midiunitynote)) * (2**32-1))
+        midiunitynote = int(midiunitynote)
+        #print(midipitchfraction, midiunitynote)
+    else:
+        midiunitynote = 0
+        midipitchfraction = 0
+    fid.write(b'smpl')
+    size = 36 + len(loops) * 24
+    sampleperiod = int(1000000000.0 / rate)
+
+    fid.write(struct.pack('<iiiiiIiiii', size, 0, 0, sampleperiod, midiunitynote, midipitchfraction, 0, 0, len(loops), 0))
+    for i, loop in enumerate(loops):
+        fid.write(struct.pack('<iiiiii', 0, 0, loop[0], loop[1], 0, 0))
+
+
+# Determine file size and place it in correct
+#  position at start of the file.
+def _write_riff_size(fid):
+    size = fid.tell()
+    fid.seek(4)
+    fid.write(struct.pack('<i', size-8))
+    fid.seek(size)
+
 
 def write(filename, rate, data, bitrate=None, markers=None, loops=None, pitch=None, normalized=False):
     """
@@ -255,23 +401,13 @@ def write(filename, rate, data, bitrate=None, markers=None, loops=None, pitch=No
             data = numpy.asarray(data * (2 ** 31 - 1), dtype=numpy.int32)
 
     fid = open(filename, 'wb')
-    fid.write(b'RIFF')
-    fid.write(b'\x00\x00\x00\x00')
-    fid.write(b'WAVE')
-
-    # fmt chunk
-    fid.write(b'fmt ')
     if data.ndim == 1:
         noc = 1
     else:
         noc = data.shape[1]
     bits = data.dtype.itemsize * 8 if bitrate != 24 else 24
-    sbytes = rate * (bits // 8) * noc
-    ba = noc * (bits // 8)
-    fid.write(struct.pack('<ihHIIHH', 16, 1, noc, rate, sbytes, ba, bits))
+    _write_header(fid, rate, noc, bits, data.nbytes)
 
-    fid.write(b'data')
-    fid.write(struct.pack('<i', data.nbytes))
     import sys
     if data.dtype.byteorder == '>' or (data.dtype.byteorder == '=' and sys.byteorder == 'big'):
         data = data.byteswap()
@@ -308,27 +444,115 @@ def write(filename, rate, data, bitrate=None, markers=None, loops=None, pitch=No
 
     # smpl chunk
     if loops or pitch:
-      if not loops:
-        loops = []
-      if pitch:
-        midiunitynote = 12 * numpy.log2(pitch * 1.0 / 440.0) + 69
-        midipitchfraction = int((midiunitynote - int(midiunitynote)) * (2**32-1))
-        midiunitynote = int(midiunitynote)
-        #print(midipitchfraction, midiunitynote)
-      else:
-        midiunitynote = 0
-        midipitchfraction = 0
-      fid.write(b'smpl')
-      size = 36 + len(loops) * 24
-      sampleperiod = int(1000000000.0 / rate)
+      _write_smpl_chunk(fid, rate, loops, pitch)
 
-      fid.write(struct.pack('<iiiiiIiiii', size, 0, 0, sampleperiod, midiunitynote, midipitchfraction, 0, 0, len(loops), 0))
-      for i, loop in enumerate(loops):
-        fid.write(struct.pack('<iiiiii', 0, 0, loop[0], loop[1], 0, 0))
+    _write_riff_size(fid)
+    fid.close()
 
-    # Determine file size and place it in correct
-    #  position at start of the file.
-    size = fid.tell()
-    fid.seek(4)
-    fid.write(struct.pack('<i', size-8))
-    fid.close()
\ No newline at end of file
+
+class WavWriter(object):
+    """
+    Write a WAV file block by block
+
+    Parameters
+    ----------
+    file : file
+        The name of the file to write (will be over-written) or an open file.
+    rate : int
+        The sample rate (in samples/sec).
+    channels : int
+        The number of channels.
+    bits : int, optional
+        Bits per sample, 8, 16 or 32.
+    loops : list, optional
+        Loops as (start, end) pairs, stored in a smpl chunk.
+    pitch : float, optional
+        Pitch stored in the smpl chunk.
+
+    Notes
+    -----
+    * Blocks are integer numpy arrays shaped (Nsamples, Nchannels) or 1-D
+      for mono, they are converted to the sample type of the file.
+      8-bit WAV samples are unsigned, signed blocks are biased by 128.
+    * The RIFF and data sizes and the smpl chunk are written on close,
+      use it as a context manager so that always happens. If the block
+      raises, the file is closed and a file opened by name is deleted.
+
+    """
+    def __init__(self, file, rate, channels, bits=16, loops=None, pitch=None):
+        if bits not in (8, 16, 32):
+            raise ValueError("Unsupported bits per sample: %d" % bits)
+
+        if hasattr(file, 'write'):
+            self.fid = file
+            self.filename = None
+        else:
+            self.fid = open(file, 'wb')
+            self.filename = file
+
+        self.rate = rate
+        self.channels = channels
+        self.bits = bits
+        self.loops = loops
+        self.pitch = pitch
+        self.dtype = numpy.dtype('u1' if bits == 8 else '<i%d' % (bits // 8))
+        self.data_size = 0
+
+        _write_header(self.fid, rate, channels, bits, 0)
+        self.data_start = self.fid.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def frames(self):
+        return self.data_size // (self.channels * self.dtype.itemsize)
+
+    def write(self, data):
+        data = numpy.asarray(data)
+
+        if data.ndim == 1 and self.channels != 1 or data.ndim == 2 and data.shape[1] != self.channels:
+            raise ValueError("Expected %d channels" % self.channels)
+
+        if self.bits == 8 and data.dtype.kind == 'i':
+            data = data.astype(numpy.int16) + 128
+
+        data = numpy.ascontiguousarray(data, dtype=self.dtype)
+        self.fid.write(data.tobytes())
+        self.data_size += data.nbytes
+
+    def close(self):
+        if self.fid is None:
+            return
+
+        if self.data_size & 1:
+            # data chunk is word-aligned
+            self.fid.write(b'\x00')
+
+        if self.loops or self.pitch:
+            _write_smpl_chunk(self.fid, self.rate, self.loops, self.pitch)
+
+        self.fid.seek(self.data_start - 4)
+        self.fid.write(struct.pack('<i', self.data_size))
+        self.fid.seek(0, 2)
+        _write_riff_size(self.fid)
+
+        self.fid.close()
+        self.fid = None
+
+    def abort(self):
+        # Leaves no partial file behind, a file object passed in is only closed
+        if self.fid is None:
+            return
+
+        self.fid.close()
+        self.fid = None
+
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)